@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: future_fstrings -*-
+# Time the vectorized deproject against the original interpolation per column.
+# Run from the repository with python benchmarks/benchmark_deproject.py [size_y size_x]
+
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# read_functions has to be imported before the other support modules
+import pyFAT_astro.Support.read_functions
+from pyFAT_astro.Support.support_functions import deproject
+
+# The deproject of pyFAT v0.0.6, one np.interp call per column
+def deproject_per_column(map,angle,center = 0., invert = False):
+    axis = np.array(range(len(map[:,0])),dtype=float)-center
+    if invert:
+        newaxis = axis/np.cos(np.radians(angle))
+    else:
+        newaxis = axis*np.cos(np.radians(angle))
+    for x in range(len(map[0,:])):
+        profile = copy.deepcopy(map[:,x])
+        map[:,x] = np.interp(np.array(newaxis,dtype=float),np.array(axis,dtype=float),np.array(profile,dtype=float))
+    return map
+
+def benchmark_deproject(shape = [1024,1024], inclination = 60., repeat = 5):
+    Configuration = {'OUTPUTLOG': None}
+    map = np.random.default_rng(1).normal(size=shape)
+    center = shape[0]/2.-1
+    results = {}
+    for invert in [False,True]:
+        start = time.perf_counter()
+        for i in range(repeat):
+            reference = deproject_per_column(copy.deepcopy(map),inclination,center = center, invert = invert)
+        loop_time = (time.perf_counter()-start)/repeat
+        start = time.perf_counter()
+        for i in range(repeat):
+            vectorized = deproject(Configuration,map,inclination,center = center, invert = invert, in_place = False)
+        vectorized_time = (time.perf_counter()-start)/repeat
+        results['invert' if invert else 'deproject'] = [loop_time,vectorized_time,float(np.max(np.abs(reference-vectorized)))]
+        print(f'''BENCHMARK_DEPROJECT: {'invert' if invert else 'deproject'} of a {shape} map
+{'':8s} per column = {loop_time:.4f} s, vectorized = {vectorized_time:.4f} s, speed up = {loop_time/vectorized_time:.1f}
+{'':8s} maximum difference = {results['invert' if invert else 'deproject'][2]}''')
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        benchmark_deproject(shape = [int(sys.argv[1]),int(sys.argv[2])])
+    else:
+        benchmark_deproject()
+        benchmark_deproject(shape = [300,451])
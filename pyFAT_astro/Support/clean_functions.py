@@ -3,12 +3,13 @@
 
 
 import os,signal,sys
+import shutil
 import numpy as np
 import traceback
 from datetime import datetime
-from pyFAT_astro.Support.support_functions import print_log,finish_current_run,set_format,create_directory
+from pyFAT_astro.Support.support_functions import print_log,finish_current_run,set_format,create_directory,locked_append
 from pyFAT_astro.Support.fits_functions import make_moments
-from pyFAT_astro.Support.write_functions import make_overview_plot,plot_usage_stats,tirific,write_config
+from pyFAT_astro.Support.write_functions import make_overview_plot,plot_usage_stats,tirific,write_config,journal_entry
 from pyFAT_astro.Support.read_functions import tirific_template,load_tirific,load_template
 class SofiaMissingError(Exception):
     pass
@@ -182,6 +183,8 @@ def cleanup(Configuration,Fits_Files, debug = False):
                     'restart_Extent_Convergence.txt','Usage_Statistics.txt', 'clean_map_0.fits','clean_map_1.fits','clean_map.fits',\
                     'dep_map_0.fits','minimum_map_0.fits','rot_map_0.fits','dep_map.fits','minimum_map.fits','rot_map.fits',\
                     'dep_map_1.fits','minimum_map_1.fits','rot_map_1.fits','Convolved_Cube_FAT_opt.fits','CFG_Before_Fitting.txt']
+    if os.path.isdir(Configuration['LOG_DIRECTORY']):
+        files_in_log.extend([x for x in os.listdir(Configuration['LOG_DIRECTORY']) if x[:17] == 'Tirific_Progress_'])
     for file in files_in_log:
         try:
             os.remove(f"{Configuration['LOG_DIRECTORY']}{file}")
@@ -190,13 +193,9 @@ def cleanup(Configuration,Fits_Files, debug = False):
     #            !!!!!!!!!!!!!!! The Directories cleanup should be removed before release
     Directories = ['Extent_Convergence', 'Centre_Convergence','tmp_incl_check','One_Step_Convergence']
     for dir in Directories:
+        # tmp_incl_check contains a sub directory for every inclination
         try:
-            for f in os.listdir(f"{Configuration['FITTING_DIR']}{dir}"):
-                os.remove(os.path.join(f"{Configuration['FITTING_DIR']}{dir}", f))
-        except FileNotFoundError:
-            pass
-        try:
-            os.rmdir(f"{Configuration['FITTING_DIR']}{dir}")
+            shutil.rmtree(f"{Configuration['FITTING_DIR']}{dir}")
         except FileNotFoundError:
             pass
 
@@ -217,7 +216,8 @@ def cleanup(Configuration,Fits_Files, debug = False):
     if 'create_fat_cube' in Configuration['FITTING_STAGES']:
         files.append(Fits_Files['FITTING_CUBE'])
 
-    if 'run_sofia' in Configuration['FITTING_STAGES'] or 'existing_sofia' in Configuration['FITTING_STAGES']:
+    # When resuming a batch SOFIA_RAN indicates that we are reusing the existing SoFiA output
+    if ('run_sofia' in Configuration['FITTING_STAGES'] and not Configuration['SOFIA_RAN']) or 'existing_sofia' in Configuration['FITTING_STAGES']:
         dir =f'{Configuration["FITTING_DIR"]}Sofia_Output/'
         file_ext=['_mask.fits','_mom0.fits','_mom1.fits','_mom2.fits','_chan.fits','_cat.txt','_sofia_xv.fits']
         print_log(f'''CLEANUP: We are cleaning the following files in the directory {dir}:
@@ -358,13 +358,7 @@ def cleanup_final(Configuration,Fits_Files, debug =False):
                         pass
     if os.path.isdir(f"{Configuration['FITTING_DIR']}tmp_incl_check"):
         if 5 > Configuration['OUTPUT_QUANTITY'] >= 1:
-            files_in_dir = os.listdir(f"{Configuration['FITTING_DIR']}tmp_incl_check")
-            for file in files_in_dir:
-                try:
-                    os.remove(f"{Configuration['FITTING_DIR']}tmp_incl_check/{file}")
-                except FileNotFoundError:
-                    pass
-            os.rmdir(f"{Configuration['FITTING_DIR']}tmp_incl_check")
+            shutil.rmtree(f"{Configuration['FITTING_DIR']}tmp_incl_check")
         else:
             # else move this directory to the LOG
             if  os.path.isdir(f"{Configuration['LOG_DIRECTORY']}tmp_incl_check"):
@@ -486,6 +480,47 @@ installation_check.__doc__ =f'''
  NOTE:
 '''
 
+# Report a crash with the traceback to the log and screen and exit
+def report_crash(log,exiting):
+    error_message = '''
+            Your code has crashed for some reason. If this message completely baffles you then please submit the trace back as a bug report to: \n
+            https://github.com/PeterKamphuis/pyFAT/issues \n
+            If the error occured while fitting a galaxy, please attach your fitting log as well
+'''
+    print_log(error_message,log, screen = True)
+    if exiting:
+        if log:
+            with open(log,'a') as log_file:
+                traceback.print_tb(exiting.__traceback__,file=log_file)
+        traceback.print_tb(exiting.__traceback__)
+    sys.exit(1)
+report_crash.__doc__ =f'''
+ NAME:
+    report_crash
+
+ PURPOSE:
+    Ask for a bug report, print the traceback of the error to the log and the screen and exit FAT.
+
+ CATEGORY:
+    clean_functions
+
+ INPUTS:
+    log = the log to write to, None prints to the screen only
+    exiting = the exception that crashed FAT, can be None
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: This always exits with status 1.
+'''
+
+
 def finish_galaxy(Configuration,maximum_directory_length,current_run = 'Not initialized', Fits_Files= None, debug = False,exiting = None):
     Configuration['END_TIME'] = datetime.now()
     if debug:
@@ -500,16 +535,11 @@ def finish_galaxy(Configuration,maximum_directory_length,current_run = 'Not init
     check_legitimacy(Configuration,debug=debug)
 
     # Need to write to results catalog
+    # When galaxies are fitted in parallel several processes write to the catalogue
     if Configuration['OUTPUT_CATALOGUE']:
-        with open(Configuration['OUTPUT_CATALOGUE'],'a') as output_catalogue:
-            output_catalogue.write(f"{Configuration['FITTING_DIR'].split('/')[-2]:{maximum_directory_length}s} {str(Configuration['ACCEPTED']):>6s} {Configuration['FINAL_COMMENT']} \n")
+        locked_append(Configuration['OUTPUT_CATALOGUE'],f"{Configuration['FITTING_DIR'].split('/')[-2]:{maximum_directory_length}s} {str(Configuration['ACCEPTED']):>6s} {Configuration['FINAL_COMMENT']} \n")
 
     if Configuration['OUTPUT_QUANTITY'] == 'error':
-        error_message = '''
-            Your code has crashed for some reason. If this message completely baffles you then please submit the trace back as a bug report to: \n
-            https://github.com/PeterKamphuis/pyFAT/issues \n
-            If the error occured while fitting a galaxy, please attach your fitting log as well
-'''
         log_statement = f'''------------When filing a bug report please copy all output  below this line------------
 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 {"":8s}FAT did not run the full fitting routines for catalog nr {Configuration['ID_NR']}.
@@ -519,13 +549,8 @@ def finish_galaxy(Configuration,maximum_directory_length,current_run = 'Not init
 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 '''
         print_log(log_statement,Configuration['OUTPUTLOG'], screen = True)
-        print_log(error_message,Configuration['OUTPUTLOG'], screen = True)
-
-        if exiting:
-            with open(Configuration['OUTPUTLOG'],'a') as log_file:
-                traceback.print_tb(exiting.__traceback__,file=log_file)
-            traceback.print_tb(exiting.__traceback__)
-        sys.exit(1)
+        journal_entry(Configuration,'finished',status='error',debug=debug)
+        report_crash(Configuration['OUTPUTLOG'],exiting)
     elif Configuration['OUTPUT_QUANTITY'] == 5:
         log_statement = f'''
 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -564,18 +589,24 @@ def finish_galaxy(Configuration,maximum_directory_length,current_run = 'Not init
     if Configuration['TIMING']:
 
         plot_usage_stats(Configuration,debug = debug)
-        timing_result = open(Configuration['MAIN_DIRECTORY']+'/Timing_Result.txt','a')
-        timing_result.write(f'''The galaxy in directory {Configuration['FITTING_DIR']} started at {Configuration['START_TIME']}.
-Finished preparations at {Configuration['PREP_END_TIME']} \n''')
-        timing_result.write(f'''Converged to a galaxy size at {Configuration['END_TIME']}. \n''')
-        timing_result.write(f'''It finished the whole process at {datetime.now()}
+        locked_append(Configuration['MAIN_DIRECTORY']+'/Timing_Result.txt',f'''The galaxy in directory {Configuration['FITTING_DIR']} started at {Configuration['START_TIME']}.
+Finished preparations at {Configuration['PREP_END_TIME']}
+Converged to a galaxy size at {Configuration['END_TIME']}.
+It finished the whole process at {datetime.now()}
 ''')
-        timing_result.close()
         log_statement = f'''Finished timing statistics for the galaxy in {Configuration['FITTING_DIR']}.
 '''
         print_log(log_statement,Configuration['OUTPUTLOG'], screen = True)
 
     cleanup_final(Configuration,Fits_Files, debug=debug)
+    # Record the wall time for the cost model of the galaxy scheduling, stopped or crashed galaxies do not tell what a fit costs
+    if Configuration['OUTPUT_QUANTITY'] not in ['error',5]:
+        locked_append(f"{Configuration['MAIN_DIRECTORY']}FAT_Wall_Times.txt",\
+            f"{Configuration['ID_NR']}|{Configuration['SUB_DIR']}|{(datetime.now()-Configuration['START_TIME']).total_seconds():.1f}\n")
+    if Configuration['OUTPUT_QUANTITY'] == 5:
+        journal_entry(Configuration,'finished',status='stopped',debug=debug)
+    else:
+        journal_entry(Configuration,'finished',status='fitted',debug=debug)
 
 finish_galaxy.__doc__ =f'''
  NAME:
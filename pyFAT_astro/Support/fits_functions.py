@@ -1,6 +1,7 @@
 # -*- coding: future_fstrings -*-
 # This module contains a set of functions and classes that are used in several different Python scripts in the Database.
 from astropy.io import fits
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
 from astropy.wcs import WCS
 from pyFAT_astro.Support.support_functions import linenumber,print_log,set_limits,clean_header
 from pyFAT_astro.Support.read_functions import obtain_border_pix
@@ -9,6 +10,12 @@ import numpy as np
 import copy
 import warnings
 import os
+import threading
+from collections import OrderedDict
+
+# The decoded fits files of the current galaxy, most recently used last
+fits_cache = OrderedDict()
+fits_cache_lock = threading.Lock()
 
 class BadHeaderError(Exception):
     pass
@@ -21,32 +28,61 @@ def check_mask(Configuration,id,Fits_Files,debug=False):
     if debug:
         print_log(f'''CHECK_MASK: Checking the mask to contain only the correct source.
 ''',Configuration['OUTPUTLOG'],debug=True)
-    mask = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MASK']}",uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
-
-    if float(id) not in mask[0].data:
+    mask_name = f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MASK']}"
+    # The mask is cleaned, the channel map made and the moments accumulated in a single pass over the channels
+    mask = open_cube(mask_name)
+    if Configuration['SOFIA_RAN']:
+        cube = fits.open(f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}")
+        hdr,hdr2D,zaxis = moment_headers(Configuration,cube[0].header,vel_unit = 'm/s')
+        sums = {}
+    clean_name = f"{mask_name}.clean"
+    if os.path.exists(clean_name):
+        os.remove(clean_name)
+    # The clean mask only contains 0 and id
+    mask_type = working_dtype(Configuration,mask[0].data.dtype,limits=[0,int(float(id))])
+    clean_hdr = copy.deepcopy(mask[0].header)
+    clean_hdr['BITPIX'] = DTYPE2BITPIX[np.dtype(mask_type).name]
+    clean_mask = fits.StreamingHDU(clean_name,clean_hdr)
+    chan_map = np.zeros(mask[0].data.shape[1:],dtype=working_dtype(Configuration,np.dtype(float)))
+    found = False
+    for z in range(mask[0].data.shape[0]):
+        mask_channel = np.array(mask[0].data[z,:,:])
+        source = mask_channel == float(id)
+        found = found or bool(np.any(source))
+        mask_channel[~source] = 0
+        clean_mask.write(mask_channel.astype(mask_type))
+        chan_map += source
+        if Configuration['SOFIA_RAN']:
+            channel = np.array(cube[0].data[z,:,:])
+            channel[~source] = float('NaN')
+            add_channel_to_moments(sums,channel,zaxis[z])
+    clean_mask.close()
+    if not found:
+        os.remove(clean_name)
+        mask.close()
+        if Configuration['SOFIA_RAN']:
+            cube.close()
         print_log(f'''CHECK_MASK: We cannot find the selected source in the mask. This will lead to errors. Aborting the fit.
 ''',Configuration['OUTPUTLOG'],screen = True,debug=debug)
-        BadMaskError(f" We can not find the sofia source id in the mask.")
-    else:
-        data = copy.deepcopy(mask[0].data)
-        data[data != float(id)] = 0.
-        diff = data-mask[0].data
-        neg_index = np.where(diff < 0.)[0]
-        if neg_index.shape:
-            if debug:
-                print_log(f'''CHECK_MASK: The initial mask had more than a single source. redoing the mask.
-''',Configuration['OUTPUTLOG'],screen = True)
-            mask[0].data = data
-            fits.writeto(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MASK']}",mask[0].data,mask[0].header, overwrite = True)
+        raise BadMaskError(f" We can not find the sofia source id in the mask.")
+    if debug:
+        print_log(f'''CHECK_MASK: Writing the mask with only the selected source.
+''',Configuration['OUTPUTLOG'])
 # to ensure compatible units and calculations with th models we make the maps ourselves
-    del mask[0].header['C*3']
-    mask[0].data[mask[0].data> 0.5] = 1.
-    chan_map = np.array(np.nansum(mask[0].data,axis=0),dtype =float)
-    mask[0].header['BITPIX'] = -32
-    fits.writeto(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Configuration['BASE_NAME']}_chan.fits",chan_map,header=mask[0].header,overwrite = True)
+    chan_hdr = copy.deepcopy(mask[0].header)
     mask.close()
+    os.replace(clean_name,mask_name)
+    del chan_hdr['C*3']
+    chan_hdr['BITPIX'] = -32
+    fits.writeto(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Configuration['BASE_NAME']}_chan.fits",chan_map,header=chan_hdr,overwrite = True)
     if Configuration['SOFIA_RAN']:
-        make_moments(Configuration, Fits_Files,fit_type='Generic_Initialize',vel_unit = 'm/s',debug=debug)
+        # The moment 2 needs a second pass with the clean mask
+        mask = open_cube(mask_name)
+        write_moment_maps(Configuration,sums,cube[0].data,hdr,hdr2D,zaxis,\
+                          f"{Configuration['FITTING_DIR']}/Sofia_Output/",f"{Configuration['BASE_NAME']}",\
+                          mask = mask[0].data)
+        mask.close()
+        cube.close()
 check_mask.__doc__ =f'''
  NAME:
     check_mask
@@ -54,6 +90,8 @@ check_mask.__doc__ =f'''
  PURPOSE:
     Check that the mask only contains the source we want and not parts of other nearby sources.
     Subsequently make the channel_map and the moment maps.
+    The cleaning of the mask, the channel map and the moment 0 and 1 are done in
+    a single pass over the channels of the mask and the cube.
 
  CATEGORY:
     fits_functions
@@ -62,17 +100,89 @@ check_mask.__doc__ =f'''
     Configuration = Standard FAT configuration
     id = the SoFiA ID of the source we are interested in
     Fits_Files = Standard FAT dictionary with filenames
-    Tirific_Template = Standard FAT Tirific Template
 
  OPTIONAL INPUTS:
     debug = False
-    fit_type = 'Undefined'
 
  OUTPUTS:
-    moment maps and the channel map
+    the cleaned mask, moment maps and the channel map
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    open_cube, moment_headers, add_channel_to_moments, write_moment_maps
+
+ NOTE: When the source is not in the mask a BadMaskError is raised
+'''
+
+
+
+
+# Store the data and header of a fits file in the cache
+def add_to_fits_cache(Configuration,filename,data,hdr):
+    status = os.stat(filename)
+    limit = Configuration['FITS_CACHE_SIZE']*1024.**2
+    if status.st_size > limit:
+        return
+    # The cached data are shared by every caller so nobody is allowed to change them
+    data.setflags(write=False)
+    with fits_cache_lock:
+        fits_cache[os.path.abspath(filename)] = [[status.st_mtime_ns,status.st_size],data,hdr.copy()]
+        while sum([x[1].nbytes for x in fits_cache.values()]) > limit:
+            fits_cache.popitem(last=False)
+add_to_fits_cache.__doc__ =f'''
+ NAME:
+    add_to_fits_cache
+
+ PURPOSE:
+    Store the decoded data and header of a fits file in the cache
+    and remove the least recently used files if the cache is full.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    filename = full path of the fits file
+    data = the data in the file
+    hdr = the header of the file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the updated fits_cache
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: The data array is stored without copying and is made read only,
+       the header is copied. Files that are larger than FITS_CACHE_SIZE are not stored.
+'''
+
+# Remove all files from the fits cache
+def clear_fits_cache():
+    with fits_cache_lock:
+        fits_cache.clear()
+clear_fits_cache.__doc__ =f'''
+ NAME:
+    clear_fits_cache
+
+ PURPOSE:
+    Empty the cache of fits files, to be called when we are done with a galaxy.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    An empty fits_cache
 
  OPTIONAL OUTPUTS:
-    a cleaned mask
 
  PROCEDURES CALLED:
     Unspecified
@@ -80,13 +190,76 @@ check_mask.__doc__ =f'''
  NOTE:
 '''
 
+# Gather the statistics of every channel needed for the preprocessing in a single pass
+def channel_statistics(data, slab_size = 64.):
+    nz = data.shape[0]
+    # bottom right, top right, bottom left, top left
+    corners = [(slice(None,6),slice(-6,None)),(slice(-6,None),slice(-6,None)),\
+               (slice(None,6),slice(None,6)),(slice(-6,None),slice(None,6))]
+    statistics = {'N': np.zeros(nz,dtype=int),'MEAN': np.full(nz,float('NaN')),'M2': np.zeros(nz),\
+                  'MIN': np.full(nz,float('NaN')),'MAX': np.full(nz,float('NaN')),\
+                  'ZEROS': np.zeros(nz,dtype=int),'CORNER_N': np.zeros((4,nz),dtype=int),\
+                  'CORNER_MEAN': np.full((4,nz),float('NaN')),'CORNER_M2': np.zeros((4,nz))}
+    channel_size = data.shape[1]*data.shape[2]*8.
+    channels_per_slab = int(max(1,slab_size*1024.**2/channel_size))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for start in range(0,nz,channels_per_slab):
+            stop = min(start+channels_per_slab,nz)
+            slab = np.array(data[start:stop,:,:],dtype=float)
+            zeros = slab == 0.
+            statistics['ZEROS'][start:stop] = np.sum(zeros,axis=(1,2))
+            slab[zeros] = float('NaN')
+            # The deviations are taken from the mean of the channel as a sum of squares cancels for cubes with an offset
+            statistics['N'][start:stop] = np.sum(~np.isnan(slab),axis=(1,2))
+            statistics['MEAN'][start:stop] = np.nanmean(slab,axis=(1,2))
+            statistics['M2'][start:stop] = np.nansum((slab-statistics['MEAN'][start:stop,np.newaxis,np.newaxis])**2,axis=(1,2))
+            statistics['MIN'][start:stop] = np.nanmin(slab,axis=(1,2))
+            statistics['MAX'][start:stop] = np.nanmax(slab,axis=(1,2))
+            for i,corner in enumerate(corners):
+                corner_slab = slab[:,corner[0],corner[1]]
+                statistics['CORNER_N'][i,start:stop] = np.sum(~np.isnan(corner_slab),axis=(1,2))
+                statistics['CORNER_MEAN'][i,start:stop] = np.nanmean(corner_slab,axis=(1,2))
+                statistics['CORNER_M2'][i,start:stop] = np.nansum((corner_slab-statistics['CORNER_MEAN'][i,start:stop,np.newaxis,np.newaxis])**2,axis=(1,2))
+    return statistics
+channel_statistics.__doc__ =f'''
+ NAME:
+    channel_statistics
+
+ PURPOSE:
+    Read a (memory mapped) cube in slabs of channels and gather for every channel
+    the number of values, their mean and the sum of their squared deviations from that mean
+    for the full channel and the four corners of 6x6 pixels. Additionally the minimum, maximum and the
+    number of values that are exactly 0. are determined.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    data = the cube data array
+
+ OPTIONAL INPUTS:
+    slab_size = 64.
+    the maximum size of a slab of channels in Mb
+
+ OUTPUTS:
+    statistics = dictionary with an array with a value for every channel for
+                 N, MEAN, M2, MIN, MAX and ZEROS and an array of (4, channels)
+                 for CORNER_N, CORNER_MEAN and CORNER_M2
+
+ OPTIONAL OUTPUTS:
 
+ PROCEDURES CALLED:
+    Unspecified
 
+ NOTE: Values that are exactly 0. are treated as blanks, as in the FAT cube.
+'''
 
 # Create a cube suitable for FAT
 def create_fat_cube(Configuration, Fits_Files, debug = False):
     #First get the cubes
-    Cube = fits.open(Configuration['FITTING_DIR']+Fits_Files['ORIGINAL_CUBE'],uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
+    # The cube is memory mapped and read in slabs of channels such that it can be larger than the memory
+    Cube = open_cube(Configuration['FITTING_DIR']+Fits_Files['ORIGINAL_CUBE'])
     data = Cube[0].data
     hdr = Cube[0].header
     if hdr['NAXIS'] == 4:
@@ -100,7 +273,8 @@ def create_fat_cube(Configuration, Fits_Files, debug = False):
     log_statement = f'''CREATE_FAT_CUBE: We are writing a FAT modfied cube to be used for the fitting. This cube is called {Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE']}
 '''
     print_log(log_statement,Configuration["OUTPUTLOG"])
-    fits.writeto(Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'],data,hdr)
+    write_fat_cube(Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'],hdr,data,\
+                   dtype = working_dtype(Configuration,data.dtype))
     # Release the arrays
 
     Cube.close()
@@ -147,6 +321,7 @@ def cut_cubes(Configuration, Fits_Files, galaxy_box, debug = False):
         cube_size.append(Configuration['NAXES'][i])
         new_cube.append([0,Configuration['NAXES'][i]])
     new_cube = np.array(new_cube,dtype=int)
+    cut_products = {}
     cut  = False
     for i,limit in enumerate(galaxy_box):
         if limit[0] > cube_edge[i]:
@@ -174,12 +349,12 @@ def cut_cubes(Configuration, Fits_Files, galaxy_box, debug = False):
 ''', Configuration['OUTPUTLOG'])
 
         for file in files_to_cut:
-            cutout_cube(Configuration,file,new_cube,debug=debug)
+            cut_products[file] = cutout_cube(Configuration,file,new_cube,debug=debug)
 
     #We want to check if the cube has a decent number of pixels per beam.
     if not os.path.exists(f"{Configuration['FITTING_DIR']}/{Fits_Files['OPTIMIZED_CUBE']}"):
         optimized_cube(Configuration, Fits_Files,debug=debug)
-    return new_cube
+    return new_cube,cut_products
 cut_cubes.__doc__ =f'''
  NAME:
     cut_cubes
@@ -201,6 +376,9 @@ cut_cubes.__doc__ =f'''
     debug = False
 
  OUTPUTS:
+    new_cube = the limits of the cut cube in the same format as galaxy_box
+    cut_products = dictionary with the cut HDULists with the cut files as keys,
+                   empty when nothing was cut
 
  OPTIONAL OUTPUTS:
 
@@ -214,11 +392,11 @@ cut_cubes.__doc__ =f'''
 '''
 
 def cutout_cube(Configuration,filename,sub_cube, debug = False):
-    Cube = fits.open(Configuration['FITTING_DIR']+filename,uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
+    Cube = open_cube(Configuration['FITTING_DIR']+filename)
     hdr = Cube[0].header
 
     if hdr['NAXIS'] == 3:
-        data = Cube[0].data[sub_cube[0,0]:sub_cube[0,1],sub_cube[1,0]:sub_cube[1,1],sub_cube[2,0]:sub_cube[2,1]]
+        data = Cube[0].section[sub_cube[0,0]:sub_cube[0,1],sub_cube[1,0]:sub_cube[1,1],sub_cube[2,0]:sub_cube[2,1]]
         hdr['NAXIS1'] = sub_cube[2,1]-sub_cube[2,0]
         hdr['NAXIS2'] = sub_cube[1,1]-sub_cube[1,0]
         hdr['NAXIS3'] = sub_cube[0,1]-sub_cube[0,0]
@@ -234,14 +412,22 @@ def cutout_cube(Configuration,filename,sub_cube, debug = False):
             xhigh,yhigh,zhigh = coordinate_frame.wcs_pix2world(*Configuration['NAXES'], 1.)
             Configuration['NAXES_LIMITS'] = [np.sort([xlow,xhigh]),np.sort([ylow,yhigh]),np.sort([zlow,zhigh])/1000.]
     elif hdr['NAXIS'] == 2:
-        data = Cube[0].data[sub_cube[1,0]:sub_cube[1,1],sub_cube[2,0]:sub_cube[2,1]]
+        data = Cube[0].section[sub_cube[1,0]:sub_cube[1,1],sub_cube[2,0]:sub_cube[2,1]]
         hdr['NAXIS1'] = sub_cube[2,1]-sub_cube[2,0]
         hdr['NAXIS2'] = sub_cube[1,1]-sub_cube[1,0]
         hdr['CRPIX1'] = hdr['CRPIX1'] -sub_cube[2,0]
         hdr['CRPIX2'] = hdr['CRPIX2'] -sub_cube[1,0]
 
     Cube.close()
-    fits.writeto(Configuration['FITTING_DIR']+filename,data,hdr,overwrite = True)
+    if np.issubdtype(data.dtype,np.integer) and data.size > 0:
+        data = data.astype(working_dtype(Configuration,data.dtype,limits = [np.min(data),np.max(data)]),copy=False)
+    else:
+        data = data.astype(working_dtype(Configuration,data.dtype),copy=False)
+    cut_hdu = fits.PrimaryHDU(data=data,header=hdr)
+    cut_hdu.writeto(Configuration['FITTING_DIR']+filename,overwrite = True)
+    # Every cut product is read again later on so we keep it in memory
+    add_to_fits_cache(Configuration,Configuration['FITTING_DIR']+filename,cut_hdu.data,cut_hdu.header)
+    return fits.HDUList([cut_hdu])
 cutout_cube.__doc__ =f'''
  NAME:
     cutout_cube
@@ -263,7 +449,163 @@ cutout_cube.__doc__ =f'''
     debug = False
 
  OUTPUTS:
-    the cut cube is written to disk.
+    the cut cube is written to disk and returned as an HDUList.
+    When it fits in the fits cache its data are read only.
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    open_cube, add_to_fits_cache
+
+ NOTE:
+'''
+
+# Obtain a fits file from the cache or read it into the cache
+def cached_fits(Configuration,filename, scaled = False):
+    status = os.stat(filename)
+    limit = Configuration['FITS_CACHE_SIZE']*1024.**2
+    if status.st_size > limit:
+        if scaled:
+            return fits.open(filename,uint = False, ignore_blank = True, output_verify= 'ignore')
+        return open_cube(filename)
+    key = os.path.abspath(filename)
+    version = [status.st_mtime_ns,status.st_size]
+    with fits_cache_lock:
+        if key in fits_cache and fits_cache[key][0] == version:
+            fits_cache.move_to_end(key)
+            data,hdr = fits_cache[key][1:]
+        else:
+            data = None
+    if data is None:
+        data,hdr = read_cube_section(filename)
+        add_to_fits_cache(Configuration,filename,data,hdr)
+    hdr = hdr.copy()
+    if scaled:
+        data,hdr = scale_data(data,hdr)
+    return fits.HDUList([fits.PrimaryHDU(data=data,header=hdr)])
+cached_fits.__doc__ =f'''
+ NAME:
+    cached_fits
+
+ PURPOSE:
+    Open a fits file through the in memory cache of FAT such that
+    the maps and cubes that are used repeatedly for a galaxy are read and
+    decoded from disk only once.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    filename = full path of the fits file
+
+ OPTIONAL INPUTS:
+    scaled = False
+    Apply BSCALE, BZERO and BLANK as fits.open does by default
+
+ OUTPUTS:
+    An HDUList with a read only view of the cached data and a copy of its header.
+    Callers that modify the data have to copy them first.
+    Files larger than the cache are opened memory mapped with open_cube instead.
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    read_cube_section, open_cube, add_to_fits_cache
+
+ NOTE: A cached file is only used when its modification time and size
+       are unchanged, otherwise it is read again.
+       The cache holds at most FITS_CACHE_SIZE Mb, the least recently
+       used files are removed first. 0 switches the cache off.
+       Unless scaled is set the data are read as in open_cube, i.e. without applying BSCALE and BZERO.
+'''
+
+# Apply the scaling keywords of a header to the raw data of a fits file
+def scale_data(data,hdr):
+    bscale = hdr.get('BSCALE',1.)
+    bzero = hdr.get('BZERO',0.)
+    blank = hdr.get('BLANK',None) if np.issubdtype(data.dtype,np.integer) else None
+    if bscale == 1. and bzero == 0. and blank is None:
+        return data,hdr
+    if np.issubdtype(data.dtype,np.integer):
+        dtype = np.float32 if data.dtype.itemsize <= 2 else np.float64
+    else:
+        dtype = data.dtype
+    scaled = data.astype(dtype)
+    if blank is not None:
+        scaled[data == blank] = float('NaN')
+    scaled *= bscale
+    scaled += bzero
+    for key in ['BSCALE','BZERO','BLANK']:
+        hdr.remove(key,ignore_missing=True)
+    return scaled,hdr
+scale_data.__doc__ =f'''
+ NAME:
+    scale_data
+
+ PURPOSE:
+    Convert the raw values of a fits file to physical values with BSCALE and BZERO
+    and blank the BLANK values of integer data, as fits.open does by default.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    data = the raw data
+    hdr = the header of the file, the scaling keywords are removed from it
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    data = the scaled data, the input array itself when there is nothing to scale
+    hdr = the header without the scaling keywords
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+# Obtain the maximum of a cube without loading it completely
+def cube_nanmax(Cube, slab_size = 64.):
+    hdr = Cube[0].header
+    if hdr['NAXIS'] < 3:
+        return np.nanmax(Cube[0].data)
+    # Cubes that are not in memory are read through section such that the slabs do not stay mapped
+    if Cube.fileinfo(0) is None:
+        cube_data = Cube[0].data
+    else:
+        cube_data = Cube[0].section
+    channel_size = hdr['NAXIS1']*hdr['NAXIS2']*abs(hdr['BITPIX'])/8.
+    channels_per_slab = int(max(1,slab_size*1024.**2/channel_size))
+    maximum = float('NaN')
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for start in range(0,hdr['NAXIS3'],channels_per_slab):
+            maximum = np.nanmax([maximum,np.nanmax(cube_data[start:start+channels_per_slab])])
+    return maximum
+cube_nanmax.__doc__ =f'''
+ NAME:
+    cube_nanmax
+
+ PURPOSE:
+    Determine the maximum of a (large) cube by reading it
+    in slabs of channels such that it never has to be in memory completely.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Cube = the opened fits file
+
+ OPTIONAL INPUTS:
+    slab_size = 64.
+    the maximum size of a slab of channels in Mb
+
+ OUTPUTS:
+    the maximum of the finite values in the cube, NaN if there are none
 
  OPTIONAL OUTPUTS:
 
@@ -273,8 +615,84 @@ cutout_cube.__doc__ =f'''
  NOTE:
 '''
 
+# Open a fits file in the way FAT always opens them but memory mapped
+def open_cube(filename, memmap = True):
+    Cube = fits.open(filename,uint = False, do_not_scale_image_data=True,\
+                    ignore_blank = True, output_verify= 'ignore', memmap = memmap)
+    return Cube
+open_cube.__doc__ =f'''
+ NAME:
+    open_cube
+
+ PURPOSE:
+    Open a fits file with the settings FAT uses for all its cubes.
+    By default the data are memory mapped, which means that only the part
+    of the data that is actually accessed is read from disk.
+    As the file is opened readonly modifications of the data remain in memory.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    filename = full path of the fits file
+
+ OPTIONAL INPUTS:
+    memmap = True
+    Memory map the data
+
+ OUTPUTS:
+    The opened HDUList
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: Slicing [0].section instead of [0].data reads only the requested part
+       of the file and returns an independent array.
+'''
+
+# Read only the requested section of a fits file
+def read_cube_section(filename, section = None):
+    Cube = open_cube(filename)
+    hdr = copy.deepcopy(Cube[0].header)
+    if section is None:
+        data = np.array(Cube[0].data)
+    else:
+        data = np.array(Cube[0].section[section])
+    Cube.close()
+    return data,hdr
+read_cube_section.__doc__ =f'''
+ NAME:
+    read_cube_section
+
+ PURPOSE:
+    Read a part of a fits file from disk without loading the rest of the data
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    filename = full path of the fits file
+
+ OPTIONAL INPUTS:
+    section = None
+    tuple of slices in the python order, i.e. (z,y,x). None reads all the data
+
+ OUTPUTS:
+    data = the data in the requested section
+    hdr = the unmodified header of the full file
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    open_cube
+
+ NOTE: Negative or out of bound slice limits follow normal numpy conventions.
+'''
+
 # Extract a PV-Diagrams
-def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],convert=-1, debug = False):
+def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],convert=-1, read_section = False, debug = False):
     if debug:
         print_log(f'''EXTRACT_PV: We are the extraction of a PV-Diagram
 {'':8s} PA = {angle}
@@ -284,10 +702,9 @@ def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],c
 ''', Configuration['OUTPUTLOG'], debug =True)
 
 
-    cube = copy.deepcopy(cube_in)
-    hdr = copy.deepcopy(cube[0].header)
-    TwoD_hdr= copy.deepcopy(cube[0].header)
-    data = copy.deepcopy(cube[0].data)
+    # The data are only read so they do not need to be copied
+    hdr = copy.deepcopy(cube_in[0].header)
+    TwoD_hdr= copy.deepcopy(cube_in[0].header)
     #Because astro py is even dumber than Python
     try:
         if hdr['CUNIT3'].lower() == 'km/s':
@@ -307,7 +724,7 @@ def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],c
             coordinate_frame = WCS(hdr)
         xcenter,ycenter,zcenter = coordinate_frame.wcs_world2pix(center[0], center[1], center[2], 1.)
 
-    nz, ny, nx = data.shape
+    nz, ny, nx = hdr['NAXIS3'], hdr['NAXIS2'], hdr['NAXIS1']
     if finalsize[0] != -1:
         if finalsize[1] >nz:
             finalsize[1] = nz
@@ -323,12 +740,21 @@ def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],c
     x1,x2,y1,y2 = obtain_border_pix(Configuration,angle,[xcenter,ycenter],debug=debug)
     linex,liney,linez = np.linspace(x1,x2,nx), np.linspace(y1,y2,nx), np.linspace(0,nz-1,nz)
     #This only works when ny == nx hence nx is used in liney
-    new_coordinates = np.array([(z,y,x)
-                        for z in linez
-                        for y,x in zip(liney,linex)
-                        ],dtype=float).transpose().reshape((-1,nz,nx))
     #spatial_resolution = abs((abs(x2-x1)/nx)*np.sin(np.radians(angle)))+abs(abs(y2-y1)/ny*np.cos(np.radians(angle)))
-    PV = ndimage.map_coordinates(data, new_coordinates,order=1)
+    # Only the final window of the PV diagram is interpolated
+    if finalsize[0] == -1:
+        zstart,zend,xstart,xend = 0,nz,0,nx
+    else:
+        zstart = set_limits(int(zcenter-finalsize[1]/2.),0,int(nz))
+        zend = set_limits(int(zcenter+finalsize[1]/2.),0,int(nz))
+        xstart = set_limits(int(xcenter-finalsize[0]/2.),0,int(nx))
+        xend = set_limits(int(xcenter+finalsize[0]/2.),0,int(nx))
+    # The PV diagram is flipped when CDELT1 is negative so then the window is mirrored along the line
+    if hdr['CDELT1'] < 0:
+        samples = slice(max(nx-xend,0),max(nx-xstart,0))
+    else:
+        samples = slice(xstart,xend)
+    PV = sample_pv_window(Configuration,cube_in,linex[samples],liney[samples],linez[zstart:max(zend,zstart)],read_section = read_section)
     if hdr['CDELT1'] < 0:
         PV = PV[:,::-1]
 
@@ -345,11 +771,6 @@ def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],c
             TwoD_hdr['CRVAL2'] = hdr['CRVAL3']
         TwoD_hdr['CRPIX1'] = xcenter+1
     else:
-        zstart = set_limits(int(zcenter-finalsize[1]/2.),0,int(nz))
-        zend = set_limits(int(zcenter+finalsize[1]/2.),0,int(nz))
-        xstart = set_limits(int(xcenter-finalsize[0]/2.),0,int(nx))
-        xend = set_limits(int(xcenter+finalsize[0]/2.),0,int(nx))
-        PV =  PV[zstart:zend, xstart:xend]
         TwoD_hdr['NAXIS2'] = int(finalsize[1])
         TwoD_hdr['NAXIS1'] = int(finalsize[0])
         TwoD_hdr['CRPIX2'] = hdr['CRPIX3']-int(nz/2.-finalsize[1]/2.)
@@ -392,17 +813,14 @@ def extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],c
     TwoD_hdr['CTYPE1'] = 'OFFSET'
     TwoD_hdr['CUNIT1'] = 'ARCSEC'
     TwoD_hdr['HISTORY'] = f'EXTRACT_PV: PV diagram extracted with angle {angle} and center {center}'
-    # Then we change the cube and rteturn the PV construct
-    cube[0].header = TwoD_hdr
-    cube[0].data = PV
-
-    return cube
+    # Then we rteturn the PV construct
+    return fits.HDUList([fits.PrimaryHDU(data=PV,header=TwoD_hdr)])
 extract_pv.__doc__ = '''
  NAME:
     extract_pv
 
  PURPOSE:
-    extract a PV diagram from a cube object. Angle is the PA and center the central location. The profile is extracted over the full length of the cube and afterwards cut back to the finalsize.
+    extract a PV diagram from a cube object. Angle is the PA and center the central location. The profile runs over the full length of the cube but only the part within the finalsize is interpolated.
 
  CATEGORY:
      fits_functions
@@ -422,6 +840,10 @@ extract_pv.__doc__ = '''
     convert=-1
     conversion factor for velocity axis, default no conversion
 
+    read_section = False
+    Read the window of the PV-diagram from the file of cube_in instead of its data,
+    only for cubes opened from a file whose data are not changed in memory
+
     debug = False
 
  KEYWORD PARAMETERS:
@@ -437,6 +859,64 @@ extract_pv.__doc__ = '''
 '''
 
 
+# Interpolate a cube along a line in the spatial plane for a set of channels
+def sample_pv_window(Configuration,Cube,linex,liney,linez, read_section = False):
+    if linex.size == 0 or linez.size == 0:
+        return np.zeros((linez.size,linex.size),dtype=working_dtype(Configuration,Cube[0].data.dtype))
+    hdr = Cube[0].header
+    # Only the box around the line is read, it includes the pixels beyond the samples that the linear interpolation needs
+    x_low = min(max(int(np.floor(np.min(linex))),0),hdr['NAXIS1']-1)
+    x_high = max(min(int(np.floor(np.max(linex)))+2,hdr['NAXIS1']),x_low+1)
+    y_low = min(max(int(np.floor(np.min(liney))),0),hdr['NAXIS2']-1)
+    y_high = max(min(int(np.floor(np.max(liney)))+2,hdr['NAXIS2']),y_low+1)
+    z_low = int(linez[0])
+    z_high = int(linez[-1])+1
+    # section only reads the box from the file, data holds any changes made in memory
+    if read_section:
+        data = Cube[0].section[z_low:z_high,y_low:y_high,x_low:x_high]
+    else:
+        data = Cube[0].data[z_low:z_high,y_low:y_high,x_low:x_high]
+    data = data.astype(working_dtype(Configuration,data.dtype),copy=False)
+    coordinates = np.empty((3,linez.size,linex.size),dtype=float)
+    coordinates[0] = (linez-z_low)[:,np.newaxis]
+    coordinates[1] = (liney-y_low)[np.newaxis,:]
+    coordinates[2] = (linex-x_low)[np.newaxis,:]
+    return ndimage.map_coordinates(data, coordinates,order=1)
+sample_pv_window.__doc__ =f'''
+ NAME:
+    sample_pv_window
+
+ PURPOSE:
+    Interpolate a cube along a line in the spatial plane for a range of channels
+    without reading or copying more of the cube than the box around the line.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT Configuration
+    Cube = the fits cube object, in memory, memory mapped or not read yet
+    linex = the x pixel coordinates of the samples along the line
+    liney = the y pixel coordinates of the samples along the line
+    linez = the channels to sample, consecutive integers
+
+ OPTIONAL INPUTS:
+    read_section = False
+    Read the box from the file through Cube[0].section instead of slicing Cube[0].data.
+    The caller has to make sure the cube is opened from a file and not changed in memory.
+
+ OUTPUTS:
+    the PV-diagram with shape (len(linez),len(linex))
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    ndimage.map_coordinates
+
+ NOTE:
+    The values are identical to interpolating the full cube with the same coordinates.
+'''
+
 def prep_cube(Configuration,hdr,data, debug = False):
     if debug:
         print_log( f'''PREPROCESSING: starting the preprocessing of the cube
@@ -449,33 +929,44 @@ def prep_cube(Configuration,hdr,data, debug = False):
         hdr['CDELT3'] = abs(hdr['CDELT3'])
         hdr['CRPIX3'] = hdr['NAXIS3']-hdr['CRPIX3']+1
         data = data[::-1,:,:]
+    # Everything we need to know is gathered in a single pass over the channels
+    statistics = channel_statistics(data)
     #Check for zeros
-    if np.where(data == 0.):
+    if np.sum(statistics['ZEROS']) > 0:
         print_log(f'''PREPROCESSING: Your cube contains values exactly 0. If this is padding these should be blanks.
 {"":8s}PREPROCESSING: We have changed them to blanks.
 ''', Configuration['OUTPUTLOG'])
-        data[np.where(data == 0.)] = float('NaN')
 
     # check for blank channels and noise statistics
+    # first and last are the first and last channel that are kept
+    first = 0
+    last = hdr['NAXIS3']-1
     cube_ok = False
     prev_first_comparison = 0.
     prev_last_comparison = 0.
     times_cut_first_channel = 0
     times_cut_last_channel = 0
+    # bottom right, top right, bottom left, top left, combined over the kept channels and updated for every cut channel
+    corner_n,corner_mean,corner_m2 = merge_statistics(statistics['CORNER_N'],statistics['CORNER_MEAN'],statistics['CORNER_M2'])
     while not cube_ok:
-        while np.isnan(data[0,:,:]).all():
-            data=data[1:,:,:]
+        while statistics['N'][first] == 0:
+            corner_n,corner_mean,corner_m2 = remove_statistics(corner_n,corner_mean,corner_m2,\
+                statistics['CORNER_N'][:,first],statistics['CORNER_MEAN'][:,first],statistics['CORNER_M2'][:,first])
+            first += 1
+            # Earlier versions did not shift the reference pixel here and put the spectral axis one channel off for every cut channel
+            hdr['CRPIX3'] = hdr['CRPIX3']-1
             hdr['NAXIS3'] = hdr['NAXIS3']-1
             if hdr['NAXIS3'] < 5:
                 print_log(f'''PREPROCESSING: This cube has too many blanked channels.
 ''', Configuration['OUTPUTLOG'],screen=True)
                 raise BadCubeError("The cube has too many blanked channels")
-            log_statement = f'''PREPROCESSING: We are cutting the cube as the first channel is completely blank.
-'''
             print_log(f'''PREPROCESSING: We are cutting the cube as the first channel is completely blank.
+{"":8s}PREPROCESSING: The reference pixel of the velocity axis is shifted with it.
 ''', Configuration['OUTPUTLOG'])
-        while np.isnan(data[-1,:,:]).all():
-            data=data[:-1,:,:]
+        while statistics['N'][last] == 0:
+            corner_n,corner_mean,corner_m2 = remove_statistics(corner_n,corner_mean,corner_m2,\
+                statistics['CORNER_N'][:,last],statistics['CORNER_MEAN'][:,last],statistics['CORNER_M2'][:,last])
+            last -= 1
             hdr['NAXIS3'] = hdr['NAXIS3']-1
             if hdr['NAXIS3'] < 5:
                 print_log(f'''PREPROCESSING: This cube has too many blanked channels.
@@ -484,13 +975,12 @@ def prep_cube(Configuration,hdr,data, debug = False):
             print_log(f'''PREPROCESSING: We are cutting the cube as the last channel is completely blank.
 ''', Configuration['OUTPUTLOG'])
         #Then check the noise statistics
-        noise_first_channel = np.nanstd(data[0,:,:])
-        noise_last_channel = np.nanstd(data[-1,:,:])
-        noise_bottom_right =  np.nanstd(data[:,:6,-6:])
-        noise_top_right =  np.nanstd(data[:,-6:,-6:])
-        noise_bottom_left =  np.nanstd(data[:,:6,:6])
-        noise_top_left =  np.nanstd(data[:,-6:,:6])
-        noise_corner = np.nanmean([noise_top_right,noise_bottom_right,noise_bottom_left,noise_top_left])
+        noise_first_channel = std_from_deviations(statistics['N'][first],statistics['M2'][first])
+        noise_last_channel = std_from_deviations(statistics['N'][last],statistics['M2'][last])
+        noise_corners = std_from_deviations(corner_n,corner_m2)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            noise_corner = np.nanmean(noise_corners)
         channel_noise = np.nanmean([noise_first_channel,noise_last_channel])
         if ~np.isfinite(noise_corner):
             noise_corner = copy.deepcopy(channel_noise)
@@ -518,7 +1008,9 @@ def prep_cube(Configuration,hdr,data, debug = False):
                ~np.isfinite(noise_first_channel):
                 prev_first_comparison = first_comparison
                 times_cut_first_channel += 1
-                data=data[1:,:,:]
+                corner_n,corner_mean,corner_m2 = remove_statistics(corner_n,corner_mean,corner_m2,\
+                    statistics['CORNER_N'][:,first],statistics['CORNER_MEAN'][:,first],statistics['CORNER_M2'][:,first])
+                first += 1
                 hdr['CRPIX3'] = hdr['CRPIX3'] - 1
                 hdr['NAXIS3'] = hdr['NAXIS3'] - 1
             else:
@@ -526,7 +1018,9 @@ def prep_cube(Configuration,hdr,data, debug = False):
                     ~np.isfinite(noise_last_channel):
                     prev_last_comparison = last_comparison
                     times_cut_last_channel += 1
-                    data=data[:-1,:,:]
+                    corner_n,corner_mean,corner_m2 = remove_statistics(corner_n,corner_mean,corner_m2,\
+                        statistics['CORNER_N'][:,last],statistics['CORNER_MEAN'][:,last],statistics['CORNER_M2'][:,last])
+                    last -= 1
                     hdr['NAXIS3'] = hdr['NAXIS3'] - 1
                 else:
                     cube_ok = True
@@ -544,33 +1038,34 @@ def prep_cube(Configuration,hdr,data, debug = False):
 ''',Configuration['OUTPUTLOG'],screen=True)
         raise BadCubeError('The Cube has noise statistics that cannot be dealt with')
     hdr['FATNOISE'] = noise_corner
+    # The values below -10*sigma are blanked when the cube is written
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        low_noise_indices = np.where(data < -10*noise_corner)
-    if len(low_noise_indices) > 0:
-        data[low_noise_indices] = float('NaN')
+        low_noise = statistics['MIN'][first:last+1] < -10*noise_corner
+    if np.any(low_noise):
         print_log(f'''PREPROCESSING: Your cube had values below -10*sigma. If you do not have a central absorption source there is something seriously wrong with the cube.
 {"":8s}PREPROCESSING: We blanked these values.
 ''',Configuration['OUTPUTLOG'])
 
-    # Check whether any channels got fully blanked
+    # Check whether any channels got fully blanked, i.e. were empty or have only values below -10*sigma
     blanked_channels = []
     for z in range(hdr['NAXIS3']):
-        if np.isnan(data[z,:,:]).all():
+        if statistics['N'][first+z] == 0 or statistics['MAX'][first+z] < -10*noise_corner:
             blanked_channels.append(str(z))
     if len(blanked_channels) == 0.:
         blanked_channels = ['-1']
     hdr['BL_CHAN'] = ','.join(blanked_channels)
     #Previously SoFiA was not dealing with blanks properly and the statement went here
 
-    return data
+    return data[first:last+1,:,:]
 prep_cube.__doc__ =f'''
  NAME:
     prep_cube
 
  PURPOSE:
-    Clean up the cube  and make sure it has all the right
-    characteristics and blanks
+    Determine how the cube should be cleaned up to make sure it has all the right
+    characteristics and blanks. The data itself is not modified such that it can be
+    a memory mapped cube that is larger than the memory.
 
  CATEGORY:
     fits_functions
@@ -584,59 +1079,243 @@ prep_cube.__doc__ =f'''
     debug = False
 
  OUTPUTS:
-    the updated header
+    a view of the data without the cut channels,
+    the header is updated in place.
 
  OPTIONAL OUTPUTS:
 
  PROCEDURES CALLED:
-    Unspecified
+    channel_statistics, merge_statistics, remove_statistics, std_from_deviations
 
- NOTE:
+ NOTE: The blanking of zeros and values below -10*FATNOISE is done by write_fat_cube.
+       CRPIX3 is lowered for every channel that is cut from the start of the cube. Versions
+       up to v0.0.6 did not do this for completely blank leading channels.
 '''
 
-#Create an optimized cube if required
-def optimized_cube(Configuration,Fits_Files, debug = False):
-    pix_per_beam = Configuration['BEAM_IN_PIXELS'][1]
-    if pix_per_beam > Configuration['OPT_PIXEL_BEAM']:
-        cube = fits.open(Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'])
-        data = cube[0].data
-        hdr = cube[0].header
-        if f"{abs(hdr['CDELT1']):.16f}" != f"{abs(hdr['CDELT2']):.16f}":
-            print_log(f'''OPTIMIZED_CUBE: Your input cube does not have square pixels.
-{"":8s}OPTIMIZED_CUBE: FAT cannot optimize your cube.
-''', Configuration['OUTPUTLOG'])
-        cube.close()
-        required_cdelt = hdr['BMIN']/int(Configuration['OPT_PIXEL_BEAM'])
-        ratio = required_cdelt/abs(hdr['CDELT2'])
-        opt_data,opt_hdr = regrid_cube(data, hdr, ratio)
-
-        fits.writeto(Configuration['FITTING_DIR']+Fits_Files['OPTIMIZED_CUBE'], opt_data,opt_hdr)
-
-        Configuration['OPTIMIZED'] = True
-        print_log(f'''OPTIMIZED_CUBE: Your input cube has {pix_per_beam} pixels along the minor FWHM.
-{"":8s}OPTIMIZED_CUBE: You requested { Configuration['OPT_PIXEL_BEAM']} therefore we regridded the cube into a new cube.
-{"":8s}OPTIMIZED_CUBE: We are using the pixel size of {required_cdelt}.
-''', Configuration['OUTPUTLOG'])
-
-    else:
-        print_log(f'''OPTIMIZED_CUBE: Your input cube has {pix_per_beam} pixels along the minor FWHM.
-{"":8s}OPTIMIZED_CUBE: You requested {Configuration['OPT_PIXEL_BEAM']} but we cannot improve the resolution.
-{"":8s}OPTIMIZED_CUBE: We are using the pixel size of the original cube.
-''', Configuration['OUTPUTLOG'])
-optimized_cube.__doc__ =f'''
+# Combine the statistics of several sets of values
+def merge_statistics(n,mean,m2, axis = -1):
+    n = np.array(n,dtype=float)
+    filled = n > 0
+    total_n = np.sum(n,axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total_mean = np.sum(np.where(filled,n*mean,0.),axis=axis)/total_n
+        deviation = np.where(filled,mean-np.expand_dims(total_mean,axis),0.)
+    total_m2 = np.sum(np.where(filled,m2+n*deviation**2,0.),axis=axis)
+    return total_n,total_mean,total_m2
+merge_statistics.__doc__ =f'''
  NAME:
-    optimized_cube
+    merge_statistics
 
  PURPOSE:
-    Check the amount of pixels that are in the minor axis FWHM,
-    if more than OPT_PIXELBEAM regrid the cube to less pixels
-    and write FAT_opt cube and set Configuration['OPTIMIZED'] = True
+    Combine the number of values, the mean and the sum of the squared deviations
+    from the mean of several sets of values into those of all values together.
 
  CATEGORY:
     fits_functions
 
  INPUTS:
-    Configuration = Standard FAT configuration
+    n = number of values in every set
+    mean = mean of every set
+    m2 = sum of the squared deviations from the mean of every set
+
+ OPTIONAL INPUTS:
+    axis = -1
+    the axis along which the sets are combined
+
+ OUTPUTS:
+    n, mean and m2 of the combined sets
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: This is the pairwise update of Chan et al. applied to all sets at once.
+       Unlike a sum of squares it does not lose precision for data with a large offset.
+       Empty sets are ignored.
+'''
+
+# Take a set of values out of combined statistics
+def remove_statistics(n,mean,m2,n_set,mean_set,m2_set):
+    n = np.array(n,dtype=float)
+    n_set = np.array(n_set,dtype=float)
+    remaining_n = n-n_set
+    filled = (n_set > 0) & (remaining_n > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        remaining_mean = np.where(filled,(n*mean-n_set*mean_set)/remaining_n,mean)
+        remaining_m2 = np.where(filled,m2-m2_set-remaining_n*n_set/n*(mean_set-remaining_mean)**2,m2)
+    # Removing everything leaves an empty set
+    empty = remaining_n <= 0
+    remaining_mean = np.where(empty,float('NaN'),remaining_mean)
+    # Rounding can not make a sum of squares negative
+    remaining_m2 = np.where(empty,0.,np.maximum(remaining_m2,0.))
+    return np.maximum(remaining_n,0.),remaining_mean,remaining_m2
+remove_statistics.__doc__ =f'''
+ NAME:
+    remove_statistics
+
+ PURPOSE:
+    Remove the number of values, the mean and the sum of the squared deviations
+    from the mean of one set from the combined statistics of several sets.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    n = number of values of the combined sets
+    mean = mean of the combined sets
+    m2 = sum of the squared deviations from the mean of the combined sets
+    n_set = number of values in the set to remove
+    mean_set = mean of the set to remove
+    m2_set = sum of the squared deviations from the mean of the set to remove
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    n, mean and m2 of the remaining sets
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: This is the pairwise update of Chan et al. of merge_statistics solved for one of the
+       two sets, such that cutting a channel does not require merging all kept channels again.
+       Removing an empty set leaves the statistics unchanged.
+'''
+
+# The standard deviation from the sum of the squared deviations from the mean
+def std_from_deviations(n,m2):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.array(m2,dtype=float)/np.array(n,dtype=float))
+    return std
+std_from_deviations.__doc__ =f'''
+ NAME:
+    std_from_deviations
+
+ PURPOSE:
+    Obtain the standard deviation of a set of values from the number of values
+    and the sum of their squared deviations from their mean.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    n = number of values
+    m2 = sum of the squared deviations from the mean
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the standard deviation, NaN when n = 0
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: The inputs can be numbers or arrays. The result is the same as np.nanstd.
+'''
+
+# Write the FAT cube channel slab by channel slab
+def write_fat_cube(filename,hdr,data, slab_size = 64., dtype = None):
+    if os.path.exists(filename):
+        raise OSError(f"File {filename} already exists.")
+    if dtype is None:
+        dtype = data.dtype
+    dtype = np.dtype(dtype)
+    hdr = copy.deepcopy(hdr)
+    hdr['NAXIS3'] = data.shape[0]
+    hdr['BITPIX'] = DTYPE2BITPIX[dtype.name]
+    stream = fits.StreamingHDU(filename,hdr)
+    channel_size = data.shape[1]*data.shape[2]*data.dtype.itemsize
+    channels_per_slab = int(max(1,slab_size*1024.**2/channel_size))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for start in range(0,data.shape[0],channels_per_slab):
+            slab = np.array(data[start:start+channels_per_slab,:,:],dtype=dtype)
+            slab[slab == 0.] = float('NaN')
+            slab[slab < -10*hdr['FATNOISE']] = float('NaN')
+            stream.write(slab)
+    stream.close()
+write_fat_cube.__doc__ =f'''
+ NAME:
+    write_fat_cube
+
+ PURPOSE:
+    Write the preprocessed cube to disk in slabs of channels such that it never
+    has to be in memory completely. Values that are exactly 0. or below
+    -10*FATNOISE are blanked while writing.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    filename = full path of the new FAT cube
+    hdr = the header prepared by prep_cube
+    data = the (memory mapped) data returned by prep_cube
+
+ OPTIONAL INPUTS:
+    slab_size = 64.
+    the maximum size of a slab of channels in Mb
+
+    dtype = None
+    data type of the written cube, None keeps the type of data
+
+ OUTPUTS:
+    The FAT cube on disk
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: An existing file is not overwritten.
+'''
+
+#Create an optimized cube if required
+def optimized_cube(Configuration,Fits_Files, debug = False):
+    pix_per_beam = Configuration['BEAM_IN_PIXELS'][1]
+    if pix_per_beam > Configuration['OPT_PIXEL_BEAM']:
+        cube = cached_fits(Configuration,Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'])
+        data = cube[0].data
+        hdr = cube[0].header
+        if f"{abs(hdr['CDELT1']):.16f}" != f"{abs(hdr['CDELT2']):.16f}":
+            print_log(f'''OPTIMIZED_CUBE: Your input cube does not have square pixels.
+{"":8s}OPTIMIZED_CUBE: FAT cannot optimize your cube.
+''', Configuration['OUTPUTLOG'])
+        required_cdelt = hdr['BMIN']/int(Configuration['OPT_PIXEL_BEAM'])
+        ratio = required_cdelt/abs(hdr['CDELT2'])
+        opt_data,opt_hdr = regrid_cube(data, hdr, ratio, dtype = working_dtype(Configuration,data.dtype))
+        cube.close()
+
+        fits.writeto(Configuration['FITTING_DIR']+Fits_Files['OPTIMIZED_CUBE'], opt_data,opt_hdr)
+
+        Configuration['OPTIMIZED'] = True
+        print_log(f'''OPTIMIZED_CUBE: Your input cube has {pix_per_beam} pixels along the minor FWHM.
+{"":8s}OPTIMIZED_CUBE: You requested { Configuration['OPT_PIXEL_BEAM']} therefore we regridded the cube into a new cube.
+{"":8s}OPTIMIZED_CUBE: We are using the pixel size of {required_cdelt}.
+''', Configuration['OUTPUTLOG'])
+
+    else:
+        print_log(f'''OPTIMIZED_CUBE: Your input cube has {pix_per_beam} pixels along the minor FWHM.
+{"":8s}OPTIMIZED_CUBE: You requested {Configuration['OPT_PIXEL_BEAM']} but we cannot improve the resolution.
+{"":8s}OPTIMIZED_CUBE: We are using the pixel size of the original cube.
+''', Configuration['OUTPUTLOG'])
+optimized_cube.__doc__ =f'''
+ NAME:
+    optimized_cube
+
+ PURPOSE:
+    Check the amount of pixels that are in the minor axis FWHM,
+    if more than OPT_PIXELBEAM regrid the cube to less pixels
+    and write FAT_opt cube and set Configuration['OPTIMIZED'] = True
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
     Fits_Files = Standard FAT dictionary with filenames
 
  OPTIONAL INPUTS:
@@ -653,9 +1332,153 @@ optimized_cube.__doc__ =f'''
  NOTE:
 '''
 
+# Add a channel to the sums needed for the moment maps
+def add_channel_to_moments(sums,channel,velocity):
+    if len(sums) == 0:
+        sums['FLUX'] = np.zeros(channel.shape,dtype=float)
+        sums['VELOCITY'] = np.zeros(channel.shape,dtype=float)
+    sums['FLUX'] += np.where(np.isnan(channel),0.,channel)
+    weighted_channel = channel.astype(float)*velocity
+    sums['VELOCITY'] += np.where(np.isnan(weighted_channel),0.,weighted_channel)
+add_channel_to_moments.__doc__ =f'''
+ NAME:
+    add_channel_to_moments
+
+ PURPOSE:
+    Add a masked channel to the running sums of the flux and the flux weighted velocity
+    from which the moment maps are made.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    sums = dictionary with the sums, empty for the first channel
+    channel = the masked channel
+    velocity = the velocity of the channel
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    sums is updated in place
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE: Blanks are ignored as in np.nansum. Both sums are accumulated in float64 whatever
+       the type of the channel, the maps are only cast to the working precision when written.
+'''
+
+# Set the units and make the 2D header and velocity axis for the moment maps
+def moment_headers(Configuration,header,vel_unit = None):
+    hdr = copy.deepcopy(header)
+    if vel_unit:
+        hdr['CUNIT3'] = vel_unit
+    try:
+        if hdr['CUNIT3'].lower().strip() == 'm/s':
+            print_log(f"We convert your m/s to km/s", Configuration['OUTPUTLOG'])
+            hdr['CUNIT3'] = 'km/s'
+            hdr['CDELT3'] = hdr['CDELT3']/1000.
+            hdr['CRVAL3'] = hdr['CRVAL3']/1000.
+        elif hdr['CUNIT3'].lower().strip() == 'km/s':
+            pass
+        else:
+            print_log(f"Your Velocity unit {hdr['CUNIT3']} is weird. Your units could be off", Configuration['OUTPUTLOG'])
+    except KeyError:
+        print_log(f"Your CUNIT3 is missing, that is bad practice. We'll add a blank one but we're not guessing the value", Configuration['OUTPUTLOG'])
+        hdr['CUNIT3'] = 'Unknown'
+    #Make a 2D header to use
+    hdr2D = copy.deepcopy(hdr)
+    hdr2D.remove('NAXIS3')
+    hdr2D['NAXIS'] = 2
+    # removing the third axis means we cannot correct for varying platescale, Sofia does so this is and issue so let's not do this
+    hdr2D.remove('CDELT3')
+    hdr2D.remove('CTYPE3')
+    hdr2D.remove('CUNIT3')
+    hdr2D.remove('CRPIX3')
+    hdr2D.remove('CRVAL3')
+    zaxis = hdr['CRVAL3'] + (np.arange(hdr['NAXIS3'])+1 \
+          - hdr['CRPIX3']) * hdr['CDELT3']
+    return hdr,hdr2D,zaxis
+moment_headers.__doc__ =f'''
+ NAME:
+    moment_headers
+
+ PURPOSE:
+    Make sure the velocity axis of a cube header is in km/s and
+    create the header for the moment maps and the velocity of every channel.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    header = the header of the cube
+
+ OPTIONAL INPUTS:
+    vel_unit= none
+    velocity unit of the input cube
+
+ OUTPUTS:
+    hdr = a copy of the cube header in km/s
+    hdr2D = the header for the moment maps
+    zaxis = the velocity of every channel
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+# Obtain a single masked channel of a cube
+def masked_channel(data,z,mask = None, level = None):
+    channel = np.array(data[z,:,:])
+    with np.errstate(invalid='ignore'):
+        if mask is not None:
+            channel[mask[z,:,:] < 0.5] = float('NaN')
+        elif level is not None:
+            channel[channel < level] = float('NaN')
+    return channel
+masked_channel.__doc__ =f'''
+ NAME:
+    masked_channel
+
+ PURPOSE:
+    Copy a single channel from a (memory mapped) cube and blank the pixels outside the mask
+    or, when no mask is given, below level.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    data = the cube data array
+    z = the channel to copy
+
+ OPTIONAL INPUTS:
+    mask = None
+    mask array of the same size as data, pixels with values < 0.5 are blanked
+
+    level = None
+    pixels below this value are blanked when no mask is given
+
+ OUTPUTS:
+    the masked channel
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
 def make_moments(Configuration,Fits_Files,fit_type = 'Undefined',
                  moments = [0,1,2],overwrite = False, level=None,
                   vel_unit= None, debug = False):
+    mask_cube = None
     if fit_type == 'Generic_Initialize':
         filename = f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}"
         basename = f"{Configuration['BASE_NAME']}"
@@ -667,79 +1490,32 @@ def make_moments(Configuration,Fits_Files,fit_type = 'Undefined',
         directory = f"{Configuration['FITTING_DIR']}/Finalmodel/"
         mask_cube = f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MASK']}"
     else:
-        filename = f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.fits"
-        basename = fit_type
+        # fit_type can be a sub directory, the files are named after the last directory
+        basename = fit_type.split('/')[-1]
+        filename = f"{Configuration['FITTING_DIR']}{fit_type}/{basename}.fits"
         directory = f"{Configuration['FITTING_DIR']}{fit_type}"
         if not level:
             mask_cube = f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MASK']}"
 
     cube = fits.open(filename)
-    if vel_unit:
-        cube[0].header['CUNIT3'] = vel_unit
+    # The channels are masked one at a time while the moments are accumulated
+    mask = None
     if mask_cube:
-        mask = fits.open(mask_cube)
-        with np.errstate(invalid='ignore', divide='ignore'):
-            cube[0].data[mask[0].data < 0.5] = float('NaN')
-        mask.close()
-    else:
-        if not level:
-            level = 3.*np.mean([np.nanstd(cube[0].data[0:2,:,:]),np.nanstd(cube[0].data[-3:-1,:,:])])
-        with np.errstate(invalid='ignore', divide='ignore'):
-            cube[0].data[cube[0].data < level] = float('NaN')
-    try:
-        if cube[0].header['CUNIT3'].lower().strip() == 'm/s':
-            print_log(f"We convert your m/s to km/s", Configuration['OUTPUTLOG'])
-            cube[0].header['CUNIT3'] = 'km/s'
-            cube[0].header['CDELT3'] = cube[0].header['CDELT3']/1000.
-            cube[0].header['CRVAL3'] = cube[0].header['CRVAL3']/1000.
-        elif cube[0].header['CUNIT3'].lower().strip() == 'km/s':
-            pass
-        else:
-            print_log(f"Your Velocity unit {cube[0].header['CUNIT3']} is weird. Your units could be off", Configuration['OUTPUTLOG'])
-    except KeyError:
-        print_log(f"Your CUNIT3 is missing, that is bad practice. We'll add a blank one but we're not guessing the value", Configuration['OUTPUTLOG'])
-        cube[0].header['CUNIT3'] = 'Unknown'
-    #Make a 2D header to use
-    hdr2D = copy.deepcopy(cube[0].header)
-    hdr2D.remove('NAXIS3')
-    hdr2D['NAXIS'] = 2
-    # removing the third axis means we cannot correct for varying platescale, Sofia does so this is and issue so let's not do this
-    hdr2D.remove('CDELT3')
-    hdr2D.remove('CTYPE3')
-    hdr2D.remove('CUNIT3')
-    hdr2D.remove('CRPIX3')
-    hdr2D.remove('CRVAL3')
-
-    # we need a moment 0 for the moment 2 as well
-    if 0 in moments:
-        hdr2D['BUNIT'] = f"{cube[0].header['BUNIT']}*{cube[0].header['CUNIT3']}"
-        moment0 = np.nansum(cube[0].data, axis=0) * cube[0].header['CDELT3']
-        moment0[np.invert(np.isfinite(moment0))] = float('NaN')
-        hdr2D['DATAMAX'] = np.nanmax(moment0)
-        hdr2D['DATAMIN'] = np.nanmin(moment0)
-        fits.writeto(f"{directory}/{basename}_mom0.fits",moment0,hdr2D,overwrite = overwrite)
-    if 1 in moments or 2 in moments:
-        zaxis = cube[0].header['CRVAL3'] + (np.arange(cube[0].header['NAXIS3'])+1 \
-              - cube[0].header['CRPIX3']) * cube[0].header['CDELT3']
-        c=np.transpose(np.resize(zaxis,[cube[0].header['NAXIS1'],cube[0].header['NAXIS2'],len(zaxis)]),(2,1,0))
-        hdr2D['BUNIT'] = f"{cube[0].header['CUNIT3']}"
-        # Remember Python is stupid so z,y,x
-        with np.errstate(invalid='ignore', divide='ignore'):
-            moment1 = np.nansum(cube[0].data*c, axis=0)/ np.nansum(cube[0].data, axis=0)
-        moment1[np.invert(np.isfinite(moment1))] = float('NaN')
-        hdr2D['DATAMAX'] = np.nanmax(moment1)
-        hdr2D['DATAMIN'] = np.nanmin(moment1)
-        if 1 in moments:
-            fits.writeto(f"{directory}/{basename}_mom1.fits",moment1,hdr2D,overwrite = overwrite)
-        if 2 in moments:
-            d = c - np.resize(moment1,[len(zaxis),cube[0].header['NAXIS2'],cube[0].header['NAXIS1']])
-            with np.errstate(invalid='ignore', divide='ignore'):
-                moment2 = np.sqrt(np.nansum(cube[0].data*d**2, axis=0)/ np.nansum(cube[0].data, axis=0))
-            moment2[np.invert(np.isfinite(moment1))] = float('NaN')
-            hdr2D['DATAMAX'] = np.nanmax(moment2)
-            hdr2D['DATAMIN'] = np.nanmin(moment2)
-            fits.writeto(f"{directory}/{basename}_mom2.fits",moment2,hdr2D,overwrite = overwrite)
+        # Memory mapped such that masked_channel only reads the channel it needs
+        mask_hdu = open_cube(mask_cube)
+        mask = mask_hdu[0].data
+    elif not level:
+        level = 3.*np.mean([np.nanstd(cube[0].data[0:2,:,:]),np.nanstd(cube[0].data[-3:-1,:,:])])
+    hdr,hdr2D,zaxis = moment_headers(Configuration,cube[0].header,vel_unit=vel_unit)
+    # Accumulate the sums over the channels such that we never need more than a channel in memory
+    sums = {}
+    for z in range(len(zaxis)):
+        add_channel_to_moments(sums,masked_channel(cube[0].data,z,mask = mask, level = level),zaxis[z])
+    write_moment_maps(Configuration,sums,cube[0].data,hdr,hdr2D,zaxis,directory,basename,\
+                      moments = moments,mask = mask, level = level,overwrite = overwrite)
     cube.close()
+    if mask_cube:
+        mask_hdu.close()
 
 make_moments.__doc__ =f'''
  NAME:
@@ -778,13 +1554,135 @@ make_moments.__doc__ =f'''
 
  OPTIONAL OUTPUTS:
 
+ PROCEDURES CALLED:
+    open_cube, moment_headers, masked_channel, add_channel_to_moments, write_moment_maps
+
+ NOTE:
+'''
+
+# The data type to use for a product given the requested working precision
+def working_dtype(Configuration,dtype, limits = None):
+    dtype = np.dtype(dtype)
+    if Configuration['WORKING_PRECISION'] != 'float32':
+        return dtype
+    if np.issubdtype(dtype,np.floating):
+        return np.dtype(np.float32)
+    if np.issubdtype(dtype,np.integer) and limits is not None:
+        for compact in [np.uint8,np.int16,np.int32]:
+            if np.iinfo(compact).min <= limits[0] and limits[1] <= np.iinfo(compact).max:
+                return np.dtype(compact)
+    return dtype
+working_dtype.__doc__ =f'''
+ NAME:
+    working_dtype
+
+ PURPOSE:
+    Determine the data type in which a cube, mask or map is kept and written.
+    With a working precision of float32 floating point data are float32 and
+    integer data (masks) the smallest integer type that holds the limits.
+    Otherwise the data type is not changed.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    dtype = the current data type
+
+ OPTIONAL INPUTS:
+    limits = None
+    [minimum, maximum] of integer data, without limits the type is not changed
+
+ OUTPUTS:
+    the numpy data type to use
+
+ OPTIONAL OUTPUTS:
+
  PROCEDURES CALLED:
     Unspecified
 
+ NOTE: Accumulators such as the sums for the moment maps are not affected.
+'''
+
+# Write the moment maps from the accumulated sums
+def write_moment_maps(Configuration,sums,data,hdr,hdr2D,zaxis,directory,basename,\
+                      moments = [0,1,2],mask = None, level = None,overwrite = False):
+    # we need a moment 0 for the moment 2 as well
+    if 0 in moments:
+        hdr2D['BUNIT'] = f"{hdr['BUNIT']}*{hdr['CUNIT3']}"
+        moment0 = (sums['FLUX'] * hdr['CDELT3']).astype(working_dtype(Configuration,data.dtype))
+        moment0[np.invert(np.isfinite(moment0))] = float('NaN')
+        hdr2D['DATAMAX'] = np.nanmax(moment0)
+        hdr2D['DATAMIN'] = np.nanmin(moment0)
+        fits.writeto(f"{directory}/{basename}_mom0.fits",moment0,hdr2D,overwrite = overwrite)
+    if 1 in moments or 2 in moments:
+        hdr2D['BUNIT'] = f"{hdr['CUNIT3']}"
+        # Remember Python is stupid so z,y,x
+        with np.errstate(invalid='ignore', divide='ignore'):
+            moment1 = sums['VELOCITY']/sums['FLUX']
+        moment1[np.invert(np.isfinite(moment1))] = float('NaN')
+        hdr2D['DATAMAX'] = np.nanmax(moment1)
+        hdr2D['DATAMIN'] = np.nanmin(moment1)
+        if 1 in moments:
+            fits.writeto(f"{directory}/{basename}_mom1.fits",moment1.astype(working_dtype(Configuration,moment1.dtype)),hdr2D,overwrite = overwrite)
+        if 2 in moments:
+            # The dispersion needs the final moment 1 so this is a second pass over the channels
+            dispersion_sum = np.zeros(moment1.shape,dtype=float)
+            for z in range(len(zaxis)):
+                channel = masked_channel(data,z,mask = mask, level = level)
+                weighted_channel = channel.astype(float)*(zaxis[z]-moment1)**2
+                dispersion_sum += np.where(np.isnan(weighted_channel),0.,weighted_channel)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                moment2 = np.sqrt(dispersion_sum/sums['FLUX'])
+            moment2[np.invert(np.isfinite(moment1))] = float('NaN')
+            hdr2D['DATAMAX'] = np.nanmax(moment2)
+            hdr2D['DATAMIN'] = np.nanmin(moment2)
+            fits.writeto(f"{directory}/{basename}_mom2.fits",moment2.astype(working_dtype(Configuration,moment2.dtype)),hdr2D,overwrite = overwrite)
+write_moment_maps.__doc__ =f'''
+ NAME:
+    write_moment_maps
+
+ PURPOSE:
+    Make the moment maps from the sums accumulated by add_channel_to_moments and write them to disk.
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    sums = the accumulated sums
+    data = the cube data array, needed for the moment 2
+    hdr = the cube header from moment_headers
+    hdr2D = the 2D header from moment_headers
+    zaxis = the velocity of every channel
+    directory = directory to write the maps to
+    basename = the maps are called basename_mom0.fits etc.
+
+ OPTIONAL INPUTS:
+    moments = [0,1,2]
+    moment maps to create
+
+    mask = None
+    the mask applied to the data
+
+    level = None
+    the cutoff level applied to the data when there is no mask
+
+    overwrite = False
+    overwrite existing maps
+
+ OUTPUTS:
+    The moment maps on disk
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    masked_channel
+
  NOTE:
 '''
 
-def regrid_cube(data,hdr,ratio):
+def regrid_cube(data,hdr,ratio, engine = 'separable', dtype = None, slab_size = 4.):
     regrid_hdr = copy.deepcopy(hdr)
     # First get the shape of the data
     shape = np.array(data.shape, dtype=float)
@@ -795,10 +1693,27 @@ def regrid_cube(data,hdr,ratio):
 
     #* np.ceil(shape / ratio).astype(int)
     new_shape[0] = shape[0]
-    # Create the zero-padded array and assign it with the old density
-    regrid_data = regridder(data,new_shape)
-    regrid_hdr['CRPIX1'] =   (regrid_hdr['CRPIX1']-1)/real_ratio[2]+1
-    regrid_hdr['CRPIX2'] =   (regrid_hdr['CRPIX2']-1)/real_ratio[1]+1
+    if dtype is None:
+        dtype = data.dtype
+    # the pixel in the old grid that corresponds to the first new pixel
+    offset = [0.,0.,0.]
+    if engine == 'map_coordinates':
+        # Create the zero-padded array and assign it with the old density
+        regrid_data = regridder(data,new_shape).astype(dtype,copy=False)
+    else:
+        # The spectral axis is not changed so we regrid the spatial axes a slab of channels at a time
+        new_shape = [int(x) for x in new_shape]
+        regrid_data = np.empty(new_shape,dtype=dtype)
+        channel_size = shape[1]*shape[2]*data.dtype.itemsize
+        channels_per_slab = int(max(1,slab_size*1024.**2/channel_size))
+        for start in range(0,new_shape[0],channels_per_slab):
+            slab = np.asarray(data[start:start+channels_per_slab])
+            # The number of valid pixels in the blocks of the first axis weighs them in the blocks of the second
+            slab,real_ratio[1],offset[1],count = regrid_axis(slab,1,new_shape[1])
+            slab,real_ratio[2],offset[2],count = regrid_axis(slab,2,new_shape[2],count = count)
+            regrid_data[start:start+slab.shape[0]] = slab
+    regrid_hdr['CRPIX1'] =   (regrid_hdr['CRPIX1']-1-offset[2])/real_ratio[2]+1
+    regrid_hdr['CRPIX2'] =   (regrid_hdr['CRPIX2']-1-offset[1])/real_ratio[1]+1
     wcs_found = False
     try:
         regrid_hdr['CDELT1'] =   regrid_hdr['CDELT1']*real_ratio[2]
@@ -840,6 +1755,16 @@ regrid_cube.__doc__ =f'''
     ratio = the requested ratio of old/new
 
  OPTIONAL INPUTS:
+    engine = 'separable'
+    separable regrids the spatial axes one after the other a slab of channels at a time,
+    by block averaging when the ratio is close to an integer and by linear interpolation otherwise.
+    map_coordinates interpolates the whole cube at once with regridder.
+
+    dtype = None
+    type of the regridded data, default the type of the input data
+
+    slab_size = 4.
+    The size in Mb of the slabs of channels that are regridded at once
 
  OUTPUTS:
     regriddata = regridded data array
@@ -848,11 +1773,104 @@ regrid_cube.__doc__ =f'''
  OPTIONAL OUTPUTS:
 
  PROCEDURES CALLED:
-    copy.deepcopy, regridder, np.array
+    copy.deepcopy, regridder, regrid_axis, np.array
 
  NOTE: This might not work well with extended projections.
 '''
 
+# Regrid a single axis of an array to a smaller size
+def regrid_axis(data,axis,new_size, tolerance = 0.05, count = None):
+    size = data.shape[axis]
+    ratio = size/new_size
+    factor = int(ratio)
+    if size < 2 or new_size == size:
+        return data,1.,0.,count
+    if np.issubdtype(data.dtype,np.floating):
+        float_type = data.dtype
+    else:
+        float_type = np.float64
+    if ratio-factor < tolerance:
+        # Close to an integer ratio we average blocks of factor pixels, the remaining pixels at the end are dropped
+        # The pixels in a block are added as strided slices which is much faster than reducing a short axis
+        blanked = count is not None or (np.issubdtype(data.dtype,np.floating) and np.isnan(data).any())
+        new_data = None
+        for i in range(factor):
+            index = [slice(None)]*data.ndim
+            index[axis] = slice(i,new_size*factor,factor)
+            index = tuple(index)
+            part = data[index]
+            if blanked:
+                # every value counts with the number of valid pixels it is the average of
+                weight = np.where(np.isnan(part),0,1 if count is None else count[index])
+                part = np.where(weight > 0,part*weight,0.)
+            if new_data is None:
+                new_data = np.array(part,dtype=float_type)
+                if blanked:
+                    new_count = np.array(weight,dtype=np.int32)
+            else:
+                new_data += part
+                if blanked:
+                    new_count += weight
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if blanked:
+                new_data /= new_count
+            else:
+                new_data /= factor
+                new_count = None
+        return new_data,float(factor),(factor-1)/2.,new_count
+    # Else we linearly interpolate at the same positions as regridder, blanks spread to their neighbours
+    coordinates = np.arange(new_size)*ratio
+    lower = np.minimum(np.floor(coordinates).astype(int),size-2)
+    weight_shape = [1]*data.ndim
+    weight_shape[axis] = new_size
+    weights = (coordinates-lower).reshape(weight_shape).astype(float_type)
+    new_data = np.take(data,lower,axis=axis).astype(float_type,copy=False)
+    difference = np.take(data,lower+1,axis=axis)-new_data
+    difference *= weights
+    new_data += difference
+    return new_data,ratio,0.,None
+regrid_axis.__doc__ =f'''
+ NAME:
+    regrid_axis
+
+ PURPOSE:
+    Regrid a single axis of an array to a smaller size with larger pixels
+
+ CATEGORY:
+    fits_functions
+
+ INPUTS:
+    data = the array to regrid
+    axis = the axis to regrid
+    new_size = the new number of pixels along the axis
+
+ OPTIONAL INPUTS:
+    tolerance = 0.05
+    When the ratio between the old and new size is less than this above an integer
+    blocks of pixels are averaged instead of interpolated.
+
+    count = None
+    the number of valid pixels that every value of data is the average of,
+    as returned by a previous call. None means every value is a single pixel.
+
+ OUTPUTS:
+    new_data = the regridded array
+    ratio = the size of the new pixels in old pixels
+    offset = the position of the first new pixel in the old pixels
+    count = the number of valid pixels in every averaged block,
+    None when there are no blanks or the axis was not averaged
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    np.take, np.isnan
+
+ NOTE:
+    Blocks that are completely blank remain blank, partially blanked blocks are the average of the valid pixels.
+    Passing the count of the first axis to the second gives the average of the valid pixels in the 2D block.
+'''
+
 def regridder(oldarray, newshape):
     oldshape = np.array(oldarray.shape)
     newshape = np.array(newshape, dtype=float)
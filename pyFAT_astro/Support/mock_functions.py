@@ -0,0 +1,597 @@
+# -*- coding: future_fstrings -*-
+# This module contains stand-ins for TiRiFiC and SoFiA2 that follow their input and output conventions
+# such that the python part of FAT can be run and timed without the real programs.
+
+class MockInputError(Exception):
+    pass
+
+from pyFAT_astro.Support.read_functions import tirific_template
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy import ndimage
+import numpy as np
+import copy
+import os
+import sys
+import time
+import warnings
+
+def mock_delay():
+    try:
+        delay = float(os.environ.get('PYFAT_MOCK_DELAY','0.'))
+    except ValueError:
+        delay = 0.
+    return np.max([delay,0.])
+
+mock_delay.__doc__ =f'''
+ NAME:
+    mock_delay
+
+ PURPOSE:
+    Read the delay of the mock programs from the environment.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    delay = the time in s that the mock tirific spends on every loop and the mock SoFiA on every run
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    The delay is set with the environment variable PYFAT_MOCK_DELAY, default 0.
+'''
+
+def mock_sofia(arguments):
+    if len(arguments) < 1:
+        raise MockInputError('MOCK_SOFIA: Please provide a SoFiA parameter file.')
+    parameters = read_sofia_parameters(arguments[0])
+    start = time.time()
+    cube = fits.open(parameters['input.data'])
+    data = np.array(cube[0].data,dtype=float)
+    header = cube[0].header
+    cube.close()
+    if parameters.get('output.filename','') != '':
+        basename = parameters['output.filename']
+    else:
+        basename = os.path.splitext(os.path.basename(parameters['input.data']))[0]
+    if parameters.get('output.directory','') != '':
+        basename = f"{parameters['output.directory']}/{basename}"
+    print(f"Mock SoFiA: searching {parameters['input.data']} for sources.")
+    threshold = float(parameters.get('scfind.threshold',5.))
+    kernels_xy = [int(x) for x in parameters.get('scfind.kernelsXY','0').split(',') if x.strip() != '']
+    kernels_z = [int(x) for x in parameters.get('scfind.kernelsZ','0').split(',') if x.strip() != '']
+    blanks = ~np.isfinite(data)
+    data[blanks] = 0.
+    mask = np.zeros(data.shape,dtype=bool)
+    # The smooth and clip finder, every combination of kernels is searched
+    for kernel_xy in kernels_xy:
+        for kernel_z in kernels_z:
+            smoothed = data
+            if kernel_xy > 0:
+                smoothed = ndimage.gaussian_filter(smoothed,[0.,kernel_xy/2.355,kernel_xy/2.355])
+            if kernel_z > 0:
+                smoothed = ndimage.uniform_filter1d(smoothed,kernel_z,axis=0)
+            noise = robust_noise(smoothed[~blanks])
+            if noise > 0.:
+                mask |= smoothed > threshold*noise
+    mask[blanks] = False
+    labels,no_labels = ndimage.label(mask,structure=np.ones((3,3,3)))
+    min_size_xy = int(parameters.get('linker.minSizeXY',1))
+    min_size_z = int(parameters.get('linker.minSizeZ',1))
+    sources = []
+    final_mask = np.zeros(data.shape,dtype=np.int32)
+    for i,source in enumerate(ndimage.find_objects(labels)):
+        size = [x.stop-x.start for x in source]
+        source_mask = labels[source] == i+1
+        if size[2] < min_size_xy or size[1] < min_size_xy or size[0] < min_size_z or \
+            np.sum(data[source][source_mask]) <= 0.:
+            continue
+        sources.append(source)
+        final_mask[source][source_mask] = len(sources)
+    delay = mock_delay()-(time.time()-start)
+    if delay > 0.:
+        time.sleep(delay)
+    if len(sources) == 0:
+        print(f"Mock SoFiA: no sources found above a threshold of {threshold}.")
+        # This is the exit code of SoFiA2 when no sources are found
+        sys.exit(8)
+    noise = robust_noise(data[~blanks])
+    catalogue = [sofia_parameters(data,final_mask,i+1,source,header,noise) for i,source in enumerate(sources)]
+    mask_header = copy.deepcopy(header)
+    mask_header['BUNIT'] = ' '
+    fits.writeto(f"{basename}_mask.fits",final_mask,mask_header,overwrite=True)
+    write_sofia_catalogue(f"{basename}_cat.txt",catalogue)
+    print(f"Mock SoFiA: found {len(sources)} sources.")
+
+mock_sofia.__doc__ =f'''
+ NAME:
+    mock_sofia
+
+ PURPOSE:
+    Stand-in for sofia2 that writes a mask and catalogue for the sources in a cube.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    arguments = the command line arguments, the first is the SoFiA parameter file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    basename_mask.fits and basename_cat.txt where basename follows output.directory and output.filename
+    exits with 8 when no source is found like SoFiA2
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    read_sofia_parameters, robust_noise, sofia_parameters, write_sofia_catalogue
+
+ NOTE:
+    Only the smooth and clip finder and the minimum source sizes of the linker are emulated.
+    There is no reliability filtering or mask dilation.
+'''
+
+def mock_tirific(arguments):
+    settings = {}
+    for argument in arguments:
+        if '=' in argument:
+            settings[argument.split('=')[0].strip().upper()] = argument.split('=')[1].strip()
+    if 'DEFFILE' not in settings:
+        raise MockInputError('MOCK_TIRIFIC: Please provide DEFFILE=yourfile.def.')
+    parent = os.getppid()
+    while True:
+        Template = tirific_template(filename = settings['DEFFILE'])
+        for key in settings:
+            if key not in ['DEFFILE','ACTION']:
+                Template[key] = settings[key]
+        run_mock_tirific(Template)
+        print('Finished', flush = True)
+        if Template.get('RESTARTNAME','').strip() == '':
+            break
+        # Like tirific we wait for the restart file to change and then read the def file again
+        restart_state = restart_file_state(Template['RESTARTNAME'])
+        while restart_file_state(Template['RESTARTNAME']) == restart_state:
+            if os.getppid() != parent:
+                return
+            time.sleep(0.05)
+
+mock_tirific.__doc__ =f'''
+ NAME:
+    mock_tirific
+
+ PURPOSE:
+    Stand-in for tirific that reads a def file and writes a model cube and def file.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    arguments = the command line arguments, DEFFILE=file.def is required, other KEY=value pairs overwrite the def file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    progress lines and Finished on stdout, the files set in OUTSET, TIRDEF and LOGNAME
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    restart_file_state, run_mock_tirific, tirific_template
+
+ NOTE:
+    When RESTARTNAME is set the mock keeps running and starts a new fit from DEFFILE whenever the restart file changes.
+    It stops when FAT is no longer running.
+'''
+
+def read_sofia_parameters(filename):
+    parameters = {}
+    with open(filename,'r') as file:
+        for line in file.readlines():
+            line = line.split('#')[0]
+            if '=' in line:
+                parameters[line.split('=')[0].strip()] = line.split('=',1)[1].strip()
+    if 'input.data' not in parameters:
+        raise MockInputError(f'MOCK_SOFIA: {filename} does not specify input.data.')
+    return parameters
+
+read_sofia_parameters.__doc__ =f'''
+ NAME:
+    read_sofia_parameters
+
+ PURPOSE:
+    Read a SoFiA2 parameter file.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    filename = name of the parameter file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    parameters = dictionary with the values as strings
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def restart_file_state(filename):
+    try:
+        status = os.stat(filename)
+    except OSError:
+        return None
+    return (status.st_size,status.st_mtime_ns)
+
+restart_file_state.__doc__ =f'''
+ NAME:
+    restart_file_state
+
+ PURPOSE:
+    Get the size and modification time of the restart file to detect changes.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    filename = name of the restart file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    (size, modification time) or None when the file does not exist
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def robust_noise(data):
+    negative = data[data < 0.]
+    if negative.size == 0:
+        return 0.
+    return 1.4826*np.median(np.abs(negative))
+
+robust_noise.__doc__ =f'''
+ NAME:
+    robust_noise
+
+ PURPOSE:
+    Determine the noise from the median absolute value of the negative pixels, like SoFiA's mad statistic on the negative flux range.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    data = the values to determine the noise from
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    noise = the noise, 0. when there are no negative values
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def run_mock_tirific(Template):
+    start = time.time()
+    loops = int(float(Template.get('LOOPS','0') or 0))
+    cube = fits.open(Template['INSET'])
+    header = cube[0].header
+    data = cube[0].data
+    model = tirific_model(Template,header)
+    try:
+        rms = float(Template['RMS'])
+    except (KeyError,ValueError):
+        rms = 0.
+    if rms <= 0.:
+        rms = robust_noise(data[np.isfinite(data)])
+    with np.errstate(invalid='ignore'):
+        chi_square = np.nansum((data-model)**2)/np.max([rms,1e-10])**2
+    cube.close()
+    restart_state = restart_file_state(Template.get('RESTARTNAME',''))
+    parameters = [x for x in ['XPOS','YPOS','VSYS','PA','INCL','VROT','SBR','SDIS','Z0'] if x in Template]
+    delay = mock_delay()
+    for loop in range(1,loops+1):
+        # The chi-square of a fit decreases towards the value of the final model
+        current_chi = chi_square*(1.+0.5**loop)
+        for i,parameter in enumerate(parameters):
+            print(f"L:{loop}/{loops} M:{i+1}/{len(parameters)} P:{parameter} I:1/1 C:{current_chi:.5E} S:{0.5**loop:.3E} T:{time.time()-start:.1f} N:1000/1000", flush = True)
+        if delay > 0.:
+            time.sleep(delay)
+        # A change of the restart file ends the current fit
+        if restart_state != restart_file_state(Template.get('RESTARTNAME','')):
+            break
+    if Template.get('OUTSET','').strip() != '':
+        output_header = copy.deepcopy(header)
+        output_header['BUNIT'] = 'Jy/beam'
+        fits.writeto(Template['OUTSET'],model.astype(np.float32),output_header,overwrite=True)
+    if Template.get('TIRDEF','').strip() != '':
+        with open(Template['TIRDEF'],'w') as file:
+            for key in Template:
+                # tirific does not write comments
+                if key[0:5] == 'EMPTY':
+                    file.write('\n')
+                elif key[0] != '#':
+                    file.write(f"{key}= {Template[key]} \n")
+    if Template.get('LOGNAME','').strip() != '':
+        with open(Template['LOGNAME'],'w') as file:
+            file.write(f"Mock tirific fitted {Template['INSET']} in {loops} loops, final chi-square {chi_square:.5E}\n")
+
+run_mock_tirific.__doc__ =f'''
+ NAME:
+    run_mock_tirific
+
+ PURPOSE:
+    Perform a single mock fit, i.e. report the progress and write the model and def file.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    Template = the def file as a dictionary
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    progress lines on stdout, the model in OUTSET, the def file in TIRDEF and a log in LOGNAME
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    mock_delay, restart_file_state, robust_noise, tirific_model
+
+ NOTE:
+    The parameters are returned unchanged. The progress lines follow the
+    layout of tirific such that FAT reads the loop, chi-square and point sources.
+'''
+
+def sofia_parameters(data,mask,label,source,header,noise):
+    source_mask = mask[source] == label
+    flux = np.where(source_mask,data[source],0.)
+    f_sum = np.sum(flux)
+    weights = np.clip(flux,0.,None)
+    z,y,x = np.indices(flux.shape,dtype=float)
+    z += source[0].start
+    y += source[1].start
+    x += source[2].start
+    centre = [np.sum(weights*x)/np.sum(weights),np.sum(weights*y)/np.sum(weights),np.sum(weights*z)/np.sum(weights)]
+    n_pix = np.sum(source_mask)
+    errors = [np.sqrt(np.sum(source_mask*(coordinate-value)**2)/np.max([n_pix-1,1]))*noise/np.max([np.max(weights),1e-10]) \
+                for coordinate,value in zip([x,y,z],centre)]
+    # The kinematical PA from the positions of the flux weighted centres of the channels
+    channel_flux = np.sum(weights,axis=(1,2))
+    channels = channel_flux > 0.
+    kin_pa = 0.
+    if np.sum(channels) > 1:
+        channel_x = np.sum(weights*x,axis=(1,2))[channels]/channel_flux[channels]
+        channel_y = np.sum(weights*y,axis=(1,2))[channels]/channel_flux[channels]
+        channel_z = z[:,0,0][channels]
+        slope_x = np.polyfit(channel_z,channel_x,1,w=np.sqrt(channel_flux[channels]))[0]
+        slope_y = np.polyfit(channel_z,channel_y,1,w=np.sqrt(channel_flux[channels]))[0]
+        # towards the receding side, east is -x for a standard RA axis
+        sign = np.sign(header.get('CDELT3',1.))
+        kin_pa = np.degrees(np.arctan2(-slope_x*sign,slope_y*sign)) % 360.
+    spectrum = np.sum(flux,axis=(1,2))
+    above = np.where(spectrum >= 0.5*np.max(spectrum))[0]
+    w50 = float(above[-1]-above[0]+1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        coordinates = WCS(header).wcs_pix2world([[centre[0],centre[1],centre[2]]+[0]*(header['NAXIS']-3)],0)[0]
+    return {'id': label, 'x': centre[0], 'y': centre[1], 'z': centre[2],
+            'x_min': source[2].start, 'x_max': source[2].stop-1,
+            'y_min': source[1].start, 'y_max': source[1].stop-1,
+            'z_min': source[0].start, 'z_max': source[0].stop-1,
+            'n_pix': n_pix, 'f_min': np.min(data[source][source_mask]), 'f_max': np.max(data[source][source_mask]),
+            'f_sum': f_sum, 'rms': noise, 'w50': w50, 'kin_pa': kin_pa,
+            'err_x': errors[0], 'err_y': errors[1], 'err_z': errors[2], 'err_f_sum': noise*np.sqrt(n_pix),
+            'ra': coordinates[0], 'dec': coordinates[1], 'v_app': coordinates[2]}
+
+sofia_parameters.__doc__ =f'''
+ NAME:
+    sofia_parameters
+
+ PURPOSE:
+    Measure the catalogue parameters of a single source in the mask.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    data = the cube
+    mask = the labelled mask
+    label = the label of the source
+    source = the slices of the bounding box of the source
+    header = the header of the cube
+    noise = the noise in the cube
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    dictionary with the parameters named as in the SoFiA2 catalogue
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Pixel positions are 0-based and widths are in channels as in SoFiA2.
+'''
+
+def template_values(Template,key,default,length = None):
+    try:
+        values = np.array(Template[key].split(),dtype=float)
+    except (KeyError,ValueError):
+        values = np.array([],dtype=float)
+    if values.size == 0:
+        values = np.array([default],dtype=float)
+    if length:
+        values = values[:length]
+        values = np.concatenate([values,np.full(length-len(values),values[-1])])
+    return values
+
+template_values.__doc__ =f'''
+ NAME:
+    template_values
+
+ PURPOSE:
+    Read the values of a parameter from a def file dictionary.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    Template = the def file as a dictionary
+    key = the parameter to read
+    default = the value to use when the parameter is not set
+
+ OPTIONAL INPUTS:
+    length = None
+    when set the values are cut or extended with the last value to this length
+
+ OUTPUTS:
+    values = numpy array with the values
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def tirific_model(Template,header):
+    radii = template_values(Template,'RADI',0.)
+    nur = int(float(Template.get('NUR',len(radii)) or len(radii)))
+    radii = radii[:nur]
+    vrot = template_values(Template,'VROT',0.,length=len(radii))
+    sbr = template_values(Template,'SBR',0.,length=len(radii))
+    inclination = np.radians(template_values(Template,'INCL',60.)[0])
+    pa = np.radians(template_values(Template,'PA',0.)[0])
+    vsys = template_values(Template,'VSYS',0.)[0]
+    dispersion = np.max([template_values(Template,'SDIS',8.)[0],1.])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        celestial = WCS(header).celestial
+        centre = celestial.wcs_world2pix([[template_values(Template,'XPOS',header['CRVAL1'])[0],\
+                                            template_values(Template,'YPOS',header['CRVAL2'])[0]]],0)[0]
+    y,x = np.indices((header['NAXIS2'],header['NAXIS1']),dtype=float)
+    east = (x-centre[0])*header['CDELT1']*3600.
+    north = (y-centre[1])*header['CDELT2']*3600.
+    major = east*np.sin(pa)+north*np.cos(pa)
+    minor = -east*np.cos(pa)+north*np.sin(pa)
+    radius = np.sqrt(major**2+(minor/np.max([np.cos(inclination),0.05]))**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_theta = np.where(radius > 0.,major/radius,0.)
+    velocity_field = vsys+np.interp(radius,radii,vrot)*cos_theta*np.sin(inclination)
+    intensity = np.interp(radius,radii,sbr,right=0.)
+    beam_area = np.pi*float(Template.get('BMAJ',header.get('BMAJ',0.)*3600.))*\
+                float(Template.get('BMIN',header.get('BMIN',0.)*3600.))/(4.*np.log(2.))
+    if beam_area > 0.:
+        intensity = intensity*beam_area
+    velocity_unit = str(header.get('CUNIT3','m/s')).strip().lower()
+    scale = 1. if velocity_unit == 'km/s' else 1000.
+    channels = (header['CRVAL3']+(np.arange(header['NAXIS3'])+1-header['CRPIX3'])*header['CDELT3'])/scale
+    model = np.zeros((header['NAXIS3'],header['NAXIS2'],header['NAXIS1']),dtype=float)
+    for i,velocity in enumerate(channels):
+        model[i] = intensity*np.exp(-0.5*((velocity-velocity_field)/dispersion)**2)/(np.sqrt(2.*np.pi)*dispersion)
+    # smooth with the beam
+    pixel_size = abs(header['CDELT2'])*3600.
+    bmaj = float(Template.get('BMAJ',0.) or 0.)
+    bmin = float(Template.get('BMIN',0.) or 0.)
+    if bmaj > 0. and bmin > 0.:
+        model = ndimage.gaussian_filter(model,[0.,bmaj/(2.355*pixel_size),bmin/(2.355*pixel_size)])
+    return model
+
+tirific_model.__doc__ =f'''
+ NAME:
+    tirific_model
+
+ PURPOSE:
+    Create a simple model cube of a flat rotating disc from a def file.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    Template = the def file as a dictionary
+    header = header of the input cube
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    model = model cube with the dimensions of the input cube
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Only the first disc and the central values of the orientation are used.
+    The beam is not rotated.
+'''
+
+def write_sofia_catalogue(filename,catalogue):
+    columns = ['id','x','y','z','x_min','x_max','y_min','y_max','z_min','z_max','n_pix','f_min','f_max','f_sum',\
+               'rms','w50','kin_pa','err_x','err_y','err_z','err_f_sum','ra','dec','v_app']
+    with open(filename,'w') as file:
+        file.write("# Mock SoFiA source catalogue\n#\n")
+        file.write('#'+''.join([f"{x:>18s}" for x in columns])+'\n')
+        for source in catalogue:
+            line = ' '
+            for column in columns:
+                if column in ['id','x_min','x_max','y_min','y_max','z_min','z_max','n_pix']:
+                    line += f"{int(source[column]):18d}"
+                else:
+                    line += f"{source[column]:18.6e}"
+            file.write(line+'\n')
+
+write_sofia_catalogue.__doc__ =f'''
+ NAME:
+    write_sofia_catalogue
+
+ PURPOSE:
+    Write the sources in the layout of the SoFiA2 ASCII catalogue.
+
+ CATEGORY:
+    mock_functions
+
+ INPUTS:
+    filename = name of the catalogue
+    catalogue = list of dictionaries with the source parameters
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The catalogue file, values are right aligned with their column names
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
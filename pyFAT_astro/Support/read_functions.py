@@ -2,9 +2,9 @@
 # This module contains a set of functions and classes that are used in FAT to read input files
 
 from pyFAT_astro.Support.support_functions import Proper_Dictionary,print_log,convertRADEC,set_limits, remove_inhomogeneities, \
-                                obtain_border_pix, get_inclination_pa,get_vel_pa,columndensity,get_profile, get_kinematical_center,\
+                                obtain_border_pix, obtain_ratios, get_inclination_pa,get_vel_pa,columndensity,get_profile, get_kinematical_center,\
                                 create_directory,copy_homemade_sofia,clean_header
-from pyFAT_astro.Support.fits_functions import check_mask,clean_header
+from pyFAT_astro.Support.fits_functions import check_mask,clean_header,cached_fits
 
 from astropy.io import fits
 from astropy.wcs import WCS
@@ -293,7 +293,7 @@ get_DHI.__doc__ =f'''
 '''
 
 def get_totflux(Configuration,map_name,debug=False):
-    image = fits.open(f"{Configuration['FITTING_DIR']}{map_name}")
+    image = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}{map_name}")
     flux = np.nansum(image[0].data)
     error = np.sqrt((np.where(image[0].data> 0.)[0].size)/Configuration['BEAM_IN_PIXELS'][2])*Configuration['NOISE']
     image.close()
@@ -332,17 +332,16 @@ def guess_orientation(Configuration,Fits_Files, v_sys = -1 ,center = None, debug
     if debug:
         print_log(f'''GUESS_ORIENTATION: starting extraction of initial parameters.
 ''',Configuration['OUTPUTLOG'], debug = True)
-    Image = fits.open(f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['MOMENT0']}",\
-            uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
-    map = Image[0].data
+    Image = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['MOMENT0']}")
+    # The cached map is read only and we blank the noisy pixels
+    map = np.array(Image[0].data)
     hdr = Image[0].header
-    mom0 = copy.deepcopy(Image)
+    mom0 = fits.HDUList([fits.PrimaryHDU(data=map,header=hdr)])
     Image.close()
 
     if not center:
         center = [hdr['NAXIS1']/2.-1,hdr['NAXIS2']/2.-1]
-    Image = fits.open(f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['CHANNEL_MAP']}",\
-            uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
+    Image = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['CHANNEL_MAP']}")
     noise_map = np.sqrt(Image[0].data)*Configuration['NOISE']*Configuration['CHANNEL_WIDTH']
 
     SNR = np.nanmean(map[noise_map > 0.]/noise_map[noise_map > 0.])
@@ -359,20 +358,24 @@ def guess_orientation(Configuration,Fits_Files, v_sys = -1 ,center = None, debug
 {'':8s} minimum {minimum_noise_in_map}
 ''',Configuration['OUTPUTLOG'])
     beam_check=[Configuration['BEAM_IN_PIXELS'][0],Configuration['BEAM_IN_PIXELS'][0]/2.]
-    inclination_av, pa_av, maj_extent_av = get_inclination_pa(Configuration, mom0, center, cutoff = scale_factor* median_noise_in_map, debug = debug)
-
-    inclination_av = [inclination_av]
+    centers = [center]
     int_weight = [2.]
-    pa_av = [pa_av]
-    maj_extent_av = [maj_extent_av]
     for mod in beam_check:
         for i in [[-1,-1],[-1,1],[1,-1],[1,1]]:
-            center_tmp = [center[0]+mod*i[0],center[1]+mod*i[1]]
-            inclination_tmp, pa_tmp, maj_extent_tmp= get_inclination_pa(Configuration, mom0, center_tmp, cutoff = scale_factor* median_noise_in_map, debug = debug)
-            inclination_av.append(inclination_tmp)
-            pa_av.append(pa_tmp)
+            centers.append([center[0]+mod*i[0],center[1]+mod*i[1]])
             int_weight.append(mod/beam_check[0]*0.25)
-            maj_extent_av.append(maj_extent_tmp)
+    # The profiles of the uncleaned map are the same for all centers so we extract them in one go
+    ratios, maj_extents = obtain_ratios(Configuration,mom0[0].data, centers, np.linspace(0, 360, 180),\
+                                        noise = scale_factor* median_noise_in_map,debug=debug)
+    inclination_av = []
+    pa_av = []
+    maj_extent_av = []
+    for i,center_tmp in enumerate(centers):
+        inclination_tmp, pa_tmp, maj_extent_tmp= get_inclination_pa(Configuration, mom0, center_tmp, cutoff = scale_factor* median_noise_in_map,\
+                                                        ratios = [ratios[i],float(maj_extents[i])], debug = debug)
+        inclination_av.append(inclination_tmp)
+        pa_av.append(pa_tmp)
+        maj_extent_av.append(maj_extent_tmp)
     int_weight = np.array(int_weight)
     weight = np.array([1./x[1] for x in inclination_av],dtype= float)*int_weight
     inclination = np.array([np.nansum(np.array([x[0] for x in inclination_av],dtype=float)*weight)/np.nansum(weight),\
@@ -460,8 +463,7 @@ def guess_orientation(Configuration,Fits_Files, v_sys = -1 ,center = None, debug
 
 
 
-    Image = fits.open(f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['MOMENT1']}",\
-            uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
+    Image = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['MOMENT1']}")
     map = copy.deepcopy(Image[0].data)
     hdr = Image[0].header
     if debug:
@@ -678,6 +680,54 @@ load_basicinfo.__doc__ =f'''
  NOTE:
 '''
 
+def load_journal(Configuration, debug = False):
+    entries = []
+    if not Configuration['JOURNAL'] or not os.path.exists(Configuration['JOURNAL']):
+        return entries
+    with open(Configuration['JOURNAL'],'r') as journal:
+        for line in journal.readlines():
+            if line[0] == '#':
+                continue
+            input = [x.strip() for x in line.split('|')]
+            if len(input) < 6:
+                continue
+            if input[1] == str(Configuration['ID_NR']) and input[2] == Configuration['SUB_DIR'] \
+                and input[5] == Configuration['CONFIG_HASH']:
+                entries.append([input[3],input[4]])
+    if debug:
+        print_log(f'''LOAD_JOURNAL: We found the following entries for this galaxy:
+{'':8s}{entries}
+''',Configuration['OUTPUTLOG'], debug = True)
+    return entries
+
+load_journal.__doc__ =f'''
+ NAME:
+    load_journal
+
+ PURPOSE:
+    Read the stages that the current galaxy reached in previous runs with the same settings from the journal.
+
+ CATEGORY:
+    read_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    entries = list of [stage, status] in the order they were written
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Entries written with a different configuration hash are ignored.
+'''
+
 #Function for loading the variables of a tirific def file into a set of variables to be used
 def load_template(Configuration,Template,Variables = ['BMIN','BMAJ','BPA','RMS','DISTANCE','NUR','RADI','VROT',
                  'Z0', 'SBR', 'INCL','PA','XPOS','YPOS','VSYS','SDIS','VROT_2',  'Z0_2','SBR_2',
@@ -751,9 +801,11 @@ def load_tirific(Configuration,filename,Variables = ['BMIN','BMAJ','BPA','RMS','
     Variables = np.array([e.upper() for e in Variables],dtype=str)
     numrings = []
     while len(numrings) < 1:
-        time.sleep(0.1)
         with open(filename, 'r') as tmp:
             numrings = [int(e.split('=')[1].strip()) for e in tmp.readlines() if e.split('=')[0].strip().upper() == 'NUR']
+        # Only wait when the file is still being written
+        if len(numrings) < 1:
+            time.sleep(0.1)
 
     outputarray=np.zeros((numrings[0],len(Variables)),dtype=float)
     with open(filename, 'r') as tmp:
@@ -819,6 +871,64 @@ load_tirific.__doc__ =f'''
  NOTE:
 '''
 
+def load_tirific_progress(Configuration,fit_type,stage = None, debug = False):
+    columns = ['TIME','STAGE','ITERATION','LOOP','MAX_LOOP','CHI_SQUARE','STEP','PARAMETER']
+    types = [float,str,int,int,int,float,float,str]
+    progress = {}
+    for column in columns:
+        progress[column] = []
+    try:
+        with open(f"{Configuration['LOG_DIRECTORY']}Tirific_Progress_{fit_type}.txt",'r') as file:
+            lines = file.readlines()
+    except FileNotFoundError:
+        lines = []
+    for line in lines:
+        if line[0] == '#':
+            continue
+        input = line.split()
+        if len(input) != len(columns) or (stage and input[1] != stage):
+            continue
+        for column,type,value in zip(columns,types,input):
+            progress[column].append(type(value))
+    for column,type in zip(columns,types):
+        progress[column] = np.array(progress[column],dtype = type)
+    if debug:
+        print_log(f'''LOAD_TIRIFIC_PROGRESS: We read {len(progress['TIME'])} progress lines for {fit_type}.
+''',Configuration['OUTPUTLOG'], debug = True)
+    return progress
+
+load_tirific_progress.__doc__ =f'''
+ NAME:
+    load_tirific_progress
+
+ PURPOSE:
+    Read the progress of the tirific runs of a fit type as written by run_tirific
+
+ CATEGORY:
+    read_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    fit_type = the fit type for which to read the progress
+
+ OPTIONAL INPUTS:
+    stage = None
+    only return the lines of this stage
+
+    debug = False
+
+ OUTPUTS:
+    progress = dictionary with arrays for TIME, STAGE, ITERATION, LOOP, MAX_LOOP, CHI_SQUARE, STEP and PARAMETER
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    TIME is in seconds since the epoch, every line is a model evaluation reported by tirific.
+'''
+
 def read_cube(Configuration,cube,debug=False):
     cube_hdr = fits.getheader(f"{Configuration['FITTING_DIR']}{cube}")
     Configuration['NOISE'] = cube_hdr['FATNOISE']
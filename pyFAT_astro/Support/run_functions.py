@@ -9,13 +9,21 @@ class InclinationRunError(Exception):
     pass
 class SofiaFaintError(Exception):
     pass
+class TirificTimeoutError(Exception):
+    pass
+class TirificOutputError(Exception):
+    pass
+class SofiaTimeoutError(Exception):
+    pass
 
 from pyFAT_astro.Support.support_functions import print_log, convert_type,set_limits,rename_fit_products,\
-                              set_ring_size,calc_rings,get_usage_statistics,get_inner_fix,convertskyangle,\
+                              set_ring_size,calc_rings,start_usage_sampler,get_inner_fix,convertskyangle,\
                               finish_current_run, remove_inhomogeneities,get_from_template,set_format, \
-                              set_rings, convertRADEC,sbr_limits, create_directory
+                              set_rings, convertRADEC,sbr_limits, create_directory,wait_for_output,\
+                              locked_append,usage_samplers,parse_tirific_progress,chi_square_plateau,\
+                              remaining_time,start_watchdog,stop_watchdog,kill_process_group
 from pyFAT_astro.Support.clean_functions import clean_before_sofia,clean_after_sofia
-from pyFAT_astro.Support.fits_functions import cut_cubes,extract_pv,make_moments
+from pyFAT_astro.Support.fits_functions import cut_cubes,extract_pv,make_moments,cached_fits,cube_nanmax
 from pyFAT_astro.Support.read_functions import load_template
 
 from pyFAT_astro.Support.modify_template import write_new_to_template,smooth_profile,set_cflux,fix_sbr, \
@@ -31,7 +39,9 @@ import os
 import sys
 import time
 import copy
+import signal
 import subprocess
+import concurrent.futures
 import numpy as np
 import traceback
 import warnings
@@ -149,30 +159,21 @@ def check_inclination(Configuration,Tirific_Template,Fits_Files, fit_type = 'Und
     # Let's make a directory to put things in
     tmp_stage = 'tmp_incl_check'
     create_directory(tmp_stage,f"{Configuration['FITTING_DIR']}")
-
-    other_run = [Configuration['TIRIFIC_RUNNING'],Configuration['TIRIFIC_PID']]
+    # Every inclination gets its own tirific, at most one per available core
+    parallel_runs = int(np.max([1,np.min([Configuration['NCPU'],len(incl_to_check)])]))
     try:
-        Configuration['TIRIFIC_RUNNING'] = False
         #and a copy of the tirific template
-        if debug:
-                print_log(f'''CHECK_INCLINATION: pytho is so stupif
-    {'':8s}PA = {Tirific_Template['PA']}
-    ''',Configuration['OUTPUTLOG'])
         Check_Template = copy.deepcopy(Tirific_Template)
         #write_new_to_template(Configuration, f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.def", Check_Template,debug = debug)
         Check_Template['LOOPS'] = '0'
         Check_Template['INIMODE'] = '0'
         Check_Template['INSET'] = f"{Fits_Files['FITTING_CUBE']}"
-        Check_Template['RESTARTNAME'] = f"{Configuration['LOG_DIRECTORY']}restart_{tmp_stage}.txt"
+        Check_Template['NCORES'] = f"{int(np.max([1,Configuration['NCPU']//parallel_runs]))}"
         #These are small galaxies make sure the VARINDX is not meesing things up
         Check_Template['VARINDX'] = ''
 
         out_keys = ['LOGNAME','OUTSET','TIRDEF']
         out_extensions = ['log','fits','def']
-        incl_run= 'Not Initialized'
-        for i,key in enumerate(out_keys):
-            Check_Template[key] = f"{tmp_stage}/{tmp_stage}.{out_extensions[i]}"
-
 
         vobs = [x*np.sin(np.radians(np.mean([float(y),float(z)]))) for x,y,z in \
                 zip(current[to_extract.index('VROT')][:],current[to_extract.index('INCL')][:],current[to_extract.index('INCL_2')][:])]
@@ -183,16 +184,17 @@ def check_inclination(Configuration,Tirific_Template,Fits_Files, fit_type = 'Und
     {'':8s}Vobs = {vobs}
     {'':8s}PA = {Check_Template['PA']}
     ''',Configuration['OUTPUTLOG'])
-        mom_chi = []
-        model_mom0 = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT0']}")
+        model_mom0 = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT0']}")
         #model_mom0 = remove_inhomogeneities(Configuration,model_mom0,inclination=float(current[1][0]), pa = float(current[2][0]), center = [current[3][0],current[4][0]],debug=debug)
-        chan_map = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['CHANNEL_MAP']}")
+        chan_map = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['CHANNEL_MAP']}")
         noisemap = np.sqrt(chan_map[0].data)*Configuration['NOISE']/np.nanmax(model_mom0[0].data)
         max_in_moment = np.nanmax(model_mom0[0].data)
         model_mom0[0].data = model_mom0[0].data
         #/max_in_moment
-        for incl in incl_to_check:
-            #print(f'We are doing this inclination {incl}')
+        candidates = []
+        for i,incl in enumerate(incl_to_check):
+            candidate = f"{tmp_stage}/Incl_{i}"
+            create_directory(candidate,f"{Configuration['FITTING_DIR']}")
             vrot = [x/np.sin(np.radians(inclination+incl)) for x in vobs]
             format = set_format('INCL')
             for key in ['INCL','INCL_2']:
@@ -200,35 +202,39 @@ def check_inclination(Configuration,Tirific_Template,Fits_Files, fit_type = 'Und
             format = set_format('VROT')
             for key in ['VROT','VROT_2']:
                 Check_Template[key]= f"{' '.join([f'{x:{format}}' for x in vrot])}"
-            wf.tirific(Configuration,Check_Template,name = f'{tmp_stage}_In.def',debug=True)
-            accepted,incl_run = run_tirific(Configuration,incl_run, stage = 'incl_check', fit_type=tmp_stage,debug=False)
-            make_moments(Configuration,Fits_Files,fit_type=tmp_stage,\
-                         moments = [0], \
-                         overwrite = True, vel_unit = 'm/s',debug=False)
-            #make_moments(filename = f"{Configuration['FITTING_DIR']}{tmp_stage}/{tmp_stage}.fits", basename = 'tmp_incl', directory = f"{Configuration['FITTING_DIR']}{tmp_stage}/",\
-            #             moments = [0],level = 3.*Configuration['NOISE'], \
-            #             overwrite = True, log= Configuration['OUTPUTLOG'], vel_unit = 'm/s',debug=debug)
-            incl_mom0 = fits.open(f"{Configuration['FITTING_DIR']}{tmp_stage}/{tmp_stage}_mom0.fits")
+            for j,key in enumerate(out_keys):
+                Check_Template[key] = f"{candidate}/Incl_{i}.{out_extensions[j]}"
+            Check_Template['RESTARTNAME'] = f"{Configuration['LOG_DIRECTORY']}restart_{tmp_stage}_{i}.txt"
+            with open(Check_Template['RESTARTNAME'],'w') as file:
+                file.write("Initialized a new run")
+            wf.tirific(Configuration,Check_Template,name = f'{candidate}_In.def',debug=False)
+            candidates.append(candidate)
+        if Configuration['TIMING']:
+            locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",f"# Started Tirific at stage = {tmp_stage}\n")
+        print_log(f'''CHECK_INCLINATION: Evaluating {len(candidates)} inclinations with {parallel_runs} tirific runs at a time.
+''',Configuration['OUTPUTLOG'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_runs) as executor:
+            candidate_mom0 = list(executor.map(lambda candidate: run_inclination_candidate(Configuration,\
+                                    Fits_Files,candidate,debug=debug),candidates))
+        if Configuration['TIMING']:
+            locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt","# Finished this run \n")
+        for i in range(len(candidates)):
+            os.remove(f"{Configuration['LOG_DIRECTORY']}restart_{tmp_stage}_{i}.txt")
+        mom_chi = []
+        for incl,mom0_file in zip(incl_to_check,candidate_mom0):
+            incl_mom0 = fits.open(mom0_file)
             if debug:
-                try:
-                    os.remove(f"{Configuration['FITTING_DIR']}{tmp_stage}/tmp_{incl:.1f}_mom0.fits")
-                except:
-                    pass
-                os.rename(f"{Configuration['FITTING_DIR']}{tmp_stage}/{tmp_stage}_mom0.fits",f"{Configuration['FITTING_DIR']}{tmp_stage}/tmp_{incl:.1f}_mom0.fits")
+                os.replace(mom0_file,f"{os.path.dirname(mom0_file)}/tmp_{incl:.1f}_mom0.fits")
             chi = np.nansum((model_mom0[0].data[noisemap > 0.]-incl_mom0[0].data[noisemap > 0.])**2/noisemap[noisemap > 0.]**2)
             mom_chi.append(abs(chi))
             incl_mom0.close()
         Check_Template = []
         chan_map.close()
         model_mom0.close()
-        finish_current_run(Configuration, incl_run)
+    except (TirificTimeoutError,TirificOutputError):
+        raise
     except:
-        finish_current_run(Configuration, incl_run)
-        Configuration['TIRIFIC_RUNNING'] = other_run[0]
-        Configuration['TIRIFIC_PID'] =  other_run[1]
         raise InclinationRunError('Something went wrong while estimating the inclination. This should not happen.')
-    Configuration['TIRIFIC_RUNNING'] = other_run[0]
-    Configuration['TIRIFIC_PID'] =  other_run[1]
     low= np.where(mom_chi == np.nanmin(mom_chi))[0]
     if low.size > 1:
         low = low[0]
@@ -333,7 +339,7 @@ def check_source(Configuration, Fits_Files, debug = False):
 ''',Configuration['OUTPUTLOG'])
     #Check whether the cube is very large, if so cut it down
 
-    new_box = cut_cubes(Configuration, Fits_Files, galaxy_box,debug=debug)
+    new_box,cut_products = cut_cubes(Configuration, Fits_Files, galaxy_box,debug=debug)
     #update our pixel values to match the new sizes
     for i in range(len(new_box)):
         shift = new_box[i,0]
@@ -344,8 +350,11 @@ def check_source(Configuration, Fits_Files, debug = False):
         elif i == 2:
             x -= shift; x_min -= shift; x_max -= shift
 
-    Cube = fits.open(Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'],uint = False, do_not_scale_image_data=True,ignore_blank = True, output_verify= 'ignore')
-    data = Cube[0].data
+    # The cut cube is already in memory, large uncut cubes are memory mapped
+    if Fits_Files['FITTING_CUBE'] in cut_products:
+        Cube = cut_products[Fits_Files['FITTING_CUBE']]
+    else:
+        Cube = cached_fits(Configuration,Configuration['FITTING_DIR']+Fits_Files['FITTING_CUBE'])
     header = Cube[0].header
 
     with warnings.catch_warnings():
@@ -410,7 +419,7 @@ def check_source(Configuration, Fits_Files, debug = False):
 #{"":8s}CHECK_SOURCE: x,y,z = {int(round(x))}, {int(round(y))}, {int(round(z))}.
 #{'':8s}CHECK_SOURCE: we will use a systemic velocity of {v_app}
 #''',Configuration['OUTPUTLOG'])
-    Central_Flux = np.mean(data[int(round(z-1)):int(round(z+1)),\
+    Central_Flux = np.mean(Cube[0].data[int(round(z-1)):int(round(z+1)),\
                                 int(round(y-Configuration['BEAM_IN_PIXELS'][0]/2.)):int(round(y+Configuration['BEAM_IN_PIXELS'][0]/2.)),\
                                 int(round(x-Configuration['BEAM_IN_PIXELS'][0]/2.)):int(round(x+Configuration['BEAM_IN_PIXELS'][0]/2.))])
     if debug:
@@ -426,7 +435,7 @@ def check_source(Configuration, Fits_Files, debug = False):
         Configuration['EXCLUDE_CENTRAL'] = False
 
     #Check that the source is bright enough
-    Max_SNR = np.nanmax(data)/Configuration['NOISE']
+    Max_SNR = cube_nanmax(Cube)/Configuration['NOISE']
     if Max_SNR < 2.5:
         log_statement = f'''CHECK_SOURCE: The maximum Signal to Noise in this cube is {Max_SNR} that is not enough for a fit.
 '''
@@ -495,11 +504,11 @@ def check_source(Configuration, Fits_Files, debug = False):
               Distance = Configuration['DISTANCE'] , DHI = [2*maj_extent*3600.,Configuration['BEAM'][0]*Configuration['RING_SIZE']],debug=debug)
 
 
-    # extract a PV-Diagram
+    # extract a PV-Diagram, from a memory mapped cube only the window is read
     if not os.path.exists(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Configuration['SOFIA_BASENAME']}_sofia_xv.fits"):
         PV =extract_pv(Configuration,Cube, pa[0], center=[ra,dec,v_app*1000.], convert = 1000.,
                        finalsize = [int(round(maj_extent/np.mean([abs(header['CDELT1']),abs(header['CDELT2'])])*1.25+header['NAXIS1']*0.2)),
-                                    int(round(z_max-z_min)+10.)],debug=debug)
+                                    int(round(z_max-z_min)+10.)],read_section = Cube.fileinfo(0) is not None,debug=debug)
         fits.writeto(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Configuration['BASE_NAME']}_sofia_xv.fits",PV[0].data,PV[0].header)
     Cube.close()
     Initial_Parameters = {}
@@ -883,6 +892,64 @@ one_step_converge.__doc__ =f'''
 
  NOTE: This routine sets the Configuration['ACCEPTED']
 '''
+def run_inclination_candidate(Configuration,Fits_Files,candidate,debug = False):
+    # The def file is written just before the run, output from before it belongs to a previous run
+    run_start = os.path.getmtime(f"{Configuration['FITTING_DIR']}{candidate}_In.def")
+    incl_run = subprocess.Popen([Configuration['TIRIFIC'],f"DEFFILE={candidate}_In.def","ACTION = 1"], stdout = subprocess.PIPE, \
+                                stderr = subprocess.DEVNULL,cwd=Configuration['FITTING_DIR'],universal_newlines = True,\
+                                start_new_session = True)
+    name = candidate.split('/')[-1]
+    allowed_time = remaining_time(Configuration,Configuration['TIRIFIC_TIMEOUT'])
+    watchdog = start_watchdog(incl_run,allowed_time)
+    try:
+        for tir_out_line in incl_run.stdout:
+            tmp = re.split(r"[/: ]+",tir_out_line.strip())
+            if tmp[0].strip() in ['Finished','Abort']:
+                break
+        if stop_watchdog(watchdog):
+            raise TirificTimeoutError(f"RUN_INCLINATION_CANDIDATE: Tirific did not finish {candidate} within {allowed_time:.0f} s.")
+        if not wait_for_output(Configuration,[f"{Configuration['FITTING_DIR']}{candidate}/{name}.fits"],newer_than = run_start,debug=debug):
+            raise TirificOutputError(f"RUN_INCLINATION_CANDIDATE: Tirific did not write the output of {candidate} within {Configuration['OUTPUT_TIMEOUT']} s.")
+    finally:
+        stop_watchdog(watchdog)
+        incl_run.stdout.close()
+        if incl_run.poll() is None:
+            kill_process_group(incl_run.pid)
+        incl_run.wait()
+    make_moments(Configuration,Fits_Files,fit_type=candidate,\
+                 moments = [0], \
+                 overwrite = True, vel_unit = 'm/s',debug=False)
+    return f"{Configuration['FITTING_DIR']}{candidate}/{name}_mom0.fits"
+run_inclination_candidate.__doc__ =f'''
+ NAME:
+    run_inclination_candidate
+
+ PURPOSE:
+    Run a single model of the inclination check in its own tirific and make its moment 0 map.
+
+ CATEGORY:
+    run_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    Fits_Files = Standard FAT dictionary with filenames
+    candidate = directory of the candidate relative to the fitting directory, its def file is candidate_In.def
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    name of the moment 0 map of the model
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    The tirific is always killed when it is done, these runs never restart.
+'''
+
 def run_tirific(Configuration, current_run, stage = 'initial',fit_type = 'Undefined', debug = False):
     if debug:
         print_log(f'''RUN_TIRIFIC: Starting a new run in stage {stage} and fit_type {fit_type}
@@ -902,63 +969,105 @@ def run_tirific(Configuration, current_run, stage = 'initial',fit_type = 'Undefi
         with open(f"{Configuration['LOG_DIRECTORY']}restart_{fit_type}.txt",'w') as file:
             file.write("Initialized a new run")
         current_run = subprocess.Popen([Configuration['TIRIFIC'],f"DEFFILE={fit_type}_In.def","ACTION = 1"], stdout = subprocess.PIPE, \
-                                    stderr = subprocess.PIPE,cwd=Configuration['FITTING_DIR'],universal_newlines = True)
+                                    stderr = subprocess.PIPE,cwd=Configuration['FITTING_DIR'],universal_newlines = True,\
+                                    start_new_session = True)
         Configuration['TIRIFIC_RUNNING'] = True
         Configuration['TIRIFIC_PID'] = current_run.pid
+    # The restart file is written at the start of every run, output from before it belongs to a previous run
+    run_start = os.path.getmtime(f"{Configuration['LOG_DIRECTORY']}restart_{fit_type}.txt")
     currentloop =1
     max_loop = 0
-    counter = 0
     if Configuration['TIMING']:
-        time.sleep(0.1)
-        with open(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",'a') as file:
-            file.write(f"# Started Tirific at stage = {fit_type}\n")
-            CPU,mem = get_usage_statistics(Configuration,current_run.pid)
-            file.write(f"{datetime.now()} CPU = {CPU} % Mem = {mem} Mb \n")
-    else:
-        time.sleep(0.1)
+        locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",f"# Started Tirific at stage = {fit_type}\n")
+        if Configuration['TIRIFIC_PID'] not in usage_samplers:
+            start_usage_sampler(Configuration,Configuration['TIRIFIC_PID'],debug=debug)
+    progress_file = f"{Configuration['LOG_DIRECTORY']}Tirific_Progress_{fit_type}.txt"
+    if not os.path.exists(progress_file):
+        with open(progress_file,'w') as file:
+            file.write(f"#{'TIME':>15s} {'STAGE':>16s} {'ITERATION':>9s} {'LOOP':>5s} {'MAX_LOOP':>8s} {'CHI_SQUARE':>14s} {'STEP':>12s} {'PARAMETER':>10s}\n")
+    progress_log = open(progress_file,'a')
+    allowed_time = remaining_time(Configuration,Configuration['TIRIFIC_TIMEOUT'])
+    watchdog = None
+    if isinstance(current_run,subprocess.Popen):
+        watchdog = start_watchdog(current_run,allowed_time)
+    # the last chi-square of every finished loop for the plateau stop
+    loop_chi = []
+    last_chi = float('NaN')
+    plateau_stop = False
     print(f"\r{'':8s}RUN_TIRIFIC: 0 % Completed", end =" ",flush = True)
     triggered = False
-    for tir_out_line in current_run.stdout:
-        tmp = re.split(r"[/: ]+",tir_out_line.strip())
-        counter += 1
-        if (counter % 50) == 0:
-            if Configuration['TIMING']:
-                with open(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",'a') as file:
-                    if tmp[0] == 'L' and not triggered:
-                        if tmp[1] == '1':
-                            file.write("# Started the actual fitting \n")
-                            triggered = True
-                    CPU,mem = get_usage_statistics(Configuration,current_run.pid)
-                    file.write(f"{datetime.now()} CPU = {CPU} % Mem = {mem} Mb \n")
-        if tmp[0] == 'L':
-            if int(tmp[1]) != currentloop:
-                print(f"\r{'':8s}RUN_TIRIFIC: {float(tmp[1])/float(max_loop)*100.:.1f} % Completed", end =" ",flush = True)
-            currentloop  = int(tmp[1])
-            if max_loop == 0:
-                max_loop = int(tmp[2])
-            try:
-                Configuration['NO_POINTSOURCES'] = np.array([tmp[18],tmp[19]],dtype=float)
-            except:
-                #If this fails for some reason an old number suffices, if the code really crashed problems will occur elsewhere.
-                pass
-        if tmp[0].strip() == 'Finished':
-            break
-        if tmp[0].strip() == 'Abort':
-            break
+    try:
+        for tir_out_line in current_run.stdout:
+            tmp = re.split(r"[/: ]+",tir_out_line.strip())
+            progress = parse_tirific_progress(tir_out_line)
+            if progress:
+                progress_log.write(f"{time.time():16.3f} {stage:>16s} {Configuration['ITERATIONS']:9d} {progress['LOOP']:5d} {progress['MAX_LOOP']:8d} {progress['CHI_SQUARE']:14.7e} {progress['STEP']:12.5e} {progress['PARAMETER']:>10s}\n")
+            if Configuration['TIMING'] and not triggered:
+                if tmp[0] == 'L' and tmp[1] == '1':
+                    locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt","# Started the actual fitting \n")
+                    triggered = True
+            if progress:
+                if max_loop == 0:
+                    max_loop = progress['MAX_LOOP']
+                if progress['LOOP'] != currentloop:
+                    print(f"\r{'':8s}RUN_TIRIFIC: {float(progress['LOOP'])/float(max_loop)*100.:.1f} % Completed", end =" ",flush = True)
+                    if not np.isnan(last_chi):
+                        loop_chi.append(last_chi)
+                    if Configuration['PLATEAU_LOOPS'] > 0 and \
+                        chi_square_plateau(loop_chi,Configuration['PLATEAU_LOOPS'],Configuration['PLATEAU_TOLERANCE']):
+                        print_log(f'''RUN_TIRIFIC: The chi-square improved less than {Configuration['PLATEAU_TOLERANCE']} in the last {Configuration['PLATEAU_LOOPS']} loops, stopping tirific at loop {progress['LOOP']}.
+''',Configuration['OUTPUTLOG'])
+                        plateau_stop = True
+                        break
+                currentloop  = progress['LOOP']
+                if not np.isnan(progress['CHI_SQUARE']):
+                    last_chi = progress['CHI_SQUARE']
+                try:
+                    Configuration['NO_POINTSOURCES'] = np.array([tmp[18],tmp[19]],dtype=float)
+                except:
+                    #If this fails for some reason an old number suffices, if the code really crashed problems will occur elsewhere.
+                    pass
+            if tmp[0].strip() == 'Finished':
+                break
+            if tmp[0].strip() == 'Abort':
+                break
+    finally:
+        # Make sure the watchdog can not kill a reused process group and the log is closed when the parsing fails
+        fired = stop_watchdog(watchdog)
+        progress_log.close()
     print(f'\n')
+    if plateau_stop and not fired:
+        # Let tirific end itself such that it can write what it has, the next run starts a new tirific from the def file
+        try:
+            kill_process_group(Configuration['TIRIFIC_PID'],sig = signal.SIGTERM)
+            current_run.wait(timeout = 10.)
+        except (ProcessLookupError,subprocess.TimeoutExpired):
+            pass
+        finish_current_run(Configuration,current_run,debug=debug)
+        # The stopped tirific can not write anything anymore so we do not wait long
+        if not wait_for_output(Configuration,[f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.fits",\
+                    f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.def"],timeout = 2.,newer_than = run_start,debug=debug):
+            print_log(f'''RUN_TIRIFIC: The stopped tirific did not write the output of {fit_type}.
+{'':8s}We switch off the plateau stop for this galaxy and run {fit_type} again with all its loops.
+''',Configuration['OUTPUTLOG'],screen=True)
+            Configuration['PLATEAU_LOOPS'] = 0
+            # The output of the previous run was moved at the start so anything left is an incomplete part of this run
+            for filetype in ['fits','def']:
+                if os.path.exists(f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.{filetype}"):
+                    os.remove(f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.{filetype}")
+            return run_tirific(Configuration,current_run,stage = stage,fit_type = fit_type,debug = debug)
+    if fired:
+        finish_current_run(Configuration,current_run,debug=debug)
+        print_log(f'''RUN_TIRIFIC: Tirific did not finish the stage {stage} within {allowed_time:.0f} s and was killed.
+''',Configuration['OUTPUTLOG'],screen=True)
+        raise TirificTimeoutError(f"RUN_TIRIFIC: Tirific did not finish {fit_type} in the {stage} stage within {allowed_time:.0f} s.")
     if Configuration['TIMING']:
-        with open(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",'a') as file:
-            file.write("# Finished this run \n")
-            CPU,mem = get_usage_statistics(Configuration,current_run.pid)
-            file.write(f"{datetime.now()} CPU = {CPU} % Mem = {mem} Gb\n")
+        locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt","# Finished this run \n")
     print(f"{'':8s}RUN_TIRIFIC: Finished the current tirific run.")
-    #The break off goes faster sometimes than the writing of the file so let's make sure it is present
-    time.sleep(1.0)
-    wait_counter = 0
-    while not os.path.exists(f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.fits") and wait_counter < 1000.:
-        print(f"\r Waiting ", end = "", flush = True)
-        time.sleep(0.5)
-        wait_counter += 1
+    #The break off goes faster sometimes than the writing of the file so let's make sure it is complete
+    if not wait_for_output(Configuration,[f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.fits",\
+                    f"{Configuration['FITTING_DIR']}{fit_type}/{fit_type}.def"],newer_than = run_start,debug=debug):
+        raise TirificOutputError(f"RUN_TIRIFIC: Tirific did not write the output of {fit_type} in the {stage} stage within {Configuration['OUTPUT_TIMEOUT']} s.")
 
     if currentloop != max_loop:
         return 1,current_run
@@ -988,6 +1097,8 @@ run_tirific.__doc__ =f'''
     stage of the fitting process
 
  OUTPUTS:
+    accepted = 1 when tirific finished before its maximum number of loops, else 0
+    current_run = subprocess structure of tirific
 
  OPTIONAL OUTPUTS:
 
@@ -995,6 +1106,11 @@ run_tirific.__doc__ =f'''
     Unspecified
 
  NOTE:
+    When advanced.plateau_loops is set the chi-square of every loop is tracked. When it stopped
+    improving tirific is sent a SIGTERM and the def and fits file it wrote are used. A stopped run
+    ends before its maximum number of loops and is therefore accepted like any run that tirific
+    ended early. If the stopped tirific did not write its output the plateau stop is switched off
+    for the galaxy and the run is repeated in full.
 '''
 
 def sofia(Configuration, Fits_Files, debug = False):
@@ -1028,8 +1144,18 @@ def sofia(Configuration, Fits_Files, debug = False):
         wf.sofia(sofia_template,'sofia_input.par')
         print_log("RUN_SOFIA: Running SoFiA. \n",Configuration['OUTPUTLOG'],screen = True)
         # Check which sofia to start
-        sfrun = subprocess.Popen([Configuration['SOFIA2'],'sofia_input.par'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-        sofia_run, sofia_warnings_are_annoying = sfrun.communicate()
+        sfrun = subprocess.Popen([Configuration['SOFIA2'],'sofia_input.par'], stdout = subprocess.PIPE, stderr = subprocess.PIPE,\
+                                 start_new_session = True)
+        allowed_time = remaining_time(Configuration,Configuration['SOFIA_TIMEOUT'])
+        try:
+            sofia_run, sofia_warnings_are_annoying = sfrun.communicate(timeout = allowed_time if allowed_time >= 0. else None)
+        except subprocess.TimeoutExpired:
+            kill_process_group(sfrun.pid)
+            sfrun.communicate()
+            os.chdir(Configuration['START_DIRECTORY'])
+            print_log(f'''RUN_SOFIA: SoFiA did not finish within {allowed_time:.0f} s and was killed.
+''',Configuration['OUTPUTLOG'],screen=True)
+            raise SofiaTimeoutError(f"RUN_SOFIA: SoFiA did not finish within {allowed_time:.0f} s.")
         print_log(sofia_run.decode("utf-8"), Configuration['OUTPUTLOG'])
 
         if sfrun.returncode == 8:
@@ -24,9 +24,18 @@ import time
 import traceback
 import numpy as np
 import copy
+import fcntl
+import hashlib
 import warnings
 import re
 import subprocess
+import socket
+import threading
+from datetime import datetime
+# The running usage samplers and the previous usage sample for every sampled process id
+usage_samplers = {}
+usage_previous_sample = {}
+
 class SupportRunError(Exception):
     pass
 class SmallSourceError(Exception):
@@ -80,6 +89,66 @@ Proper_Dictionary.__doc__=f'''
 A class of ordered dictionary where keys can be inserted in at specified locations or at the end.
 '''
 
+# Obtain the minimum over azimuth at every radius from a polar resampling of the map
+def azimuthal_minimum(Configuration,map,center, debug = False):
+    x,y = float(center[0]),float(center[1])
+    # the radii have to reach the corners of the map
+    corners_x = np.array([0.,map.shape[1]-1.,0.,map.shape[1]-1.])-x
+    corners_y = np.array([0.,0.,map.shape[0]-1.,map.shape[0]-1.])-y
+    max_radius = np.max(np.sqrt(corners_x**2+corners_y**2))
+    radii = np.arange(0.,max_radius+1.,0.5)
+    # at least a sample per pixel along the outer circle
+    n_azimuth = max(72,int(np.ceil(2.*np.pi*max_radius)))
+    azimuth = np.linspace(0.,2.*np.pi,n_azimuth,endpoint=False)
+    polar_y = y+radii[:,np.newaxis]*np.sin(azimuth)[np.newaxis,:]
+    polar_x = x+radii[:,np.newaxis]*np.cos(azimuth)[np.newaxis,:]
+    # Outside the map the values are 0. as in the padded rotations
+    polar_map = ndimage.map_coordinates(map,np.stack((polar_y,polar_x)),order=1,mode='constant',cval=0.)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        radial_minimum = np.nanmin(polar_map,axis=1)
+    if debug:
+        print_log(f'''AZIMUTHAL_MINIMUM: We sampled {radii.size} radii at {n_azimuth} azimuths around {center}.
+''',Configuration['OUTPUTLOG'])
+    pixel_y,pixel_x = np.indices(map.shape,dtype=float)
+    pixel_radius = np.sqrt((pixel_x-x)**2+(pixel_y-y)**2)
+    minimum_radial_map = np.interp(pixel_radius,radii,radial_minimum)
+    minimum_map = copy.deepcopy(map)
+    minimum_map[minimum_radial_map < minimum_map] = minimum_radial_map[minimum_radial_map < minimum_map]
+    return minimum_map
+
+azimuthal_minimum.__doc__ =f'''
+ NAME:
+    azimuthal_minimum
+
+ PURPOSE:
+    Replace every pixel in a map with the minimum value found along the circle through that pixel around the center.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    map = the 2D array, normally the deprojected moment 0 map
+    center = [x,y] the center of the circles in pixels
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    minimum_map = the map with the minimum along every circle
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    ndimage.map_coordinates, np.nanmin, np.interp
+
+ NOTE:
+    The map is resampled once onto a polar grid with half pixel radial steps and at least a sample per pixel
+    along the outer circle. The minimum along azimuth is mapped back by interpolating in radius.
+    Pixels are never raised above their original value.
+'''
+
 def calc_rings(Configuration,size_in_beams = 0., ring_size  = 0.,debug=False):
     if ring_size == 0.:
         ring_size = Configuration['RING_SIZE']
@@ -174,6 +243,120 @@ check_sofia.__doc__ =f'''
 
  NOTE:
 '''
+
+def chi_square_plateau(loop_chi,loops,tolerance):
+    if loops < 1 or len(loop_chi) < loops+1:
+        return False
+    chi = np.array(loop_chi[-(loops+1):],dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        improvement = (chi[:-1]-chi[1:])/chi[:-1]
+    return bool(np.all(improvement < tolerance))
+
+chi_square_plateau.__doc__ =f'''
+ NAME:
+    chi_square_plateau
+
+ PURPOSE:
+    Check whether the chi-square of a tirific run stopped improving.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    loop_chi = the chi-square at the end of every finished loop
+    loops = the number of loops the improvement has to stay below the tolerance
+    tolerance = the relative improvement per loop below which the chi-square is flat
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    True when each of the last loops improved the chi-square by less than the tolerance
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    An increasing chi-square counts as no improvement.
+'''
+
+def claim_galaxy(Configuration,galaxy_key,debug=False):
+    queue_file = f"{Configuration['MAIN_DIRECTORY']}FAT_Queue/{galaxy_key}"
+    if os.path.exists(f"{queue_file}.done"):
+        return None
+    claimed = False
+    while not claimed:
+        try:
+            claim = os.open(f"{queue_file}.claim", os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(claim,f"{socket.gethostname()} {os.getpid()} {time.time()}\n".encode('utf-8'))
+            os.close(claim)
+            claimed = True
+        except FileExistsError:
+            stale_claim = read_claim(f"{queue_file}.claim")
+            if stale_claim is None:
+                # The claim was just released or reclaimed, try again
+                continue
+            if time.time()-stale_claim[1] < Configuration['QUEUE_TIMEOUT']:
+                return None
+            # The worker holding the claim is dead. Only the process holding the takeover token
+            # may replace the claim and it has to be the claim we judged stale, another process
+            # may have replaced it with a living claim since we looked.
+            if not take_token(f"{queue_file}.takeover",Configuration['QUEUE_TIMEOUT']):
+                return None
+            try:
+                if read_claim(f"{queue_file}.claim") != stale_claim:
+                    return None
+                os.remove(f"{queue_file}.claim")
+            finally:
+                os.remove(f"{queue_file}.takeover")
+            print_log(f'''CLAIM_GALAXY: The claim on {galaxy_key} has not been renewed for {time.time()-stale_claim[1]:.1f} s. We reclaim it.
+''',None,screen=True)
+    if os.path.exists(f"{queue_file}.done"):
+        # The previous worker finished in between our checks
+        os.remove(f"{queue_file}.claim")
+        return None
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(target=queue_heartbeat,args=(f"{queue_file}.claim",stop_heartbeat,Configuration['QUEUE_HEARTBEAT']),daemon=True)
+    heartbeat.start()
+    return [queue_file,stop_heartbeat,heartbeat]
+
+claim_galaxy.__doc__ =f'''
+ NAME:
+    claim_galaxy
+
+ PURPOSE:
+    Claim a galaxy in the work queue on the shared file system such that several
+    pyFAT processes, possibly on different nodes, can fit the same catalogue.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    galaxy_key = unique name of the galaxy in the queue
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    claim = [queue file base, stop event of the heartbeat, heartbeat thread] or None when
+            the galaxy is done or claimed by a living worker
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    os.open, read_claim, take_token, threading.Thread
+
+ NOTE:
+    A claim is a lock file created with O_EXCL in MAIN_DIRECTORY/FAT_Queue.
+    Its modification time is renewed every QUEUE_HEARTBEAT seconds and a claim
+    that is not renewed for QUEUE_TIMEOUT seconds is considered to belong to a dead worker.
+    A stale claim is only removed by the process holding the takeover token of the galaxy
+    and only when the claim is still the one that was judged stale. The new claim is then
+    created with O_EXCL like any other.
+'''
+
 # clean the header
 def clean_header(Configuration,hdr_in,two_dim=False,mask_file=False, debug = False):
     hdr = copy.deepcopy(hdr_in)
@@ -816,17 +999,34 @@ create_directory.__doc__ =f'''
  NOTE:
 '''
 
-def deproject(Configuration,map,angle, center = 0., invert = False,debug=False):
+def deproject(Configuration,map,angle, center = 0., invert = False, in_place = True,debug=False):
     axis = np.array(range(len(map[:,0])),dtype=float)-center
     if invert:
         newaxis = axis/np.cos(np.radians(angle))
     else:
         newaxis = axis*np.cos(np.radians(angle))
-    for x in range(len(map[0,:])):
-        profile = copy.deepcopy(map[:,x])
-        new_profile = np.interp(np.array(newaxis,dtype=float),np.array(axis,dtype=float),np.array(profile,dtype=float))
-        map[:,x] = new_profile
-    return map
+    if axis.size < 2:
+        return map if in_place else copy.deepcopy(map)
+    # The new axis is the same for every column so the interpolation indices and weights are computed once
+    # and the whole map is interpolated in one go, exactly as np.interp would per column
+    lower = np.clip(np.searchsorted(axis,newaxis,side='right')-1,0,axis.size-2)
+    profiles = np.asarray(map,dtype=float)
+    lower_profiles = profiles[lower,:]
+    new_map = profiles[lower+1,:]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        new_map -= lower_profiles
+        new_map /= (axis[lower+1]-axis[lower])[:,np.newaxis]
+        new_map *= (newaxis-axis[lower])[:,np.newaxis]
+        new_map += lower_profiles
+    on_pixel = newaxis == axis[lower]
+    new_map[on_pixel,:] = profiles[lower[on_pixel],:]
+    new_map[newaxis <= axis[0],:] = profiles[0,:]
+    new_map[newaxis >= axis[-1],:] = profiles[-1,:]
+    if in_place:
+        map[:] = new_map
+        return map
+    return new_map.astype(map.dtype,copy=False)
 
 deproject.__doc__ =f'''
  NAME:
@@ -852,27 +1052,32 @@ deproject.__doc__ =f'''
     invert = False
     If true the image is inclined by tangle instead of deprojected
 
+    in_place = True
+    If true the input map is overwritten with the deprojected map, else a new map is returned
+
  OUTPUTS:
     the deprojected map
 
  OPTIONAL OUTPUTS:
 
  PROCEDURES CALLED:
-    Unspecified
+    np.searchsorted
 
  NOTE:
+    The columns are linearly interpolated along the y-axis all at once, the result is the same as np.interp per column.
 '''
 
 def finish_current_run(Configuration,current_run,debug=False):
     print_log(f"FINISH_CURRENT_RUN: Is Tirific Running? {Configuration['TIRIFIC_RUNNING']}. \n",Configuration['OUTPUTLOG'],debug=debug)
     if Configuration['TIRIFIC_RUNNING']:
+        stop_usage_sampler(Configuration['TIRIFIC_PID'])
         try:
             current_run.stdout.close()
             current_run.stderr.close()
         except:
             pass
         try:
-            os.kill(Configuration['TIRIFIC_PID'], signal.SIGKILL)
+            kill_process_group(Configuration['TIRIFIC_PID'])
             print_log(f"FINISH_CURRENT_RUN: We killed PID = {Configuration['TIRIFIC_PID']}. \n",Configuration['OUTPUTLOG'])
         except:
             try:
@@ -913,6 +1118,55 @@ finish_current_run.__doc__ =f'''
  NOTE:
 '''
 
+def fits_file_size(filename):
+    # Read the primary header block by block until the END card
+    header_blocks = 0
+    cards = {}
+    with open(filename,'rb') as file:
+        while True:
+            block = file.read(2880)
+            if len(block) < 2880:
+                return np.inf
+            header_blocks += 1
+            for i in range(36):
+                card = block[i*80:(i+1)*80].decode('ascii',errors='replace')
+                if card[:8].strip() == 'END':
+                    data_size = abs(int(cards.get('BITPIX',8)))//8
+                    for axis in range(int(cards.get('NAXIS',0))):
+                        data_size *= int(cards.get(f'NAXIS{axis+1}',0))
+                    if int(cards.get('NAXIS',0)) == 0:
+                        data_size = 0
+                    return header_blocks*2880+int(np.ceil(data_size/2880.))*2880
+                if card[8:10] == '= ':
+                    cards[card[:8].strip()] = card[10:].split('/')[0].strip()
+
+fits_file_size.__doc__ =f'''
+ NAME:
+    fits_file_size
+
+ PURPOSE:
+    Determine the size a fits file should have from its primary header.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    filename = name of the fits file
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the size in bytes of the primary header and data unit, infinite when the header is not completely written yet
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Only the primary HDU is considered as that is what TiRiFiC writes.
+'''
+
 def fit_sine(Configuration,x,y,debug = False):
     if debug:
         print_log(f'''FIT_SINE: Starting to fit a sin.
@@ -1092,6 +1346,48 @@ gaussian_function.__doc__ =f'''
  NOTE:
 '''
 
+def get_config_hash(Configuration):
+    # Every setting goes into the hash except the batch control, the paths and the bookkeeping of the run itself
+    excluded_keys = ['NCPU','PARALLEL_GALAXIES','PREFETCH_GALAXIES','LONGEST_FIRST','WORK_QUEUE',\
+                     'QUEUE_HEARTBEAT','QUEUE_TIMEOUT','CATALOGUE_START_ID','CATALOGUE_END_ID','RESUME',\
+                     'TIRIFIC_TIMEOUT','SOFIA_TIMEOUT','GALAXY_TIMEOUT','OUTPUT_TIMEOUT','USAGE_INTERVAL',\
+                     'FITS_CACHE_SIZE','DEBUG','TIMING','NEW_OUTPUT','PRINT_EXAMPLES','INSTALLATION_CHECK',\
+                     'MAIN_DIRECTORY','START_DIRECTORY','CATALOGUE','OUTPUT_CATALOGUE','LOG_DIRECTORY','LOG_FILE',\
+                     'CONFIGURATION_FILE','CUBE_NAME','TIRIFIC','SOFIA2','JOURNAL','CONFIG_HASH']
+    config_string = ';'.join([f"{key}={Configuration[key]}" for key in sorted(Configuration) \
+                              if key not in excluded_keys])
+    return hashlib.md5(config_string.encode('utf-8')).hexdigest()[:12]
+
+get_config_hash.__doc__ =f'''
+ NAME:
+    get_config_hash
+
+ PURPOSE:
+    Create a short hash of the fitting settings such that products of a previous run
+    can be identified as coming from the same configuration.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    12 character md5 hex string
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    hashlib.md5
+
+ NOTE:
+    All keys are included except an explicit list of settings that do not change the products,
+    such as ncpu, the timeouts, the queue and prefetch settings and the paths.
+    New options therefore invalidate the products of previous runs unless they are excluded.
+'''
+
 def get_from_template(Configuration,Tirific_Template,Variables, debug = False):
     out = []
     if debug:
@@ -1139,8 +1435,9 @@ get_from_template.__doc__ =f'''
     the latter can thus can include zeros
 '''
 
-def get_inclination_pa(Configuration, Image, center, cutoff = 0., debug = False):
+def get_inclination_pa(Configuration, Image, center, cutoff = 0., ratios = None, debug = False):
     map = copy.deepcopy(Image[0].data)
+    initial_ratios = ratios
     for i in [0,1]:
         if debug:
             print_log(f'''GET_INCLINATION_PA: Doing iteration {i} in the estimates
@@ -1148,7 +1445,10 @@ def get_inclination_pa(Configuration, Image, center, cutoff = 0., debug = False)
         # now we need to get profiles under many angles let's say 100
         #extract the profiles under a set of angles
         angles = np.linspace(0, 360, 180)
-        ratios, maj_extent = obtain_ratios(Configuration,map, center, angles,noise = cutoff,debug=debug)
+        if i == 0 and initial_ratios is not None:
+            ratios, maj_extent = copy.deepcopy(initial_ratios[0]),initial_ratios[1]
+        else:
+            ratios, maj_extent = obtain_ratios(Configuration,map, center, angles,noise = cutoff,debug=debug)
         if np.any(np.isnan(ratios)):
             return [float('NaN'),float('NaN')],  [float('NaN'),float('NaN')],float('NaN')
         sin_ratios,sin_parameters = fit_sine(Configuration,angles,ratios,debug=debug)
@@ -1290,6 +1590,10 @@ get_inclination_pa.__doc__ =f'''
     cutoff = 0.
     Limit to trust the map to, below this values are not evaluated
 
+    ratios = None
+    [ratios,maj_extent] as obtained from obtain_ratios for the uncleaned map at np.linspace(0,360,180).
+    When given these are used in the first iteration instead of extracting the profiles again.
+
  OUTPUTS:
     inclination,inclination_error = inclination and error
     pa,pa_error =  pa and errror
@@ -1550,6 +1854,48 @@ get_profile.__doc__=f'''
  NOTE:
 '''
 
+def get_profiles(Configuration,map,angles,centers,debug=False):
+    angles = np.array(angles,dtype=float)
+    centers = np.array(centers,dtype=float).reshape(-1,2)
+    centers[np.sum(centers,axis=1) == 0.] = [len(map[0,:])/2.,len(map[:,0])/2.]
+    x1,x2,y1,y2 = obtain_border_pixels(Configuration,angles,centers,debug=debug)
+    linex,liney = np.linspace(x1,x2,1000,axis=1), np.linspace(y1,y2,1000,axis=1)
+    resolutions = np.sqrt((x2-x1)**2+(y2-y1)**2)/1000.
+    profiles = ndimage.map_coordinates(map, np.stack((liney,linex)),order=1)
+    return profiles,resolutions
+get_profiles.__doc__=f'''
+ NAME:
+    get_profiles
+
+ PURPOSE:
+    extract a set of profiles under arbitrary angles and centers from a map in one go.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    map = the 2D array with the map
+    angles = the angles of the profiles
+    centers = the center of every profile in pixels, shape (len(angles),2)
+              a center of [0.,0.] is replaced by the center of the map
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    profiles = array of shape (len(angles),1000)
+    resolutions = resolution of a step on the axis of every profile
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    obtain_border_pixels, ndimage.map_coordinates
+
+ NOTE:
+    The profiles are identical to those of get_profile.
+'''
+
 def get_ring_weights(Configuration,Tirific_Template,debug = False):
     if debug:
         print_log(f'''GET_RING_WEIGTHS: Getting the importance of the rings in terms of SBR.
@@ -1600,39 +1946,95 @@ get_ring_weights.__doc__=f'''
     Errors should be divided by these weights to reflect the importance
 '''
 
+def get_process_tree(process_id):
+    # Collect the parent of every running process to find all descendants of process_id
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                stat = file.read()
+        except OSError:
+            continue
+        parent = int(stat[stat.rfind(')')+2:].split()[1])
+        children.setdefault(parent,[]).append(int(entry))
+    tree = [int(process_id)]
+    for pid in tree:
+        tree.extend(children.get(pid,[]))
+    return tree
+
+get_process_tree.__doc__ =f'''
+ NAME:
+    get_process_tree
+
+ PURPOSE:
+    Find a process and all its descendants in /proc
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    process_id = process id of the parent process
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    tree = list with the process id and the ids of all its descendants
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
 def get_usage_statistics(Configuration,process_id, debug = False):
-    result = subprocess.check_output(['top',f'-p {process_id}','-d 1','-n 1'])
-    #result = subprocess.check_output(['ps','u'])
-    lines = result.decode('utf8').split('\n')
-    column_names = [x.upper() for x in lines[6].strip().split()]
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    cpu_time = 0.
+    mem = 0.
+    for pid in get_process_tree(process_id):
+        try:
+            with open(f'/proc/{pid}/stat') as file:
+                stat = file.read()
+            with open(f'/proc/{pid}/status') as file:
+                status = file.readlines()
+        except OSError:
+            # the process finished while we were reading
+            continue
+        fields = stat[stat.rfind(')')+2:].split()
+        # utime and stime are the 14th and 15th field of stat
+        cpu_time += (float(fields[11])+float(fields[12]))/clock_ticks
+        for line in status:
+            if line[:6] == 'VmRSS:':
+                mem += float(line.split()[1])/1024.
+    now = time.time()
+    previous = usage_previous_sample.get(int(process_id))
+    if previous is None:
+        # Without a previous sample we report the average since the start of the process
+        try:
+            with open(f'/proc/{process_id}/stat') as file:
+                stat = file.read()
+            with open('/proc/uptime') as file:
+                uptime = float(file.read().split()[0])
+            started = float(stat[stat.rfind(')')+2:].split()[19])/clock_ticks
+            CPU = cpu_time/np.max([uptime-started,1./clock_ticks])*100.
+        except OSError:
+            CPU = 0.
+    else:
+        CPU = (cpu_time-previous[1])/np.max([now-previous[0],1./clock_ticks])*100.
+    usage_previous_sample[int(process_id)] = [now,cpu_time]
     if debug:
-        print_log(f'''{'':8s}GET_usage_statistics: We extracted the following column names {column_names}
+        print_log(f'''{'':8s}GET_USAGE_STATISTICS: PID {process_id} uses CPU = {CPU:.1f} % and Mem = {mem:.1f} Mb
 ''',Configuration['OUTPUTLOG'],debug=True)
-    CPU = float(0.)
-    mem=float(0.)
-    column_var = [x for x in lines[7].strip().split()]
-    if debug:
-        print_log(f'''{'':8s}GET_usage_statistics: We extracted the following variables {column_var}
-''',Configuration['OUTPUTLOG'])
-    try:
-        if int(column_var[column_names.index('PID')]) == int(process_id):
-            CPU = float(column_var[column_names.index('%CPU')])
-            mem = float(column_var[column_names.index('RES')])/1024**2
-    except:
-        #if the PID is not numeric it got merged with the crap in shiftcentercounter
-        try:
-            if column_var[column_names.index('COMMAND')-1] == 'tirific':
-                CPU = float(column_var[column_names.index('%CPU')-1])
-                mem = float(column_var[column_names.index('RES')-1])/1024**2
-        except:
-            pass
-    return CPU,mem
+    return float(CPU),float(mem)
 
 get_usage_statistics.__doc__ =f'''
  NAME:
     get_usage_statistics
  PURPOSE:
-    use top to get the current CPU and memory usage of tirific
+    read /proc to get the current CPU and memory usage of tirific and its child processes
 
  CATEGORY:
     support_functions
@@ -1645,15 +2047,16 @@ get_usage_statistics.__doc__ =f'''
     debug = False
 
  OUTPUTS:
-    CPU = The current CPU usage
-    mem = current memory usage in Mb
+    CPU = The CPU usage since the previous call for this process in %
+    mem = current resident memory usage in Mb
 
  OPTIONAL OUTPUTS:
 
  PROCEDURES CALLED:
-    Unspecified
+    get_process_tree
 
  NOTE:
+    The first call for a process returns the average CPU usage since the process started.
 '''
 
 def get_vel_pa(Configuration,velocity_field,center= [0.,0.], debug =False):
@@ -1772,6 +2175,43 @@ get_vel_pa.__doc__ =f'''
  NOTE:
 '''
 
+def kill_process_group(process_id, sig = signal.SIGKILL):
+    group = os.getpgid(process_id)
+    # Processes that were not started in their own session share our group
+    if group != os.getpgrp():
+        os.killpg(group, sig)
+    else:
+        os.kill(process_id, sig)
+
+kill_process_group.__doc__ =f'''
+ NAME:
+    kill_process_group
+
+ PURPOSE:
+    Kill an external program together with all processes it started.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    process_id = process id of the program
+
+ OPTIONAL INPUTS:
+    sig = signal.SIGKILL
+    the signal to send, signal.SIGTERM lets the program end itself
+
+ OUTPUTS:
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    The program should be started with start_new_session = True, else only the process itself is killed.
+    Raises ProcessLookupError when the process does not exist.
+'''
+
 # A simple function to return the line numbers in the stack from where the functions are called
 def linenumber(debug=False):
     line = []
@@ -1821,6 +2261,44 @@ linenumber.__doc__ =f'''
     the first debug message in every function should set this to true and later messages not.
     !!!!Not sure whether currently the linenumber is produced due to the restructuring.
 '''
+def locked_append(filename,statement):
+    with open(filename,'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.write(statement)
+            file.flush()
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+locked_append.__doc__ =f'''
+ NAME:
+    locked_append
+
+ PURPOSE:
+    Append a statement to a file that is shared between several FAT processes,
+    e.g. the output catalogue when galaxies are fitted in parallel.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    filename = the file to append to
+    statement = the string to append
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the statement is appended to the file
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    fcntl.flock
+
+ NOTE:
+    The lock is advisory, i.e. it only protects against other writers that use this function.
+'''
+
 def make_tiltogram(Configuration,Tirific_Template,debug =False):
     if debug:
         print_log(f'''MAKE_TILTOGRAM: Starting tiltogram.
@@ -1965,91 +2443,201 @@ obtain_border_pix.__doc__ =f'''
  NOTE:
 '''
 
-def obtain_ratios(Configuration, map, center, angles, noise = 0. ,debug = False):
-    ratios = []
-    max_extent = 0.
-    for angle in angles:
-        #major axis
-        maj_profile,maj_axis,maj_resolution = get_profile(Configuration,map,angle,center=center,debug=debug)
-        tmp = np.where(maj_profile > noise)[0]
-        #gauss =fit_gaussian(maj_axis[tmp], maj_profile[tmp])
-        #maj_gaus = gaussian_function(maj_profile, *gauss)
-        #tmp = np.where(maj_gaus > 0.2*np.nanmax(maj_gaus))[0]
-        if tmp.shape[0] == 0.:
-             width_maj = 0.
-        else:
-            width_maj = (tmp[-1]-tmp[0])*maj_resolution
-            if width_maj**2 > Configuration['BEAM_IN_PIXELS'][0]**2:
-                width_maj = np.sqrt(width_maj**2 - Configuration['BEAM_IN_PIXELS'][0]**2)
-            else:
-                if width_maj < Configuration['BEAM_IN_PIXELS'][0]:
-                    width_maj = Configuration['BEAM_IN_PIXELS'][0]
-
-        if width_maj > max_extent:
-            max_extent = width_maj
-        #minor axis
-        if angle < 90:
-            min_profile,min_axis,min_resolution = get_profile(Configuration,map,angle+90,center=center,debug=debug)
-        else:
-            min_profile,min_axis,min_resolution = get_profile(Configuration,map,angle-90,center=center,debug=debug)
-        tmp = np.where(min_profile > noise)[0]
-        #gauss =fit_gaussian(min_axis[tmp], maj_profile[tmp])
-        #min_gaus = gaussian_function(min_profile,*gauss)
-        #tmp = np.where(min_gaus > 0.2*np.nanmax(min_gaus))[0]
-        if tmp.shape[0] == 0.:
-             width_min = 0.
-        else:
-            width_min = (tmp[-1]-tmp[0])*min_resolution
-            if width_min**2 > Configuration['BEAM_IN_PIXELS'][0]**2:
-                width_min = np.sqrt(width_min**2 - Configuration['BEAM_IN_PIXELS'][0]**2)
-            else:
-                if width_min < Configuration['BEAM_IN_PIXELS'][1]:
-                    width_min = Configuration['BEAM_IN_PIXELS'][1]
-            if width_min > max_extent:
-                max_extent = width_min
-        if width_min != 0. and width_maj != 0.:
-            ratios.append(width_maj/width_min)
-        else:
-            ratios.append(float('NaN'))
-    #as the extend is at 25% let's take 2 time the sigma of that
-    #max_extent = (max_extent/(2.*np.sqrt(2*np.log(2))))*2.
-    max_extent = max_extent/2.
-    return np.array(ratios,dtype=float), max_extent*Configuration['PIXEL_SIZE']
+def obtain_border_pixels(Configuration,angles,centers, debug = False):
+    # vectorized version of obtain_border_pix, every angle has its own center
+    angles = np.array(angles,dtype=float)
+    centers = np.array(centers,dtype=float).reshape(-1,2)
+    xc = centers[:,0]
+    yc = centers[:,1]
+    # only setup for 0-180 but 180.-360 is the same but -180
+    rotate = angles > 180.
+    angles = np.where(rotate,angles-180.,angles)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        # angle < 90.
+        low_x1 = xc-(Configuration['NAXES'][1]-yc)*np.tan(np.radians(angles))
+        low_x2 = xc+(yc)*np.tan(np.radians(angles))
+        low_y1 = np.where(low_x1 < 0, yc+(xc)*np.tan(np.radians(90-angles)),Configuration['NAXES'][1])
+        low_y2 = np.where(low_x2 > Configuration['NAXES'][0], yc-(xc)*np.tan(np.radians(90-angles)),0)
+        # angle > 90.
+        high_x1 = xc-(yc)*np.tan(np.radians(180.-angles))
+        high_x2 = xc+(Configuration['NAXES'][1]-yc)*np.tan(np.radians(180-angles))
+        high_y1 = np.where(high_x1 < 0, yc-(xc)*np.tan(np.radians(angles-90)),0)
+        high_y2 = np.where(high_x2 > Configuration['NAXES'][0], yc+(xc)*np.tan(np.radians(angles-90)),Configuration['NAXES'][1])
+    low = angles < 90.
+    vertical = angles == 90.
+    x1 = np.where(low,low_x1,high_x1)
+    x2 = np.where(low,low_x2,high_x2)
+    y1 = np.where(low,low_y1,high_y1)
+    y2 = np.where(low,low_y2,high_y2)
+    x1 = np.where(x1 < 0, 0., x1)
+    x2 = np.where(x2 > Configuration['NAXES'][0], float(Configuration['NAXES'][0]), x2)
+    x1 = np.where(vertical, 0., x1)
+    x2 = np.where(vertical, float(Configuration['NAXES'][0]), x2)
+    y1 = np.where(vertical, yc, y1)
+    y2 = np.where(vertical, yc, y2)
+    # if the orginal angle was > 180 we need to give the line 180 deg rotation
+    x1,x2 = np.where(rotate,x2,x1),np.where(rotate,x1,x2)
+    y1,y2 = np.where(rotate,y2,y1),np.where(rotate,y1,y2)
+    return x1,x2,y1,y2
 
-obtain_ratios.__doc__ = '''
+obtain_border_pixels.__doc__ =f'''
  NAME:
-       obtain_ratios
-
+    obtain_border_pixels
  PURPOSE:
-       Obtain the ratio between an axis along the specified angle as well as one rotated 90 degrees to determine the pa and inclination.
-       Additionally keep track of the maximum width.
+    Get the pixel locations of where a set of lines across a map exits the map
 
  CATEGORY:
-       support_functions
+    support_functions
 
  INPUTS:
-       Configuration
-       map = moment 0 map
-       hdr = hdr of the map
-       center = estimated center
-       angles = angles to look for the ratios
+    Configuration = standard FAT Configuration
+    angles = the angles of the lines running through the map
+    centers = center of every line running through the map, shape (len(angles),2)
 
  OPTIONAL INPUTS:
-       noise = 0.
-       noise level in the map
+    debug = False
 
-       debug = False
+ OUTPUTS:
+    x1,x2,y1,y2
+    arrays with the pixel locations of how the lines run through the map
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    np.tan,np.radians,np.where
+
+ NOTE:
+    Gives the same borders as obtain_border_pix for every angle.
+'''
+
+def obtain_ratios(Configuration, map, center, angles, noise = 0. ,debug = False):
+    # center can be a single center or a list of centers, all profiles are extracted at once
+    angles = np.array(angles,dtype=float)
+    single_center = np.array(center,dtype=float).ndim == 1
+    centers = np.array(center,dtype=float).reshape(-1,2)
+    #the minor axis is always rotated 90 degrees from the major axis
+    minor_angles = np.where(angles < 90, angles+90, angles-90)
+    profile_angles = np.concatenate((np.tile(angles,centers.shape[0]),np.tile(minor_angles,centers.shape[0])))
+    profile_centers = np.tile(np.repeat(centers,angles.size,axis=0),(2,1))
+    profiles,resolutions = get_profiles(Configuration,map,profile_angles,profile_centers,debug=debug)
+    # the width is the distance between the first and last sample above the noise
+    above = profiles > noise
+    detected = np.any(above,axis=1)
+    first = np.argmax(above,axis=1)
+    last = above.shape[1]-1-np.argmax(above[:,::-1],axis=1)
+    widths = (last-first)*resolutions
+    # Correct for the beam, the minor axis is never set smaller than the minor axis of the beam
+    minimum_width = np.concatenate((np.full(angles.size*centers.shape[0],Configuration['BEAM_IN_PIXELS'][0],dtype=float),\
+                                   np.full(angles.size*centers.shape[0],Configuration['BEAM_IN_PIXELS'][1],dtype=float)))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        widths = np.where(widths**2 > Configuration['BEAM_IN_PIXELS'][0]**2,\
+                          np.sqrt(widths**2 - Configuration['BEAM_IN_PIXELS'][0]**2),\
+                          np.where(widths < minimum_width,minimum_width,widths))
+    widths = np.where(detected,widths,0.)
+    width_maj = widths[:angles.size*centers.shape[0]].reshape(centers.shape[0],angles.size)
+    width_min = widths[angles.size*centers.shape[0]:].reshape(centers.shape[0],angles.size)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ratios = np.where((width_min != 0.) & (width_maj != 0.), width_maj/width_min, float('NaN'))
+    max_extent = np.maximum(np.max(width_maj,axis=1,initial=0.),np.max(width_min,axis=1,initial=0.))
+    #as the extend is at 25% let's take 2 time the sigma of that
+    #max_extent = (max_extent/(2.*np.sqrt(2*np.log(2))))*2.
+    max_extent = max_extent/2.
+    if single_center:
+        return np.array(ratios[0],dtype=float), float(max_extent[0])*Configuration['PIXEL_SIZE']
+    return np.array(ratios,dtype=float), max_extent*Configuration['PIXEL_SIZE']
+
+obtain_ratios.__doc__ = '''
+ NAME:
+       obtain_ratios
+
+ PURPOSE:
+       Obtain the ratio between an axis along the specified angle as well as one rotated 90 degrees to determine the pa and inclination.
+       Additionally keep track of the maximum width.
+
+ CATEGORY:
+       support_functions
+
+ INPUTS:
+       Configuration
+       map = moment 0 map
+       hdr = hdr of the map
+       center = estimated center, or a list of centers
+       angles = angles to look for the ratios
+
+ OPTIONAL INPUTS:
+       noise = 0.
+       noise level in the map
+
+       debug = False
 
  OUTPUTS:
          ratios =  ratios corresponding to the input angles
          max_extent = the maximum extend of any profile analysed (in degree)
+         When a list of centers is given the ratios are an array of shape (len(center),len(angles))
+         and max_extent an array with the extent for every center.
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+      get_profiles, np.argmax, np.where
+
+ NOTE:
+    The profiles for all angles and centers are evaluated in a single map_coordinates call.
+'''
+
+def parse_tirific_progress(line):
+    # TiRiFiC reports its progress as KEY:value pairs, e.g. L:3/10 for the third of ten loops
+    fields = {}
+    for key,value in re.findall(r"([A-Za-z]+):\s*([^\s]+)",line):
+        if key not in fields:
+            fields[key] = value
+    if 'L' not in fields:
+        return None
+    progress = {'LOOP': -1, 'MAX_LOOP': -1, 'CHI_SQUARE': float('NaN'), 'STEP': float('NaN'),\
+                'PARAMETER': fields.get('P','-')}
+    loops = fields['L'].split('/')
+    try:
+        progress['LOOP'] = int(loops[0])
+        progress['MAX_LOOP'] = int(loops[1])
+    except (ValueError,IndexError):
+        pass
+    for key,name in zip(['C','S'],['CHI_SQUARE','STEP']):
+        try:
+            progress[name] = float(fields[key].split('/')[0])
+        except (KeyError,ValueError):
+            pass
+    return progress
+
+parse_tirific_progress.__doc__ =f'''
+ NAME:
+    parse_tirific_progress
+
+ PURPOSE:
+    Parse a progress line of the TiRiFiC output into its loop, chi-square and step size.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    line = a line of the tirific stdout
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    progress = dictionary with LOOP, MAX_LOOP, CHI_SQUARE, STEP and PARAMETER
+    or None when the line does not report a loop
 
  OPTIONAL OUTPUTS:
 
  PROCEDURES CALLED:
-      np.mean, ndimage.map_coordinates, np.linspace, np.vstack, np.cos, np.radians, np.sin
+    Unspecified
 
  NOTE:
+    L is the loop counter, C the chi-square, S the step size and P the parameter that is varied.
+    Values that are not on the line are set to -1 or NaN.
 '''
 
 def print_log(log_statement,log, screen = False,debug = False):
@@ -2091,7 +2679,156 @@ print_log.__doc__ =f'''
     This is useful for testing functions.
 '''
 
-def remove_inhomogeneities(Configuration,fits_map_in,inclination=30., pa = 90. , center = [0.,0.],WCS_center = True, iteration= 0 , debug=False):
+def queue_heartbeat(claim_file,stop_heartbeat,interval):
+    while not stop_heartbeat.wait(interval):
+        try:
+            os.utime(claim_file)
+        except OSError:
+            break
+
+queue_heartbeat.__doc__ =f'''
+ NAME:
+    queue_heartbeat
+
+ PURPOSE:
+    Renew the modification time of a claim in the work queue until the galaxy is released.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    claim_file = the lock file of the claim
+    stop_heartbeat = threading event that is set when the galaxy is released
+    interval = time between the renewals in s
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    os.utime
+
+ NOTE:
+    Runs in a daemon thread started by claim_galaxy.
+'''
+
+def read_claim(claim_file):
+    try:
+        with open(claim_file,'r') as claim:
+            owner = claim.read()
+        last_heartbeat = os.path.getmtime(claim_file)
+    # FileNotFoundError is redefined in this module so we catch the parent
+    except OSError:
+        return None
+    return [owner,last_heartbeat]
+
+read_claim.__doc__ =f'''
+ NAME:
+    read_claim
+
+ PURPOSE:
+    Read the owner and the time of the last heartbeat of a claim in the work queue.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    claim_file = the lock file of the claim
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    [owner, last heartbeat] where the owner is the line written by claim_galaxy,
+    None when there is no claim
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    os.path.getmtime
+
+ NOTE:
+    Two reads of the same living claim differ as soon as its heartbeat renewed it.
+'''
+
+def release_galaxy(claim,debug=False):
+    queue_file,stop_heartbeat,heartbeat = claim
+    stop_heartbeat.set()
+    heartbeat.join()
+    with open(f"{queue_file}.done",'w') as done:
+        done.write(f"{socket.gethostname()} {os.getpid()} {time.time()}\n")
+    try:
+        os.remove(f"{queue_file}.claim")
+    except OSError:
+        pass
+
+release_galaxy.__doc__ =f'''
+ NAME:
+    release_galaxy
+
+ PURPOSE:
+    Stop the heartbeat of a claimed galaxy and mark it as done in the work queue.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    claim = the claim as returned by claim_galaxy
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    The .done file in the queue directory
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Galaxies that stop with an error are marked as done as well, their failure is recorded in the output catalogue.
+'''
+
+def remaining_time(Configuration,timeout):
+    budgets = []
+    if timeout > 0.:
+        budgets.append(timeout)
+    if Configuration['GALAXY_DEADLINE'] > 0.:
+        budgets.append(Configuration['GALAXY_DEADLINE']-time.time())
+    if len(budgets) == 0:
+        return -1.
+    return float(np.max([np.min(budgets),0.]))
+
+remaining_time.__doc__ =f'''
+ NAME:
+    remaining_time
+
+ PURPOSE:
+    Determine how long an external program may run given its own time limit and the time left for the galaxy.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    timeout = the time limit of the program in s, negative for no limit
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the allowed run time in s, -1 when there is no limit
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def remove_inhomogeneities(Configuration,fits_map_in,inclination=30., pa = 90. , center = [0.,0.],WCS_center = True, iteration= 0 , engine = None, debug=False):
     fits_map = copy.deepcopy(fits_map_in)
     if debug:
         print_log(f'''REMOVE_INHOMOGENEITIES: These are the values we get as input
@@ -2113,20 +2850,27 @@ def remove_inhomogeneities(Configuration,fits_map_in,inclination=30., pa = 90. ,
         y = center[1]
     rot_map = rotateImage(Configuration,map,pa-90,[x,y],debug=debug)
     # deproject
-    dep_map = deproject(Configuration,copy.deepcopy(rot_map),inclination,center = y, debug=debug)
+    dep_map = deproject(Configuration,rot_map,inclination,center = y,in_place = False, debug=debug)
 
     if debug:
         fits.writeto(f"{Configuration['FITTING_DIR']}rot_map_{int(iteration)}.fits",rot_map,fits_map[0].header,overwrite = True)
         fits.writeto(f"{Configuration['FITTING_DIR']}dep_map_{int(iteration)}.fits",dep_map,fits_map[0].header,overwrite = True)
 
-    angles = np.linspace(5.,360.,71)
-    minimum_map = copy.deepcopy(dep_map)
-    for angle in angles:
-        rot_dep_map =  rotateImage(Configuration,copy.deepcopy(dep_map),angle,[x,y],debug=debug)
-
-        #tmp = np.where(rot_dep_map < minimum_map)[0]
-        minimum_map[rot_dep_map < minimum_map] =rot_dep_map[rot_dep_map < minimum_map]
-    clean_map = rotateImage(Configuration,deproject(Configuration,copy.deepcopy(minimum_map),inclination,center = y,invert= True,debug=debug),-1*(pa-90),[x,y],debug=debug)
+    if engine is None:
+        engine = Configuration['INHOMOGENEITY_ENGINE']
+    if engine == 'polar':
+        minimum_map = azimuthal_minimum(Configuration,dep_map,[x,y],debug=debug)
+    elif engine == 'rotation':
+        angles = np.linspace(5.,360.,71)
+        minimum_map = copy.deepcopy(dep_map)
+        for angle in angles:
+            rot_dep_map =  rotateImage(Configuration,copy.deepcopy(dep_map),angle,[x,y],debug=debug)
+
+            #tmp = np.where(rot_dep_map < minimum_map)[0]
+            minimum_map[rot_dep_map < minimum_map] =rot_dep_map[rot_dep_map < minimum_map]
+    else:
+        raise InputError(f"REMOVE_INHOMOGENEITIES: {engine} is not a known engine, use polar or rotation.")
+    clean_map = rotateImage(Configuration,deproject(Configuration,minimum_map,inclination,center = y,invert= True,in_place = False,debug=debug),-1*(pa-90),[x,y],debug=debug)
 
     if debug:
         fits.writeto(f"{Configuration['FITTING_DIR']}minimum_map_{int(iteration)}.fits",minimum_map,fits_map[0].header,overwrite = True)
@@ -2168,6 +2912,11 @@ remove_inhomogeneities
     iteration= 0.
     counter for outputting the intermediate maps (See optional outputs)
 
+    engine = None
+    polar takes the minimum along azimuth from a single polar resampling of the deprojected map,
+    rotation takes the minimum of 71 rotated copies of the deprojected map.
+    If None Configuration['INHOMOGENEITY_ENGINE'] is used.
+
  OUTPUTS:
     The cleaned minimum value map
 
@@ -2346,6 +3095,7 @@ def setup_configuration(cfg):
 
                'PREP_END_TIME': 'Not completed',
                'START_TIME':'Not completed',
+               'PREPARATION_TIME': 0., #Seconds spent in prepare_galaxy, set at the end of prepare_galaxy
                'END_TIME':'Not completed',
                'OUTPUTLOG':'Not set yet',
                'RUN_COUNTER': 0,
@@ -2354,6 +3104,9 @@ def setup_configuration(cfg):
                'USED_FITTING': None,
                'TIRIFIC_PID': 'Not Initialized', #Process ID of tirific that is running
                'FINAL_COMMENT': "This fitting stopped with an unregistered exit.",
+               'JOURNAL': None, #File with the journal of the completed stages of all galaxies, set in main
+               'CONFIG_HASH': 'Unset', #Hash of the fitting settings to identify products in the journal, set in main
+               'GALAXY_DEADLINE': -1., #Time at which the galaxy runs out of its galaxy_timeout, set at start of loop
 
                'MAX_SIZE_IN_BEAMS': 30, # The galaxy is not allowed to extend beyond this number of beams in radius, set in check_source
                'MIN_SIZE_IN_BEAMS': 0., # Minimum allowed radius in number of beams of the galaxy, set in check_source
@@ -2442,6 +3195,12 @@ Please provide the correct file name.
 
     if 'run_sofia' in Configuration['FITTING_STAGES'] and 'existing_sofia' in Configuration['FITTING_STAGES']:
         raise InputError(f"You are both providing existing sofia input and ask for sofia to be ran. This won't work exiting.")
+    Configuration['WORKING_PRECISION'] = Configuration['WORKING_PRECISION'].lower()
+    if Configuration['WORKING_PRECISION'] not in ['float32','float64']:
+        raise InputError(f"The working precision {Configuration['WORKING_PRECISION']} is not supported, use float32 or float64.")
+    Configuration['INHOMOGENEITY_ENGINE'] = Configuration['INHOMOGENEITY_ENGINE'].lower()
+    if Configuration['INHOMOGENEITY_ENGINE'] not in ['polar','rotation']:
+        raise InputError(f"The inhomogeneity engine {Configuration['INHOMOGENEITY_ENGINE']} is not supported, use polar or rotation.")
 
 
 
@@ -2562,6 +3321,101 @@ sbr_limits.__doc__ =f'''
  NOTE:
 '''
 
+def schedule_galaxies(Configuration,Full_Catalogue,galaxies,debug=False):
+    # Cost features from the headers only, the log of the number of voxels and the number of beams across
+    features = np.full((len(galaxies),2),np.nan,dtype=float)
+    # Several catalogue entries can share a directory, the wall times are matched on the catalogue number as well
+    keys = []
+    for i,index in enumerate(galaxies):
+        directory = Full_Catalogue['DIRECTORYNAME'][index]
+        keys.append(f"{Full_Catalogue['NUMBER'][index]}|{directory}")
+        if directory == './':
+            fitting_dir = Configuration['MAIN_DIRECTORY']
+        else:
+            fitting_dir = f"{Configuration['MAIN_DIRECTORY']}{directory}/"
+        cube = f"{fitting_dir}{Full_Catalogue['CUBENAME'][index]}.fits"
+        if 'create_fat_cube' not in Configuration['FITTING_STAGES'] and cube[-9:] != '_FAT.fits':
+            cube = f"{fitting_dir}{Full_Catalogue['CUBENAME'][index]}_FAT.fits"
+        try:
+            hdr = fits.getheader(cube)
+        except Exception:
+            continue
+        voxels = float(hdr['NAXIS1'])*float(hdr['NAXIS2'])*float(hdr['NAXIS3'])
+        pixel_size = abs(float(hdr.get('CDELT1',hdr.get('CD1_1',1.))))
+        beam = float(hdr.get('BMAJ',4.*pixel_size))
+        beams_across = np.min([np.max([hdr['NAXIS1'],hdr['NAXIS2']])*pixel_size/beam,2.*Configuration['MAX_SIZE_IN_BEAMS']])
+        features[i] = [np.log10(voxels),np.log10(np.max([beams_across,1.]))]
+
+    # Calibrate on the wall times of previous runs
+    measured = {}
+    wall_time_file = f"{Configuration['MAIN_DIRECTORY']}FAT_Wall_Times.txt"
+    if os.path.exists(wall_time_file):
+        with open(wall_time_file,'r') as tmp:
+            for line in tmp.readlines():
+                input = [x.strip() for x in line.split('|')]
+                if line[0] == '#' or len(input) < 3:
+                    continue
+                key = f"{input[0]}|{input[1]}"
+                if key not in measured:
+                    measured[key] = []
+                measured[key].append(np.log10(np.max([float(input[2]),1.])))
+    calibration = [i for i,key in enumerate(keys) if key in measured and np.all(np.isfinite(features[i]))]
+    if len(calibration) >= 4:
+        design = np.column_stack([np.ones(len(calibration)),features[calibration]])
+        times = np.array([np.mean(measured[keys[i]]) for i in calibration])
+        coefficients = np.linalg.lstsq(design,times,rcond=None)[0]
+        print_log(f'''SCHEDULE_GALAXIES: Calibrated the cost model on {len(calibration)} previous fits, log(t) = {coefficients[0]:.2f} + {coefficients[1]:.2f} log(voxels) + {coefficients[2]:.2f} log(beams).
+''',None,screen=True)
+    else:
+        # Without calibration TiRiFiC scales roughly with the number of voxels times the number of rings
+        coefficients = np.array([0.,1.,1.])
+    cost = coefficients[0]+features[:,0]*coefficients[1]+features[:,1]*coefficients[2]
+    if len(calibration) >= 4:
+        for i,key in enumerate(keys):
+            if key in measured:
+                cost[i] = np.mean(measured[key])
+    # Galaxies without a header fail fast so they go last
+    cost[~np.isfinite(cost)] = -np.inf
+    order = np.argsort(-cost,kind='stable')
+    if debug:
+        print_log(f'''SCHEDULE_GALAXIES: The predicted log costs are {cost[order]} for the galaxies {[keys[i] for i in order]}
+''',None,screen=True)
+    return [galaxies[i] for i in order]
+
+schedule_galaxies.__doc__ =f'''
+ NAME:
+    schedule_galaxies
+
+ PURPOSE:
+    Order the galaxies of a batch such that the most expensive fits are started first.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    galaxies = indices in the catalogue of the galaxies to be fitted
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    the indices ordered by decreasing predicted cost
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    fits.getheader, np.linalg.lstsq
+
+ NOTE:
+    Only the headers of the cubes are read (NAXIS1-3, BMAJ, CDELT1).
+    The wall times that finish_galaxy records in FAT_Wall_Times.txt for successful fits are used
+    to fit the cost model once at least four of the galaxies have been fitted before,
+    galaxies that were fitted before then use their own wall time.
+    The times are matched on the catalogue number and the directory.
+'''
+
 def set_format(key):
     if key in ['SBR', 'SBR_2']:
         format = '.5e'
@@ -2837,6 +3691,146 @@ set_rings.__doc__ =f'''
  NOTE:
 '''
 
+def start_usage_sampler(Configuration,process_id,debug = False):
+    stop_sampler = threading.Event()
+    sampler = threading.Thread(target=usage_sampler,args=(Configuration,process_id,stop_sampler),daemon=True)
+    usage_samplers[int(process_id)] = [stop_sampler,sampler]
+    sampler.start()
+    if debug:
+        print_log(f'''START_USAGE_SAMPLER: Sampling the usage of PID {process_id} every {Configuration['USAGE_INTERVAL']} s.
+''',Configuration['OUTPUTLOG'],debug=True)
+
+start_usage_sampler.__doc__ =f'''
+ NAME:
+    start_usage_sampler
+
+ PURPOSE:
+    Start a background thread that writes the CPU and memory usage of a process to Usage_Statistics.txt
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    process_id = process id of the tirific that was started
+
+ OPTIONAL INPUTS:
+    debug = False
+
+ OUTPUTS:
+    The sampler is registered in usage_samplers under the process id
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    usage_sampler
+
+ NOTE:
+'''
+
+def start_watchdog(process,timeout):
+    if timeout < 0.:
+        return None
+    fired = threading.Event()
+    timer = threading.Timer(timeout,watchdog_kill,args=(process,fired))
+    timer.daemon = True
+    timer.start()
+    return [timer,fired]
+
+start_watchdog.__doc__ =f'''
+ NAME:
+    start_watchdog
+
+ PURPOSE:
+    Kill the process group of an external program when it runs longer than allowed.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    process = subprocess structure of the program
+    timeout = the allowed run time in s, negative for no limit
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    watchdog = [timer, event that is set when the program was killed] or None when there is no limit
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    watchdog_kill
+
+ NOTE:
+    A killed program closes its stdout such that a reading loop ends.
+'''
+
+def stop_watchdog(watchdog):
+    if watchdog is None:
+        return False
+    watchdog[0].cancel()
+    return watchdog[1].is_set()
+
+stop_watchdog.__doc__ =f'''
+ NAME:
+    stop_watchdog
+
+ PURPOSE:
+    Stop a watchdog and report whether it killed its program.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    watchdog = the watchdog returned by start_watchdog
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    True when the program was killed for running too long
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def stop_usage_sampler(process_id):
+    try:
+        stop_sampler,sampler = usage_samplers.pop(int(process_id))
+    except (KeyError,ValueError):
+        return
+    stop_sampler.set()
+    sampler.join()
+    usage_previous_sample.pop(int(process_id),None)
+
+stop_usage_sampler.__doc__ =f'''
+ NAME:
+    stop_usage_sampler
+
+ PURPOSE:
+    Stop the usage sampler of a process if one is running
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    process_id = process id of the sampled process
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
 def sine(x,amp,center,f,mean):
     return amp*np.sin(np.radians(x/f+abs(center)))+mean
 
@@ -2912,3 +3906,205 @@ sofia_output_exists.__doc__ =f'''
 
  NOTE:
 '''
+
+def take_token(token_file,timeout):
+    try:
+        token = os.open(token_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # A token is only held for a moment, an old one belongs to a process that died while holding it
+        try:
+            if time.time()-os.path.getmtime(token_file) > timeout:
+                os.remove(token_file)
+        # FileNotFoundError is redefined in this module so we catch the parent
+        except OSError:
+            pass
+        return False
+    os.write(token,f"{socket.gethostname()} {os.getpid()} {time.time()}\n".encode('utf-8'))
+    os.close(token)
+    return True
+
+take_token.__doc__ =f'''
+ NAME:
+    take_token
+
+ PURPOSE:
+    Take a token file on the shared file system such that only one process at a time can perform an action.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    token_file = the token file
+    timeout = age in s after which a token is considered left behind by a dead process
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    True when we hold the token, False when another process holds it.
+    The holder removes the token file when it is done.
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    os.open
+
+ NOTE:
+    A token that was left behind is removed but not taken, the action is tried again later.
+'''
+
+def usage_sampler(Configuration,process_id,stop_sampler):
+    while True:
+        if not os.path.exists(f'/proc/{process_id}'):
+            break
+        CPU,mem = get_usage_statistics(Configuration,process_id)
+        locked_append(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",\
+            f"{datetime.now()} CPU = {CPU:.1f} % Mem = {mem:.1f} Mb \n")
+        if stop_sampler.wait(Configuration['USAGE_INTERVAL']):
+            break
+
+usage_sampler.__doc__ =f'''
+ NAME:
+    usage_sampler
+
+ PURPOSE:
+    Sample the CPU and memory usage of a process until asked to stop
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    process_id = process id of the sampled process
+    stop_sampler = threading event that stops the sampling
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    A line in the Usage_Statistics.txt every USAGE_INTERVAL seconds
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    get_usage_statistics, locked_append
+
+ NOTE:
+    The lines have the format read by plot_usage_stats.
+'''
+
+def watchdog_kill(process,fired):
+    fired.set()
+    try:
+        kill_process_group(process.pid)
+    except OSError:
+        pass
+
+watchdog_kill.__doc__ =f'''
+ NAME:
+    watchdog_kill
+
+ PURPOSE:
+    Kill the process group of a program that ran out of time.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    process = subprocess structure of the program
+    fired = threading event that is set to record the kill
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    kill_process_group
+
+ NOTE:
+'''
+
+def wait_for_output(Configuration,filenames,timeout = -1., newer_than = 0., stable_time = 0.5, debug = False):
+    if timeout < 0.:
+        timeout = Configuration['OUTPUT_TIMEOUT']
+    start = time.time()
+    # the last size and modification time of every file and since when it has not changed
+    unchanged = {}
+    interval = 0.01
+    while True:
+        complete = True
+        for filename in filenames:
+            try:
+                status = os.stat(filename)
+            # FileNotFoundError is redefined in this module so we catch the parent
+            except OSError:
+                complete = False
+                unchanged.pop(filename,None)
+                continue
+            # An empty file or a file from before the run is not the output we wait for
+            if status.st_size == 0 or status.st_mtime < newer_than:
+                complete = False
+                unchanged.pop(filename,None)
+                continue
+            if filename[-5:] == '.fits':
+                # a fits file is complete when it is as large as its header says
+                if status.st_size < fits_file_size(filename):
+                    complete = False
+            else:
+                # other files have to stay the same for stable_time
+                current = (status.st_size,status.st_mtime_ns)
+                if filename not in unchanged or unchanged[filename][0] != current:
+                    unchanged[filename] = [current,time.time()]
+                if time.time()-unchanged[filename][1] < stable_time:
+                    complete = False
+        if complete:
+            if debug:
+                print_log(f'''WAIT_FOR_OUTPUT: The files {filenames} were complete after {time.time()-start:.2f} s.
+''',Configuration['OUTPUTLOG'])
+            return True
+        if time.time()-start > timeout:
+            print_log(f'''WAIT_FOR_OUTPUT: We waited {timeout} s but the files {filenames} are not complete.
+''',Configuration['OUTPUTLOG'],screen=True)
+            return False
+        time.sleep(interval)
+        interval = np.min([interval*2.,0.2])
+
+wait_for_output.__doc__ =f'''
+ NAME:
+    wait_for_output
+
+ PURPOSE:
+    Wait until output files of an external program are completely written.
+
+ CATEGORY:
+    support_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    filenames = list of the files to wait for
+
+ OPTIONAL INPUTS:
+    debug = False
+
+    timeout = -1.
+    maximum time to wait in s, if negative OUTPUT_TIMEOUT is used
+
+    newer_than = 0.
+    time stamp in s since the epoch, files modified before it are left over from a previous run
+
+    stable_time = 0.5
+    time in s that a file other than a fits file has to stay unchanged
+
+ OUTPUTS:
+    True when all files are complete, False when the timeout is reached
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    os.stat, fits_file_size
+
+ NOTE:
+    A file has to be modified after newer_than and not be empty. A fits file is complete
+    when it has the size given by its primary header, other files when their size and
+    modification time did not change for stable_time. The checks start 0.01 s apart and back off to 0.2 s.
+'''
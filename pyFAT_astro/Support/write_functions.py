@@ -1,9 +1,9 @@
 # -*- coding: future_fstrings -*-
 # This module contains a set of functions and classes that are used to write text files to Disk
 
-from pyFAT_astro.Support.support_functions import print_log,convertRADEC,convertskyangle,set_limit_modifier,columndensity,set_limits,get_inner_fix,linenumber
+from pyFAT_astro.Support.support_functions import print_log,convertRADEC,convertskyangle,set_limit_modifier,columndensity,set_limits,get_inner_fix,linenumber,locked_append
 from pyFAT_astro.Support.modify_template import set_model_parameters, set_overall_parameters, set_fitting_parameters,get_warp_slope, update_disk_angles
-from pyFAT_astro.Support.fits_functions import extract_pv
+from pyFAT_astro.Support.fits_functions import extract_pv,cached_fits
 from pyFAT_astro.Support.read_functions import load_tirific,load_basicinfo, load_template
 import numpy as np
 import warnings
@@ -216,6 +216,46 @@ initialize_def_file.__doc__ =f'''
  NOTE:
 '''
 
+def journal_entry(Configuration,stage,status = 'completed', debug = False):
+    if not Configuration['JOURNAL']:
+        return
+    if debug:
+        print_log(f'''JOURNAL_ENTRY: Registering the stage {stage} with status {status} in {Configuration['JOURNAL']}
+''',Configuration['OUTPUTLOG'],debug = True)
+    locked_append(Configuration['JOURNAL'],f"{datetime.datetime.now()}|{Configuration['ID_NR']}|{Configuration['SUB_DIR']}|{stage}|{status}|{Configuration['CONFIG_HASH']}\n")
+
+journal_entry.__doc__ =f'''
+ NAME:
+    journal_entry
+
+ PURPOSE:
+    Append the stage reached by the current galaxy to the journal of the batch run.
+
+ CATEGORY:
+    write_functions
+
+ INPUTS:
+    Configuration = Standard FAT configuration
+    stage = the stage that is reached, create_fat_cube, run_sofia, check_source or finished
+
+ OPTIONAL INPUTS:
+    debug = False
+
+    status = 'completed'
+    exit status of the stage
+
+ OUTPUTS:
+    A line in the journal file
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    locked_append
+
+ NOTE:
+    The journal is append only and read by load_journal when resuming a batch.
+'''
+
 def make_overview_plot(Configuration,Fits_Files, debug = False):
     fit_type = Configuration['USED_FITTING']
     if debug:
@@ -224,15 +264,15 @@ def make_overview_plot(Configuration,Fits_Files, debug = False):
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        cube_mod = fits.open(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel.fits")
-        moment0_mod = fits.open(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom0.fits")
-        moment1_mod = fits.open(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom1.fits")
-        moment2_mod = fits.open(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom2.fits")
-        cube = fits.open(f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}")
-        moment0 = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT0']}")
-        moment1 = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT1']}")
-        moment2 = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT2']}")
-        channels_map = fits.open(f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['CHANNEL_MAP']}")
+        cube_mod = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel.fits",scaled = True)
+        moment0_mod = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom0.fits",scaled = True)
+        moment1_mod = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom1.fits",scaled = True)
+        moment2_mod = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_mom2.fits",scaled = True)
+        cube = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}",scaled = True)
+        moment0 = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT0']}",scaled = True)
+        moment1 = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT1']}",scaled = True)
+        moment2 = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['MOMENT2']}",scaled = True)
+        channels_map = cached_fits(Configuration,f"{Configuration['FITTING_DIR']}/Sofia_Output/{Fits_Files['CHANNEL_MAP']}",scaled = True)
         im_wcs = WCS(moment0[0].header)
 
     # Open the model info
@@ -564,14 +604,15 @@ def make_overview_plot(Configuration,Fits_Files, debug = False):
 #__________________------------------------------------------------------------PV Diagram
 
     extract_angle = np.mean(FAT_Model[0:round(len(FAT_Model[:,Vars_to_plot.index('PA')])/2.),Vars_to_plot.index('PA')])
+    # Cubes too large for the cache are opened from the file and only the window of the PV-diagram is read
     PV = extract_pv(Configuration,cube,extract_angle, \
                     center = [float(FAT_Model[0,Vars_to_plot.index('XPOS')]),float(FAT_Model[0,Vars_to_plot.index('YPOS')]),float(FAT_Model[0,Vars_to_plot.index('VSYS')]*1000.)], \
-                    convert=1000.)
+                    convert=1000.,read_section = cube.fileinfo(0) is not None)
     if not os.path.exists(f"{Configuration['FITTING_DIR']}/Finalmodel/{Configuration['BASE_NAME']}_final_xv.fits"):
         fits.writeto(f"{Configuration['FITTING_DIR']}/Finalmodel/{Configuration['BASE_NAME']}_final_xv.fits",PV[0].data,PV[0].header)
     PV_model = extract_pv(Configuration,cube_mod,extract_angle, \
                     center = [float(FAT_Model[0,Vars_to_plot.index('XPOS')]),float(FAT_Model[0,Vars_to_plot.index('YPOS')]),float(FAT_Model[0,Vars_to_plot.index('VSYS')]*1000.)], \
-                    convert=1000.)
+                    convert=1000.,read_section = cube_mod.fileinfo(0) is not None)
     if not os.path.exists(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_xv.fits"):
         fits.writeto(f"{Configuration['FITTING_DIR']}/Finalmodel/Finalmodel_xv.fits",PV_model[0].data,PV_model[0].header)
     ratio=PV[0].header['NAXIS2']/PV[0].header['NAXIS1']
@@ -22,7 +22,12 @@ class Fitting:
     fixed_parameters:  List = field(default_factory=lambda: ['Z0','XPOS','YPOS','VSYS']) #Options are INCL, PA, SDIS, SBR
     opt_pixel_beam: int=4
     ncpu: int = 6
+    parallel_galaxies: int = 1 # The number of galaxies fitted simultaneously. The ncpu cores are divided over the galaxies.
+    prefetch_galaxies: int = 0 # When fitting one galaxy at a time, prepare this many of the next galaxies (FAT cube, SoFiA, source check) while TiRiFiC is running. 0 switches this off
+    longest_first: bool = False # Predict the fitting time of every galaxy from the cube headers and the wall times of previous runs and fit the most expensive galaxies first
+    work_queue: bool = False # Claim every galaxy through a lock file in main_directory/FAT_Queue such that several pyFAT processes, e.g. on different nodes, can fit the same catalogue
     max_iterations: int=15
+    working_precision: str = 'float64' # float32 keeps all cubes and maps in float32 and the masks in the smallest integer type, float64 keeps the type that the calculations produce
     distance: float = -1. # Distance to the galaxy, set from the catalogue at start of loop in case of batch fitting
 
 @dataclass
@@ -55,14 +60,26 @@ class Advanced:
     minimum_warp_size: float = 3. # if the number of beams across the major axis/2. is less than this size we will only fit a flat disc,set here.
     minimum_rings: int = 3  # we need at least this amount of rings (Including 0 and 1/5 beam), set here
     too_small_galaxy: float = 1. # if the number of beams across the major axis/2 is less than this we will not fit the galaxy, set here
+    output_timeout: float = 500. # The maximum time in seconds to wait for the output of a TiRiFiC run to be completely written
+    queue_heartbeat: float = 60. # Interval in seconds at which a worker renews the claim on its galaxy in the work queue
+    queue_timeout: float = 600. # A claim in the work queue that is not renewed for this many seconds belongs to a dead worker and is reclaimed
+    plateau_loops: int = 0 # Stop tirific when the chi-square improved less than plateau_tolerance for this many consecutive loops and use the output it wrote. 0 switches this off
+    plateau_tolerance: float = 0.001 # The relative improvement of the chi-square per loop below which a loop counts towards the plateau
+    tirific_timeout: float = -1. # Maximum wall time in seconds of a single tirific run before it is killed and the galaxy is skipped. -1 means no limit
+    sofia_timeout: float = -1. # Maximum wall time in seconds of a single SoFiA run before it is killed and the galaxy is skipped. -1 means no limit
+    galaxy_timeout: float = -1. # Maximum wall time in seconds for a galaxy, checked whenever tirific or SoFiA is started. -1 means no limit
+    usage_interval: float = 1. # Interval in seconds at which the CPU and memory usage of TiRiFiC is sampled when timing is set
+    fits_cache_size: float = 1024. # Maximum size in Mb of the fits files that are kept in memory for a galaxy. 0 switches the cache off
+    inhomogeneity_engine: str = 'rotation' # How the minimum over azimuth of the deprojected moment 0 map is found in the initial estimates. rotation rotates the map 71 times as FAT always did, polar resamples the map once onto a polar grid which is much faster but not identical.
 
 @dataclass
 class defaults:
     print_examples: bool=False
     installation_check: bool=False
+    resume: bool=False # Skip the galaxies that were completed in a previous run with the same settings and restart the others at the last finished stage
     cube_name: Optional[str] = None
     configuration_file: Optional[str] = None
-    input: Input = Input()
-    output: Output = Output()
-    fitting: Fitting = Fitting()
-    advanced: Advanced = Advanced()
+    input: Input = field(default_factory=Input)
+    output: Output = field(default_factory=Output)
+    fitting: Fitting = field(default_factory=Fitting)
+    advanced: Advanced = field(default_factory=Advanced)
@@ -4,6 +4,9 @@
 import sys
 import os
 import copy
+import time
+import collections
+import multiprocessing
 import numpy as np
 from omegaconf import OmegaConf,MissingMandatoryValue
 import traceback
@@ -13,7 +16,7 @@ try:
 except ImportError:
     # Try backported to PY<37 `importlib_resources`.
     import importlib_resources as import_res
-from datetime import datetime
+from datetime import datetime,timedelta
 import pyFAT_astro
 import pyFAT_astro.Support.read_functions as rf
 import pyFAT_astro.Support.support_functions as sf
@@ -40,6 +43,672 @@ def warn_with_traceback(message, category, filename, lineno, file=None, line=Non
 
 # String syntax ''' '''for multiline strings. " " for string without break and ' ' for indexing dictionaries
 
+def claim_catalogue_entry(Original_Configuration,Full_Catalogue,current_galaxy_index):
+    return sf.claim_galaxy(Original_Configuration,catalogue_queue_key(Full_Catalogue,current_galaxy_index))
+
+claim_catalogue_entry.__doc__ = f'''
+ NAME:
+    claim_catalogue_entry
+
+ PURPOSE:
+    Claim a catalogue entry in the work queue.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    current_galaxy_index = index of the galaxy to fit in the catalogue
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the claim from claim_galaxy, None when the galaxy is claimed by another process or done
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    claim_galaxy
+
+ NOTE:
+'''
+
+def catalogue_queue_key(Full_Catalogue,current_galaxy_index):
+    return f"{Full_Catalogue['NUMBER'][current_galaxy_index]}_{Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]}".replace('/','_')
+
+catalogue_queue_key.__doc__ = f'''
+ NAME:
+    catalogue_queue_key
+
+ PURPOSE:
+    The name of a catalogue entry in the work queue.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    current_galaxy_index = index of the galaxy in the catalogue
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the key of the galaxy in MAIN_DIRECTORY/FAT_Queue
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+'''
+
+def fit_catalogue(Original_Configuration,Full_Catalogue,galaxies,maximum_directory_length,stop_individual_errors):
+    remaining = copy.deepcopy(galaxies)
+    while len(remaining) > 0:
+        fit_galaxies(Original_Configuration,Full_Catalogue,remaining,maximum_directory_length,stop_individual_errors)
+        if not Original_Configuration['WORK_QUEUE']:
+            break
+        # Galaxies that another worker was fitting are checked again until they are done, when that worker died its claim goes stale and we take it over
+        remaining = [x for x in remaining if not \
+            os.path.exists(f"{Original_Configuration['MAIN_DIRECTORY']}FAT_Queue/{catalogue_queue_key(Full_Catalogue,x)}.done")]
+        if len(remaining) > 0:
+            sf.print_log(f'''FIT_CATALOGUE: {len(remaining)} galaxies are being fitted by other workers. We check them again in {Original_Configuration['QUEUE_HEARTBEAT']} s.
+''',None,screen=True)
+            time.sleep(Original_Configuration['QUEUE_HEARTBEAT'])
+
+fit_catalogue.__doc__ = f'''
+ NAME:
+    fit_catalogue
+
+ PURPOSE:
+    Fit all galaxies of the catalogue and, in the work queue mode, wait for the galaxies
+    that other workers are fitting until they are done.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    galaxies = indices in the catalogue of the galaxies to be fitted
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The fitted galaxies
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    fit_galaxies
+
+ NOTE:
+    A galaxy that is skipped because a living worker holds its claim is tried again every
+    QUEUE_HEARTBEAT seconds, such that it is reclaimed when that worker dies before it is done.
+'''
+
+def fit_galaxies(Original_Configuration,Full_Catalogue,galaxies,maximum_directory_length,stop_individual_errors):
+    no_processes = min([Original_Configuration['PARALLEL_GALAXIES'],Original_Configuration['NCPU'],len(galaxies)])
+    if no_processes > 1:
+        # Split the cores such that the TiRiFiC runs of the different galaxies do not compete
+        Pool_Configuration = copy.deepcopy(Original_Configuration)
+        Pool_Configuration['NCPU'] = max([1,int(Original_Configuration['NCPU']/no_processes)])
+        sf.print_log(f'''MAIN: We are fitting {len(galaxies)} galaxies with {no_processes} processes of {Pool_Configuration['NCPU']} cores each.
+''',None,screen=True)
+        input_parameters = [(Pool_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors) for current_galaxy_index in galaxies]
+        with multiprocessing.get_context('spawn').Pool(processes=no_processes) as pool:
+            for current_galaxy_index,status in pool.imap_unordered(galaxy_loop_parallel,input_parameters):
+                sf.print_log(f'''MAIN: The galaxy in directory {Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]} has {status}.
+''',None,screen=True)
+    elif Original_Configuration['PREFETCH_GALAXIES'] > 0 and len(galaxies) > 1:
+        pipeline_galaxies(Original_Configuration,Full_Catalogue,galaxies,maximum_directory_length,stop_individual_errors)
+    else:
+        for current_galaxy_index in galaxies:
+            galaxy_loop(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors)
+
+fit_galaxies.__doc__ = f'''
+ NAME:
+    fit_galaxies
+
+ PURPOSE:
+    Fit a list of galaxies one by one, in parallel processes or with the next galaxies prepared ahead.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    galaxies = indices in the catalogue of the galaxies to be fitted
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The fitted galaxies
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    galaxy_loop_parallel, pipeline_galaxies, galaxy_loop
+
+ NOTE:
+    In the work queue mode galaxies claimed by other processes are skipped.
+'''
+
+def prepare_galaxy(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+    current_run = 'Not Initialized'
+    Configuration = copy.deepcopy(Original_Configuration)
+    Configuration['START_TIME'] = datetime.now()
+    if Configuration['GALAXY_TIMEOUT'] > 0.:
+        Configuration['GALAXY_DEADLINE'] = time.time()+Configuration['GALAXY_TIMEOUT']
+    try:
+        # First check the starttime
+        Configuration['ID_NR'] = Full_Catalogue['NUMBER'][current_galaxy_index]
+        if  Full_Catalogue['DISTANCE'][current_galaxy_index] != 2.:
+            Configuration['DISTANCE'] = Full_Catalogue['DISTANCE'][current_galaxy_index]
+        Configuration['SUB_DIR'] = Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]
+        Configuration['BASE_NAME'] = Full_Catalogue['CUBENAME'][current_galaxy_index]+'_FAT'
+        if not Configuration['SOFIA_BASENAME']:
+            if 'BASENAME' in Full_Catalogue['ENTRIES']:
+                Configuration['SOFIA_BASENAME'] = Full_Catalogue['BASENAME'][current_galaxy_index]
+            else:
+                Configuration['SOFIA_BASENAME'] = Configuration['BASE_NAME']
+        #Add our fitting directory to the Configuration
+        #Maindir always ends in slash already
+        if Full_Catalogue['DIRECTORYNAME'][current_galaxy_index] == './':
+            Configuration['FITTING_DIR'] = f"{Configuration['MAIN_DIRECTORY']}"
+        else:
+            Configuration['FITTING_DIR'] = f"{Configuration['MAIN_DIRECTORY']}{Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]}/"
+        if Configuration['FITTING_DIR'][-2:] == '//':
+            Configuration['FITTING_DIR'] = Configuration['FITTING_DIR'][:-2]+'/'
+        if not Configuration['SOFIA_DIR']:
+            Configuration['SOFIA_DIR'] = Configuration['FITTING_DIR']
+        # When resuming check what this galaxy reached in previous runs
+        journal = []
+        if Configuration['RESUME']:
+            journal = rf.load_journal(Configuration,debug=Configuration['DEBUG'])
+            if len(journal) > 0 and journal[-1][0] == 'finished' and journal[-1][1] != 'error':
+                sf.print_log(f'''MAIN: The galaxy in directory {Configuration['SUB_DIR']} was completed in a previous run. We skip it.
+''',None,screen=True)
+                return
+        ini_mode_factor =25
+        # We initially set the variations to fixed for all parameters
+        #let's see what happens if we immediately
+
+        #Make a dictionary for the fitsfiles we use
+        Fits_Files = {'ORIGINAL_CUBE': f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}.fits"}
+
+        # If we have a fitting log we start writing
+        log_statement = f'''This file is a log of the fitting process run at {Configuration ['START_TIME']}.
+{"":8s}This is version {pyFAT_astro.__version__} of the program.
+'''
+
+
+        # Adapt configuration to hold some specifics to this galaxy
+
+        Configuration['LOG_DIRECTORY']=f'''{Configuration['FITTING_DIR']}{Configuration['LOG_DIRECTORY']}/'''
+        sf.create_directory(Configuration['LOG_DIRECTORY'],Configuration['FITTING_DIR'])
+        Configuration['OUTPUTLOG'] = f"{Configuration['LOG_DIRECTORY']}{Configuration['LOG_FILE']}"
+
+            #If it exists move the previous Log
+        if os.path.exists(Configuration['OUTPUTLOG']):
+            os.rename(Configuration['OUTPUTLOG'],f"{Configuration['LOG_DIRECTORY']}Previous_Log.txt")
+
+        with open(Configuration['OUTPUTLOG'],'w') as log:
+            log.write(log_statement)
+
+        #Make a dictionary for the fitsfiles we use
+        Fits_Files = {'ORIGINAL_CUBE': f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}.fits"}
+        #if we skip the create_fat _cube stage peaople could give the fat cube itself
+
+        if Fits_Files['ORIGINAL_CUBE'][-9:] == '_FAT.fits':
+            sf.print_log(f''' Your input cube ends in _FAT.fits indicating it is a FAT processed cube.
+''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
+            if 'create_fat_cube' in Configuration['FITTING_STAGES']:
+                sf.print_log(f''' We are remove the Create_FAT_Cube stages from the loop.
+''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
+                Configuration['FITTING_STAGES'].remove('create_fat_cube')
+            fat_ext = ''
+        else:
+            fat_ext = '_FAT'
+        Fits_Files['FITTING_CUBE'] = f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}{fat_ext}.fits"
+        Fits_Files['OPTIMIZED_CUBE'] = f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}{fat_ext}_opt.fits"
+        Fits_Files['MOMENT0'] = f"{Configuration['BASE_NAME']}_mom0.fits"
+        Fits_Files['MOMENT1'] = f"{Configuration['BASE_NAME']}_mom1.fits"
+        Fits_Files['MOMENT2'] = f"{Configuration['BASE_NAME']}_mom2.fits"
+        Fits_Files['MASK'] = f"{Configuration['BASE_NAME']}_mask.fits"
+        Fits_Files['CHANNEL_MAP'] = f"{Configuration['BASE_NAME']}_chan.fits"
+        # Restart at the last finished stage, check_source modifies the cube and thus invalidates the SoFiA output
+        stages_reached = [x for x in journal if x[0] != 'finished']
+        if 'create_fat_cube' in Configuration['FITTING_STAGES'] and ['create_fat_cube','completed'] in stages_reached \
+            and os.path.exists(f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}"):
+            sf.print_log(f'''MAIN: We are resuming from a previous run and use the existing {Fits_Files['FITTING_CUBE']}.
+''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
+            Configuration['FITTING_STAGES'].remove('create_fat_cube')
+        if 'create_fat_cube' not in Configuration['FITTING_STAGES'] and 'run_sofia' in Configuration['FITTING_STAGES'] \
+            and len(stages_reached) > 0 and stages_reached[-1] == ['run_sofia','completed'] \
+            and os.path.exists(f"{Configuration['FITTING_DIR']}Sofia_Output/{Fits_Files['MASK']}") \
+            and os.path.exists(f"{Configuration['FITTING_DIR']}Sofia_Output/{Configuration['BASE_NAME']}_cat.txt"):
+            sf.print_log(f'''MAIN: We are resuming from a previous run and use the existing SoFiA output.
+''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
+            Configuration['SOFIA_RAN'] = True
+        if 'create_fat_cube' in Configuration['FITTING_STAGES']:
+            if not os.path.exists(f"{Configuration['FITTING_DIR']}/{Fits_Files['ORIGINAL_CUBE']}"):
+                raise CatalogError(f'''We can not find the file {Fits_Files['ORIGINAL_CUBE']}. This is likely to be due to a typo in your catalog.''' )
+        else:
+            if not os.path.exists(f"{Configuration['FITTING_DIR']}/{Fits_Files['FITTING_CUBE']}"):
+                raise CatalogError(f'''We can not find the file {Fits_Files['FITTING_CUBE']}. This is likely to be due to a typo in your catalog.''' )
+
+        # run cleanup
+        cf.cleanup(Configuration,Fits_Files,debug=Configuration['DEBUG'])
+
+        if Configuration['DEBUG']:
+            from numpy import __version__ as npversion
+            from scipy import __version__ as spversion
+            from astropy import __version__ as apversion
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                from matplotlib import __version__ as mpversion
+            #from subprocess import __version__ as subversion
+
+            sf.print_log(f'''MAIN: We are using the following versions
+{'':8s}NumPy {npversion}
+{'':8s}SciPy {spversion}
+{'':8s}AstroPy {apversion}
+{'':8s}Matplotlib {mpversion}
+''',Configuration['OUTPUTLOG'])
+
+
+
+        log_statement = f'''We are in loop {current_galaxy_index}. This is catalogue number {Configuration['ID_NR']} and the directory {Configuration['SUB_DIR']}.\n'''
+        sf.print_log(log_statement,Configuration['OUTPUTLOG'], screen =True)
+
+
+
+        if Configuration['TIMING']:
+            with open(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",'w') as file:
+                file.write("Creating a CPU RAM Log for analysis. \n")
+        # Check if the input cube exists
+
+
+
+
+        # Let's see if our base cube exists, Note that cleanup removes it if we want to start from the original dir so no need to check start_point
+        if not os.path.exists(f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}"):
+            try:
+                ff.create_fat_cube(Configuration, Fits_Files)
+            except Exception as e:
+                Configuration['FINAL_COMMENT'] = e
+                if e.__class__.__name__ in stop_individual_errors:
+                    Configuration['OUTPUT_QUANTITY'] = 5
+                else:
+                    Configuration['OUTPUT_QUANTITY'] = 'error'
+                cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting=e)
+                return
+            wf.journal_entry(Configuration,'create_fat_cube',debug=Configuration['DEBUG'])
+
+        # Get a bunch of info from the cube
+        rf.read_cube(Configuration,Fits_Files['FITTING_CUBE'],debug =Configuration['DEBUG'] )
+
+
+        #If we have Sofia Preprocessed Output request make sure it all exists
+        if Configuration['DEBUG']:
+            wf.write_config(f'{Configuration["LOG_DIRECTORY"]}CFG_Before_Sofia.txt',Configuration,debug = True)
+        if 'existing_sofia' in  Configuration['FITTING_STAGES']:
+            sf.copy_homemade_sofia(Configuration,debug=Configuration['DEBUG'])
+        elif 'run_sofia' in Configuration['FITTING_STAGES'] and not Configuration['SOFIA_RAN']:
+            # Run sofia2
+            try:
+                runf.sofia(Configuration, Fits_Files,debug=Configuration['DEBUG'])
+            except Exception as e:
+                Configuration['FINAL_COMMENT'] = e
+                if e.__class__.__name__ in stop_individual_errors:
+                    Configuration['OUTPUT_QUANTITY'] = 5
+                else:
+                    Configuration['OUTPUT_QUANTITY'] = 'error'
+                cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting=e)
+                return
+            wf.journal_entry(Configuration,'run_sofia',debug=Configuration['DEBUG'])
+        elif 'run_sofia' in Configuration['FITTING_STAGES']:
+            # The SoFiA output of a previous run is reused, the moment maps are made in check_source
+            pass
+        else:
+            sf.sofia_output_exists(Configuration,Fits_Files, debug = Configuration['DEBUG'])
+                # We assume sofia is ran and created the proper files
+        try:
+            # Process the found source in sofia to set up the proper fitting and make sure source can be fitted
+            wf.journal_entry(Configuration,'check_source',status='started',debug=Configuration['DEBUG'])
+            Initial_Parameters = runf.check_source(Configuration, Fits_Files,debug=Configuration['DEBUG'])
+            #sf.sofia_output_exists(Configuration,Fits_Files)
+
+            sf.print_log(f'''The source is well defined and we will now setup the initial tirific file
+''' ,Configuration['OUTPUTLOG'], screen =True, debug = Configuration['DEBUG'])
+        except Exception as e:
+            Configuration['FINAL_COMMENT'] = e
+            if e.__class__.__name__ in stop_individual_errors:
+                Configuration['OUTPUT_QUANTITY'] = 5
+            else:
+                Configuration['OUTPUT_QUANTITY'] = 'error'
+            cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run, Fits_Files =Fits_Files,debug = Configuration['DEBUG'],exiting=e)
+            return
+        Configuration['PREPARATION_TIME'] = (datetime.now()-Configuration['START_TIME']).total_seconds()
+        return Configuration,Fits_Files,Initial_Parameters
+    except Exception as e:
+        Configuration['FINAL_COMMENT'] = e
+        Configuration['OUTPUT_QUANTITY'] = 'error'
+        cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting= e)
+
+prepare_galaxy.__doc__ = f'''
+ NAME:
+    prepare_galaxy
+
+ PURPOSE:
+    Run the preparation stages of FAT on a single galaxy from the catalogue,
+    i.e. create the FAT cube, run SoFiA and check the source.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    current_galaxy_index = index of the galaxy to fit in the catalogue
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    Configuration = Standard FAT configuration for this galaxy
+    Fits_Files = Standard FAT dictionary with filenames
+    Initial_Parameters = the initial estimates of the galaxy parameters from check_source
+
+ OPTIONAL OUTPUTS:
+    None when the galaxy is finished before the fitting, e.g. when it is skipped or SoFiA finds no source.
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Any unregistered error ends in finish_galaxy with an error status, which exits the program.
+'''
+
+def fit_galaxy(Configuration,Fits_Files,Initial_Parameters,maximum_directory_length,stop_individual_errors):
+    registered_exception = None
+    current_run = 'Not Initialized'
+    # A prefetched galaxy can wait for the previous fit, so the clocks restart here with only the preparation counted
+    Configuration['START_TIME'] = datetime.now()-timedelta(seconds=Configuration['PREPARATION_TIME'])
+    if Configuration['GALAXY_TIMEOUT'] > 0.:
+        Configuration['GALAXY_DEADLINE'] = time.time()+Configuration['GALAXY_TIMEOUT']-Configuration['PREPARATION_TIME']
+    try:
+        # then we want to read the template
+        Tirific_Template = rf.tirific_template()
+        try:
+            #Add your personal fitting types here
+            wf.write_config(f'{Configuration["LOG_DIRECTORY"]}CFG_Before_Fitting.txt',Configuration,debug = True)
+            # If you add any make sure that the fitstage  starts with 'Fit_'
+            if 'fit_tirific_osc' in Configuration['FITTING_STAGES']:
+                current_run = runf.fitting_osc(Configuration,Fits_Files,Tirific_Template,Initial_Parameters)
+            elif 'fit_make_your_own' in Configuration['FITTING_STAGES']:
+                print_log(f'If you add any fiiting routine make sure that the fit stage  starts with Fit_')
+                Configuration['FINAL_COMMENT'] = 'This example does not work'
+                cf.finish_galaxy(Configuration,maximum_directory_length,debug=Configuration['DEBUG'])
+                return
+            else:
+                Configuration['FINAL_COMMENT'] = 'You have chosen not to do any fitting'
+                cf.finish_galaxy(Configuration,maximum_directory_length,debug=Configuration['DEBUG'])
+                return
+            #cf.finish_galaxy(Configuration,maximum_directory_length, Fits_Files =Fits_Files,current_run =current_run,debug=Configuration['DEBUG'])
+            #continue
+            Configuration['FINAL_COMMENT'] = 'The fit has converged succesfully'
+
+
+        except Exception as e:
+            registered_exception = e
+            Configuration['FINAL_COMMENT'] = e
+            if e.__class__.__name__ in stop_individual_errors:
+                Configuration['OUTPUT_QUANTITY'] = 5
+            else:
+                Configuration['OUTPUT_QUANTITY'] = 'error'
+        cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run, Fits_Files =Fits_Files,debug = Configuration['DEBUG'],exiting=registered_exception)
+        if Configuration['OUTPUT_QUANTITY'] != 5:
+            DHI = rf.get_DHI(Configuration,Model=Configuration['USED_FITTING'],debug=Configuration['DEBUG'])
+            Totflux = rf.get_totflux(Configuration,f"/Finalmodel/Finalmodel_mom0.fits", debug=Configuration['DEBUG'])
+            wf.basicinfo(Configuration, template=Tirific_Template,Tot_Flux = Totflux, DHI = [DHI,Configuration['BEAM'][0]*Configuration['RING_SIZE']],debug=Configuration['DEBUG'] )
+            if Configuration['INSTALLATION_CHECK']:
+                cf.installation_check(Configuration,debug=Configuration['DEBUG'])
+    except Exception as e:
+        registered_exception = e
+        Configuration['FINAL_COMMENT'] = e
+        Configuration['OUTPUT_QUANTITY'] = 'error'
+        cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting= registered_exception)
+
+fit_galaxy.__doc__ = f'''
+ NAME:
+    fit_galaxy
+
+ PURPOSE:
+    Fit a prepared galaxy with TiRiFiC and produce the final output.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Configuration = Standard FAT configuration for this galaxy
+    Fits_Files = Standard FAT dictionary with filenames
+    Initial_Parameters = the initial estimates of the galaxy parameters from check_source
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The fitted galaxy and a line in the output catalogue
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Any unregistered error ends in finish_galaxy with an error status, which exits the program.
+    START_TIME and GALAXY_DEADLINE are reset at the start such that the time a prefetched
+    galaxy waited for the previous fit does not count towards its timing or galaxy_timeout.
+'''
+
+def galaxy_loop(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+    # In the work queue mode another pyFAT process might be fitting or have fitted this galaxy
+    claim = None
+    if Original_Configuration['WORK_QUEUE']:
+        claim = claim_catalogue_entry(Original_Configuration,Full_Catalogue,current_galaxy_index)
+        if not claim:
+            return
+    try:
+        prepared = prepare_galaxy(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors)
+        if prepared:
+            fit_galaxy(*prepared,maximum_directory_length,stop_individual_errors)
+    finally:
+        ff.clear_fits_cache()
+        if claim:
+            sf.release_galaxy(claim)
+
+galaxy_loop.__doc__ = f'''
+ NAME:
+    galaxy_loop
+
+ PURPOSE:
+    Run the full FAT procedure on a single galaxy from the catalogue.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    current_galaxy_index = index of the galaxy to fit in the catalogue
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The fitted galaxy and a line in the output catalogue
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    Unspecified
+
+ NOTE:
+    Any unregistered error ends in finish_galaxy with an error status, which exits
+    the program. The parallel runs catch this exit in galaxy_loop_parallel.
+    In the work queue mode galaxies claimed by other processes are skipped,
+    fit_catalogue tries them again until they are done.
+'''
+
+def galaxy_loop_parallel(input_parameters):
+    current_galaxy_index = input_parameters[2]
+    try:
+        galaxy_loop(*input_parameters)
+        status = 'finished'
+    except SystemExit:
+        status = 'error'
+    except Exception as e:
+        status = f'error: {e}'
+    return current_galaxy_index,status
+
+galaxy_loop_parallel.__doc__ = f'''
+ NAME:
+    galaxy_loop_parallel
+
+ PURPOSE:
+    Wrapper around galaxy_loop for the process pool such that a crash of one
+    galaxy does not take down the worker or the other galaxies.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    input_parameters = tuple with the input for galaxy_loop
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    current_galaxy_index = index of the galaxy in the catalogue
+    status = finished or error
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    galaxy_loop
+
+ NOTE:
+'''
+
+def prepare_galaxy_parallel(input_parameters):
+    try:
+        return prepare_galaxy(*input_parameters)
+    except SystemExit:
+        return None
+    finally:
+        ff.clear_fits_cache()
+
+prepare_galaxy_parallel.__doc__ = f'''
+ NAME:
+    prepare_galaxy_parallel
+
+ PURPOSE:
+    Wrapper around prepare_galaxy for the prefetching processes such that a crash in the
+    preparation of one galaxy does not take down the pipeline.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    input_parameters = tuple with the input for prepare_galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    the output of prepare_galaxy or None
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    prepare_galaxy
+
+ NOTE:
+'''
+
+def pipeline_galaxies(Original_Configuration,Full_Catalogue,galaxies,maximum_directory_length,stop_individual_errors):
+    to_prepare = copy.deepcopy(galaxies)
+    in_preparation = collections.deque()
+    with multiprocessing.get_context('spawn').Pool(processes=Original_Configuration['PREFETCH_GALAXIES']) as pool:
+        def prefetch_next():
+            while len(to_prepare) > 0:
+                current_galaxy_index = to_prepare.pop(0)
+                claim = None
+                if Original_Configuration['WORK_QUEUE']:
+                    claim = claim_catalogue_entry(Original_Configuration,Full_Catalogue,current_galaxy_index)
+                    if not claim:
+                        continue
+                in_preparation.append([claim,pool.apply_async(prepare_galaxy_parallel,\
+                    ((Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors),))])
+                return
+        for i in range(Original_Configuration['PREFETCH_GALAXIES']):
+            prefetch_next()
+        while len(in_preparation) > 0:
+            claim,preparation = in_preparation.popleft()
+            # Keep the prefetch depth while this galaxy is being fitted
+            prefetch_next()
+            try:
+                prepared = preparation.get()
+                if prepared:
+                    fit_galaxy(*prepared,maximum_directory_length,stop_individual_errors)
+            finally:
+                ff.clear_fits_cache()
+                if claim:
+                    sf.release_galaxy(claim)
+
+pipeline_galaxies.__doc__ = f'''
+ NAME:
+    pipeline_galaxies
+
+ PURPOSE:
+    Fit the galaxies one after the other while the preparation stages (FAT cube, SoFiA,
+    check_source) of the next galaxies run in separate processes.
+
+ CATEGORY:
+    main
+
+ INPUTS:
+    Original_Configuration = Standard FAT configuration as set up before any galaxy is fitted
+    Full_Catalogue = the catalogue with all galaxies to be fitted
+    galaxies = indices in the catalogue of the galaxies to be fitted
+    maximum_directory_length = the maximum string length of the input directory names
+    stop_individual_errors = list of error names that only stop the fitting of this galaxy
+
+ OPTIONAL INPUTS:
+
+ OUTPUTS:
+    The fitted galaxies
+
+ OPTIONAL OUTPUTS:
+
+ PROCEDURES CALLED:
+    prepare_galaxy, fit_galaxy
+
+ NOTE:
+    At most PREFETCH_GALAXIES galaxies are prepared ahead of the one being fitted
+    such that the disk and memory use stay bounded.
+'''
+
 def main(argv):
 
     warnings.showwarning = warn_with_traceback
@@ -87,6 +756,13 @@ def main(argv):
 
             pyFAT file_name=Input_Cube.fits fitting.ring_size=1.5 'fitting.fixed_parameters=[INCL,SDIS]'
 
+        An interrupted batch run can be continued with:
+
+            pyFAT configuration_file=FAT_Input.yml resume=True
+
+        which skips the galaxies that were completed with the same settings
+        and restarts the others at the last finished stage.
+
         You can test your installation with:
 
             pyFAT installation_check=True
@@ -148,7 +824,8 @@ configuration_file = ''')
             Full_Catalogue = rf.sofia_input_catalogue(Original_Configuration)
         else:
             Full_Catalogue = rf.catalogue(Original_Configuration['CATALOGUE'])
-        stop_individual_errors = ['SmallSourceError','BadSourceError','SofiaFaintError','BadHeaderError','BadCubeError','BadMaskError','BadCatalogueError']
+        stop_individual_errors = ['SmallSourceError','BadSourceError','SofiaFaintError','BadHeaderError','BadCubeError','BadMaskError','BadCatalogueError',\
+                                  'TirificTimeoutError','SofiaTimeoutError','TirificOutputError']
         # Get the longest directory name to format the output directory properlyFit_Tirific_OSC
         dirname = 'Directory Name'
         maximum_directory_length = len(dirname)
@@ -158,14 +835,28 @@ configuration_file = ''')
             if len(directory) > maximum_directory_length:
                 maximum_directory_length = len(directory)
 
-        # Create a file to write the results to if if required
+        # Create a file to write the results to if if required, when resuming or sharing a work queue we keep the previous results
         if Original_Configuration['OUTPUT_CATALOGUE']:
-            if not os.path.exists(Original_Configuration['OUTPUT_CATALOGUE']) or Original_Configuration['NEW_OUTPUT']:
+            if not os.path.exists(Original_Configuration['OUTPUT_CATALOGUE']) or \
+                (Original_Configuration['NEW_OUTPUT'] and not Original_Configuration['RESUME'] and not Original_Configuration['WORK_QUEUE']):
                 with open(Original_Configuration['OUTPUT_CATALOGUE'],'w') as output_catalogue:
                     comment = 'Comments on Fit Result'
                     AC1 = 'OS'
                     output_catalogue.write(f"{dirname:<{maximum_directory_length}s} {AC1:>6s} {comment}\n")
 
+        if Original_Configuration['WORK_QUEUE']:
+            os.makedirs(f"{Original_Configuration['MAIN_DIRECTORY']}FAT_Queue",exist_ok=True)
+
+        # The journal keeps track of the stages every galaxy reached such that a batch can be resumed
+        if Original_Configuration['OUTPUT_CATALOGUE']:
+            Original_Configuration['JOURNAL'] = f"{os.path.splitext(Original_Configuration['OUTPUT_CATALOGUE'])[0]}_Journal.txt"
+        else:
+            Original_Configuration['JOURNAL'] = f"{Original_Configuration['MAIN_DIRECTORY']}FAT_Journal.txt"
+        Original_Configuration['CONFIG_HASH'] = sf.get_config_hash(Original_Configuration)
+        if not os.path.exists(Original_Configuration['JOURNAL']):
+            with open(Original_Configuration['JOURNAL'],'w') as journal:
+                journal.write(f"# Time|ID|Directory|Stage|Status|Config Hash\n")
+
         if Original_Configuration['TIMING']:
             timing_result = open(Original_Configuration['MAIN_DIRECTORY']+'Timing_Result.txt','w')
             timing_result.write("This file contains the system start and end times for the fitting of each galaxy")
@@ -189,205 +880,15 @@ configuration_file = ''')
             sys.exit(1)
 
 
-        for current_galaxy_index in range(Original_Configuration['CATALOGUE_START_ID'],Original_Configuration['CATALOGUE_END_ID']):
-            registered_exception = None
-            current_run = 'Not Initialized'
-            Configuration = copy.deepcopy(Original_Configuration)
-            Configuration['START_TIME'] = datetime.now()
-            # First check the starttime
-            Configuration['ID_NR'] = Full_Catalogue['NUMBER'][current_galaxy_index]
-            if  Full_Catalogue['DISTANCE'][current_galaxy_index] != 2.:
-                Configuration['DISTANCE'] = Full_Catalogue['DISTANCE'][current_galaxy_index]
-            Configuration['SUB_DIR'] = Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]
-            Configuration['BASE_NAME'] = Full_Catalogue['CUBENAME'][current_galaxy_index]+'_FAT'
-            if not Configuration['SOFIA_BASENAME']:
-                if 'BASENAME' in Full_Catalogue['ENTRIES']:
-                    Configuration['SOFIA_BASENAME'] = Full_Catalogue['BASENAME'][current_galaxy_index]
-                else:
-                    Configuration['SOFIA_BASENAME'] = Configuration['BASE_NAME']
-            #Add our fitting directory to the Configuration
-            #Maindir always ends in slash already
-            if Full_Catalogue['DIRECTORYNAME'][current_galaxy_index] == './':
-                Configuration['FITTING_DIR'] = f"{Configuration['MAIN_DIRECTORY']}"
-            else:
-                Configuration['FITTING_DIR'] = f"{Configuration['MAIN_DIRECTORY']}{Full_Catalogue['DIRECTORYNAME'][current_galaxy_index]}/"
-            if Configuration['FITTING_DIR'][-2:] == '//':
-                Configuration['FITTING_DIR'] = Configuration['FITTING_DIR'][:-2]+'/'
-            if not Configuration['SOFIA_DIR']:
-                Configuration['SOFIA_DIR'] = Configuration['FITTING_DIR']
-            ini_mode_factor =25
-            # We initially set the variations to fixed for all parameters
-            #let's see what happens if we immediately
-
-            #Make a dictionary for the fitsfiles we use
-            Fits_Files = {'ORIGINAL_CUBE': f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}.fits"}
-
-            # If we have a fitting log we start writing
-            log_statement = f'''This file is a log of the fitting process run at {Configuration ['START_TIME']}.
-{"":8s}This is version {pyFAT_astro.__version__} of the program.
-'''
-
-
-            # Adapt configuration to hold some specifics to this galaxy
-
-            Configuration['LOG_DIRECTORY']=f'''{Configuration['FITTING_DIR']}{Configuration['LOG_DIRECTORY']}/'''
-            sf.create_directory(Configuration['LOG_DIRECTORY'],Configuration['FITTING_DIR'])
-            Configuration['OUTPUTLOG'] = f"{Configuration['LOG_DIRECTORY']}{Configuration['LOG_FILE']}"
-
-                #If it exists move the previous Log
-            if os.path.exists(Configuration['OUTPUTLOG']):
-                os.rename(Configuration['OUTPUTLOG'],f"{Configuration['LOG_DIRECTORY']}Previous_Log.txt")
-
-            with open(Configuration['OUTPUTLOG'],'w') as log:
-                log.write(log_statement)
-
-            #Make a dictionary for the fitsfiles we use
-            Fits_Files = {'ORIGINAL_CUBE': f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}.fits"}
-            #if we skip the create_fat _cube stage peaople could give the fat cube itself
-
-            if Fits_Files['ORIGINAL_CUBE'][-9:] == '_FAT.fits':
-                sf.print_log(f''' Your input cube ends in _FAT.fits indicating it is a FAT processed cube.
-''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
-                if 'create_fat_cube' in Configuration['FITTING_STAGES']:
-                    sf.print_log(f''' We are remove the Create_FAT_Cube stages from the loop.
-''',Configuration['OUTPUTLOG'],screen=True,debug=Configuration['DEBUG'])
-                    Configuration['FITTING_STAGES'].remove('create_fat_cube')
-                fat_ext = ''
-            else:
-                fat_ext = '_FAT'
-            Fits_Files['FITTING_CUBE'] = f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}{fat_ext}.fits"
-            Fits_Files['OPTIMIZED_CUBE'] = f"{Full_Catalogue['CUBENAME'][current_galaxy_index]}{fat_ext}_opt.fits"
-            Fits_Files['MOMENT0'] = f"{Configuration['BASE_NAME']}_mom0.fits"
-            Fits_Files['MOMENT1'] = f"{Configuration['BASE_NAME']}_mom1.fits"
-            Fits_Files['MOMENT2'] = f"{Configuration['BASE_NAME']}_mom2.fits"
-            Fits_Files['MASK'] = f"{Configuration['BASE_NAME']}_mask.fits"
-            Fits_Files['CHANNEL_MAP'] = f"{Configuration['BASE_NAME']}_chan.fits"
-            if 'create_fat_cube' in Configuration['FITTING_STAGES']:
-                if not os.path.exists(f"{Configuration['FITTING_DIR']}/{Fits_Files['ORIGINAL_CUBE']}"):
-                    raise CatalogError(f'''We can not find the file {Fits_Files['ORIGINAL_CUBE']}. This is likely to be due to a typo in your catalog.''' )
-            else:
-                if not os.path.exists(f"{Configuration['FITTING_DIR']}/{Fits_Files['FITTING_CUBE']}"):
-                    raise CatalogError(f'''We can not find the file {Fits_Files['FITTING_CUBE']}. This is likely to be due to a typo in your catalog.''' )
-
-            # run cleanup
-            cf.cleanup(Configuration,Fits_Files,debug=Configuration['DEBUG'])
-
-            # then we want to read the template
-            Tirific_Template = rf.tirific_template()
-            if Configuration['DEBUG']:
-                from numpy import __version__ as npversion
-                from scipy import __version__ as spversion
-                from astropy import __version__ as apversion
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    from matplotlib import __version__ as mpversion
-                #from subprocess import __version__ as subversion
-
-                sf.print_log(f'''MAIN: We are using the following versions
-{'':8s}NumPy {npversion}
-{'':8s}SciPy {spversion}
-{'':8s}AstroPy {apversion}
-{'':8s}Matplotlib {mpversion}
-''',Configuration['OUTPUTLOG'])
-
-
-
-            log_statement = f'''We are in loop {current_galaxy_index}. This is catalogue number {Configuration['ID_NR']} and the directory {Configuration['SUB_DIR']}.\n'''
-            sf.print_log(log_statement,Configuration['OUTPUTLOG'], screen =True)
-
-
-
-            if Configuration['TIMING']:
-                with open(f"{Configuration['LOG_DIRECTORY']}Usage_Statistics.txt",'w') as file:
-                    file.write("Creating a CPU RAM Log for analysis. \n")
-            # Check if the input cube exists
-
-
-
-
-            # Let's see if our base cube exists, Note that cleanup removes it if we want to start from the original dir so no need to check start_point
-            if not os.path.exists(f"{Configuration['FITTING_DIR']}{Fits_Files['FITTING_CUBE']}"):
-                try:
-                    ff.create_fat_cube(Configuration, Fits_Files)
-                except Exception as e:
-                    Configuration['FINAL_COMMENT'] = e
-                    if e.__class__.__name__ in stop_individual_errors:
-                        Configuration['OUTPUT_QUANTITY'] = 5
-                    else:
-                        Configuration['OUTPUT_QUANTITY'] = 'error'
-                    cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting=e)
-                    continue
-
-            # Get a bunch of info from the cube
-            rf.read_cube(Configuration,Fits_Files['FITTING_CUBE'],debug =Configuration['DEBUG'] )
-
-
-            #If we have Sofia Preprocessed Output request make sure it all exists
-            if Configuration['DEBUG']:
-                wf.write_config(f'{Configuration["LOG_DIRECTORY"]}CFG_Before_Sofia.txt',Configuration,debug = True)
-            if 'existing_sofia' in  Configuration['FITTING_STAGES']:
-                sf.copy_homemade_sofia(Configuration,debug=Configuration['DEBUG'])
-            elif 'run_sofia' in Configuration['FITTING_STAGES']:
-                # Run sofia2
-                try:
-                    runf.sofia(Configuration, Fits_Files,debug=Configuration['DEBUG'])
-                except Exception as e:
-                    Configuration['FINAL_COMMENT'] = e
-                    if e.__class__.__name__ in stop_individual_errors:
-                        Configuration['OUTPUT_QUANTITY'] = 5
-                    else:
-                        Configuration['OUTPUT_QUANTITY'] = 'error'
-                    cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting=e)
-                    continue
-            else:
-                sf.sofia_output_exists(Configuration,Fits_Files, debug = Configuration['DEBUG'])
-                    # We assume sofia is ran and created the proper files
-            try:
-
-                # Process the found source in sofia to set up the proper fitting and make sure source can be fitted
-                Initial_Parameters = runf.check_source(Configuration, Fits_Files,debug=Configuration['DEBUG'])
-                #sf.sofia_output_exists(Configuration,Fits_Files)
-
-                sf.print_log(f'''The source is well defined and we will now setup the initial tirific file
-''' ,Configuration['OUTPUTLOG'], screen =True, debug = Configuration['DEBUG'])
-                #Add your personal fitting types here
-                wf.write_config(f'{Configuration["LOG_DIRECTORY"]}CFG_Before_Fitting.txt',Configuration,debug = True)
-                # If you add any make sure that the fitstage  starts with 'Fit_'
-                if 'fit_tirific_osc' in Configuration['FITTING_STAGES']:
-                    current_run = runf.fitting_osc(Configuration,Fits_Files,Tirific_Template,Initial_Parameters)
-                elif 'fit_make_your_own' in Configuration['FITTING_STAGES']:
-                    print_log(f'If you add any fiiting routine make sure that the fit stage  starts with Fit_')
-                    Configuration['FINAL_COMMENT'] = 'This example does not work'
-                    cf.finish_galaxy(Configuration,maximum_directory_length,debug=Configuration['DEBUG'])
-                    continue
-                else:
-                    Configuration['FINAL_COMMENT'] = 'You have chosen not to do any fitting'
-                    cf.finish_galaxy(Configuration,maximum_directory_length,debug=Configuration['DEBUG'])
-                    continue
-                #cf.finish_galaxy(Configuration,maximum_directory_length, Fits_Files =Fits_Files,current_run =current_run,debug=Configuration['DEBUG'])
-                #continue
-                Configuration['FINAL_COMMENT'] = 'The fit has converged succesfully'
-
-
-            except Exception as e:
-                registered_exception = e
-                Configuration['FINAL_COMMENT'] = e
-                if e.__class__.__name__ in stop_individual_errors:
-                    Configuration['OUTPUT_QUANTITY'] = 5
-                else:
-                    Configuration['OUTPUT_QUANTITY'] = 'error'
-            cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run, Fits_Files =Fits_Files,debug = Configuration['DEBUG'],exiting=registered_exception)
-            if Configuration['OUTPUT_QUANTITY'] != 5:
-                DHI = rf.get_DHI(Configuration,Model=Configuration['USED_FITTING'],debug=Configuration['DEBUG'])
-                Totflux = rf.get_totflux(Configuration,f"/Finalmodel/Finalmodel_mom0.fits", debug=Configuration['DEBUG'])
-                wf.basicinfo(Configuration, template=Tirific_Template,Tot_Flux = Totflux, DHI = [DHI,Configuration['BEAM'][0]*Configuration['RING_SIZE']],debug=Configuration['DEBUG'] )
-                if Configuration['INSTALLATION_CHECK']:
-                    cf.installation_check(Configuration,debug=Configuration['DEBUG'])
+        galaxies = list(range(Original_Configuration['CATALOGUE_START_ID'],Original_Configuration['CATALOGUE_END_ID']))
+        if Original_Configuration['LONGEST_FIRST']:
+            galaxies = sf.schedule_galaxies(Original_Configuration,Full_Catalogue,galaxies,debug=Original_Configuration['DEBUG'])
+        fit_catalogue(Original_Configuration,Full_Catalogue,galaxies,maximum_directory_length,stop_individual_errors)
     except Exception as e:
-        registered_exception = e
-        Configuration['FINAL_COMMENT'] = e
-        Configuration['OUTPUT_QUANTITY'] = 'error'
-        cf.finish_galaxy(Configuration,maximum_directory_length,current_run =current_run,debug=Configuration['DEBUG'],exiting= registered_exception)
+        # Errors that are not caught by the galaxy functions crash the whole batch
+        sf.print_log(f'''MAIN: The batch of galaxies stopped with the error: {e}
+''',None,screen=True)
+        cf.report_crash(None,e)
 
 main.__doc__ = '''
  NAME:
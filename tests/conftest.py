@@ -0,0 +1,44 @@
+# -*- coding: future_fstrings -*-
+# Shared fixtures for the pyFAT tests
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+# read_functions has to be imported before the other support modules
+import pyFAT_astro.Support.read_functions
+
+DATA_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/data/"
+
+# The part of the FAT configuration that the tested functions use, with the directories in a temporary directory
+@pytest.fixture
+def configuration(tmp_path):
+    config = {'MAIN_DIRECTORY': f"{tmp_path}/",
+              'FITTING_DIR': f"{tmp_path}/Galaxy/",
+              'LOG_DIRECTORY': f"{tmp_path}/Galaxy/Logs/",
+              'OUTPUTLOG': f"{tmp_path}/Galaxy/Logs/Log.txt",
+              'TIRIFIC': 'tirific',
+              'TIRIFIC_RUNNING': False,
+              'TIRIFIC_PID': 'Not Initialized',
+              'TIMING': False,
+              'ITERATIONS': 0,
+              'USED_FITTING': 'Fit_Tirific_OSC',
+              'NO_POINTSOURCES': 0.,
+              'PLATEAU_LOOPS': 0,
+              'PLATEAU_TOLERANCE': 0.001,
+              'TIRIFIC_TIMEOUT': -1.,
+              'SOFIA_TIMEOUT': -1.,
+              'GALAXY_TIMEOUT': -1.,
+              'GALAXY_DEADLINE': -1.,
+              'OUTPUT_TIMEOUT': 10.,
+              'USAGE_INTERVAL': 0.1,
+              'QUEUE_HEARTBEAT': 60.,
+              'QUEUE_TIMEOUT': 600.,
+              'FITS_CACHE_SIZE': 1024.,
+              'WORKING_PRECISION': 'float64',
+              'INHOMOGENEITY_ENGINE': 'rotation',
+              'DEBUG': False,
+              }
+    os.makedirs(config['LOG_DIRECTORY'])
+    return config
@@ -0,0 +1,41 @@
+# -*- coding: future_fstrings -*-
+# Tests of the error reporting and the final bookkeeping in clean_functions
+import os
+from datetime import datetime
+
+import pytest
+
+import pyFAT_astro.Support.clean_functions as cf
+
+
+def test_report_crash_logs_traceback(configuration):
+    try:
+        raise ValueError('A broken batch')
+    except ValueError as e:
+        error = e
+    with pytest.raises(SystemExit) as exit_status:
+        cf.report_crash(configuration['OUTPUTLOG'],error)
+    assert exit_status.value.code == 1
+    with open(configuration['OUTPUTLOG']) as log:
+        content = log.read()
+    assert 'please submit the trace back as a bug report' in content
+    assert 'test_report_crash_logs_traceback' in content
+
+def test_report_crash_without_log(capsys):
+    with pytest.raises(SystemExit):
+        cf.report_crash(None,None)
+    assert 'bug report' in capsys.readouterr().out
+
+@pytest.mark.parametrize('quantity,recorded',[[4,True],[5,False]])
+def test_finish_galaxy_records_only_fitted_wall_times(configuration,monkeypatch,quantity,recorded):
+    configuration.update({'ID_NR': '3','SUB_DIR': 'Galaxy','START_TIME': datetime.now(),'OUTPUT_QUANTITY': quantity,\
+                          'FINAL_COMMENT': 'A test','ACCEPTED': True,'OUTPUT_CATALOGUE': None,'FITTING_STAGES': [],\
+                          'JOURNAL': f"{configuration['MAIN_DIRECTORY']}FAT_Journal.txt",'CONFIG_HASH': 'test'})
+    # load_tirific does not run on numpy 2 and there is no fitted model to check
+    monkeypatch.setattr(cf,'check_legitimacy',lambda Configuration,debug = False: None)
+    cf.finish_galaxy(configuration,20,Fits_Files = {'OPTIMIZED_CUBE': 'Cube_FAT.fits'})
+    wall_time_file = f"{configuration['MAIN_DIRECTORY']}FAT_Wall_Times.txt"
+    assert os.path.exists(wall_time_file) == recorded
+    if recorded:
+        with open(wall_time_file) as file:
+            assert file.read().split('|')[:2] == ['3','Galaxy']
@@ -0,0 +1,737 @@
+# -*- coding: future_fstrings -*-
+# Tests of the streaming and cached fits functions against full cube reference implementations
+import copy
+import os
+import warnings
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy import ndimage
+
+import pyFAT_astro.Support.fits_functions as ff
+
+
+# A small cube with a rotating disk on top of noise, an offset and a few blanks
+def synthetic_cube(shape = (40,24,32),offset = 0.,dtype = np.float32,seed = 1):
+    rng = np.random.default_rng(seed)
+    z,y,x = np.indices(shape)
+    velocity = 0.6*(x-shape[2]/2.)
+    disk = np.exp(-((x-shape[2]/2.)**2+(y-shape[1]/2.)**2)/50.)*\
+        np.exp(-(z-shape[0]/2.-velocity)**2/8.)
+    data = (disk+rng.normal(0.,0.05,shape)+offset).astype(dtype)
+    data[3,5:8,7:9] = np.nan
+    return data
+
+def cube_header(shape,cunit3 = 'm/s'):
+    hdr = fits.Header()
+    hdr['NAXIS'] = 3
+    for i,size in enumerate(shape[::-1]):
+        hdr[f'NAXIS{i+1}'] = size
+    for i in [1,2]:
+        hdr[f'CDELT{i}'] = (-1)**i*1./3600.
+        hdr[f'CRPIX{i}'] = shape[-i]/2.
+        hdr[f'CRVAL{i}'] = 10.
+        hdr[f'CTYPE{i}'] = ['RA---SIN','DEC--SIN'][i-1]
+        hdr[f'CUNIT{i}'] = 'deg'
+    hdr['CDELT3'] = 4000.
+    hdr['CRPIX3'] = 1.
+    hdr['CRVAL3'] = 1.2e6
+    hdr['CTYPE3'] = 'VELO-HEL'
+    hdr['CUNIT3'] = cunit3
+    hdr['BUNIT'] = 'Jy/beam'
+    return hdr
+
+# The moment maps as they were made from the full cube before the channels were streamed
+def full_cube_moments(data,mask,hdr):
+    data = np.array(data,dtype=float)
+    data[mask < 0.5] = np.nan
+    cdelt = hdr['CDELT3']/1000.
+    zaxis = hdr['CRVAL3']/1000. + (np.arange(hdr['NAXIS3'])+1 - hdr['CRPIX3']) * cdelt
+    c = np.transpose(np.resize(zaxis,[hdr['NAXIS1'],hdr['NAXIS2'],len(zaxis)]),(2,1,0))
+    moment0 = np.nansum(data, axis=0)*cdelt
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moment1 = np.nansum(data*c, axis=0)/np.nansum(data, axis=0)
+        moment2 = np.sqrt(np.nansum(data*(c-moment1)**2, axis=0)/np.nansum(data, axis=0))
+    moment1[~np.isfinite(moment1)] = np.nan
+    moment2[~np.isfinite(moment1)] = np.nan
+    return moment0,moment1,moment2
+
+@pytest.mark.parametrize('precision',['float64','float32'])
+def test_make_moments_matches_full_cube(configuration,precision):
+    configuration['WORKING_PRECISION'] = precision
+    data = synthetic_cube()
+    hdr = cube_header(data.shape)
+    mask = (data > 0.15).astype(np.int32)
+    os.makedirs(f"{configuration['FITTING_DIR']}Sofia_Output")
+    os.makedirs(f"{configuration['FITTING_DIR']}Fit_Test")
+    fits.writeto(f"{configuration['FITTING_DIR']}Sofia_Output/mask.fits",mask,hdr)
+    fits.writeto(f"{configuration['FITTING_DIR']}Fit_Test/Fit_Test.fits",data,hdr)
+    ff.make_moments(configuration,{'MASK':'mask.fits'},fit_type = 'Fit_Test')
+    for i,reference in enumerate(full_cube_moments(data,mask,hdr)):
+        moment = fits.getdata(f"{configuration['FITTING_DIR']}Fit_Test/Fit_Test_mom{i}.fits")
+        # as before the streaming only the velocity maps are float64 at double precision
+        expected = np.float64 if i > 0 and precision == 'float64' else np.float32
+        assert moment.dtype.newbyteorder('=') == expected
+        assert np.array_equal(np.isnan(moment),np.isnan(reference))
+        assert np.allclose(moment,reference,rtol=1e-5,atol=1e-5,equal_nan=True)
+
+def test_moment_sums_are_float64():
+    sums = {}
+    channel = np.full((4,4),0.1,dtype=np.float32)
+    for z in range(1000):
+        ff.add_channel_to_moments(sums,channel,1.)
+    assert sums['FLUX'].dtype == np.float64
+    assert np.allclose(sums['FLUX'],1000*np.float64(np.float32(0.1)),rtol=1e-12)
+
+def test_cached_fits_is_read_only_and_shared(configuration):
+    filename = f"{configuration['MAIN_DIRECTORY']}map.fits"
+    fits.writeto(filename,np.arange(12,dtype=np.float32).reshape(3,4))
+    first = ff.cached_fits(configuration,filename)
+    second = ff.cached_fits(configuration,filename)
+    assert np.shares_memory(first[0].data,second[0].data)
+    with pytest.raises(ValueError):
+        first[0].data[0,0] = -1.
+    first[0].header['BUNIT'] = 'Changed'
+    assert 'BUNIT' not in second[0].header
+    assert 'BUNIT' not in ff.cached_fits(configuration,filename)[0].header
+
+def test_cached_fits_scaled(configuration):
+    filename = f"{configuration['MAIN_DIRECTORY']}scaled.fits"
+    hdu = fits.PrimaryHDU(data=np.linspace(-3.,5.,24,dtype=np.float32).reshape(2,3,4))
+    hdu.scale('int16',bscale=0.01,bzero=1.)
+    hdu.writeto(filename)
+    raw = ff.cached_fits(configuration,filename)[0].data
+    scaled = ff.cached_fits(configuration,filename,scaled = True)
+    assert np.array_equal(raw,fits.getdata(filename,do_not_scale_image_data=True))
+    assert np.array_equal(scaled[0].data,fits.getdata(filename))
+    assert 'BSCALE' not in scaled[0].header
+    # scaling does not affect the cached raw data
+    assert np.array_equal(ff.cached_fits(configuration,filename)[0].data,raw)
+
+def test_cutout_cube_does_not_alias_the_cache(configuration):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    data = synthetic_cube()
+    fits.writeto(f"{configuration['FITTING_DIR']}cube.fits",data,cube_header(data.shape))
+    sub_cube = np.array([[2,30],[4,20],[3,29]])
+    cut = ff.cutout_cube(configuration,'cube.fits',sub_cube)
+    assert np.array_equal(cut[0].data,data[2:30,4:20,3:29],equal_nan=True)
+    with pytest.raises(ValueError):
+        cut[0].data[0,0,0] = 0.
+    cut[0].header['CRPIX1'] = -100.
+    cached = ff.cached_fits(configuration,f"{configuration['FITTING_DIR']}cube.fits")
+    assert cached[0].header['CRPIX1'] == cube_header(data.shape)['CRPIX1']-3
+    assert np.array_equal(cached[0].data,data[2:30,4:20,3:29],equal_nan=True)
+
+@pytest.mark.parametrize('offset',[0.,1e4])
+def test_channel_statistics_match_nanstd(offset):
+    data = synthetic_cube(shape = (12,20,24),offset = offset)*np.float32(1e-2)
+    data[5,:,:] = np.nan
+    data[7,:3,:4] = 0.
+    # a slab size below a channel forces a slab per channel, the default reads the cube at once
+    for slab_size in [1e-3,64.]:
+        statistics = ff.channel_statistics(data,slab_size = slab_size)
+        reference = np.array(data,dtype=float)
+        reference[reference == 0.] = np.nan
+        with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+            expected = np.nanstd(reference,axis=(1,2))
+        assert statistics['ZEROS'][7] == 12
+        assert np.allclose(ff.std_from_deviations(statistics['N'],statistics['M2']),expected,\
+                           rtol=1e-10,equal_nan=True)
+        # the corners are combined over the channels that are kept
+        corners = [reference[2:10,:6,-6:],reference[2:10,-6:,-6:],reference[2:10,:6,:6],reference[2:10,-6:,:6]]
+        n,mean,m2 = ff.merge_statistics(statistics['CORNER_N'][:,2:10],statistics['CORNER_MEAN'][:,2:10],\
+                                        statistics['CORNER_M2'][:,2:10])
+        assert np.allclose(mean,[np.nanmean(x) for x in corners],rtol=1e-12)
+        assert np.allclose(ff.std_from_deviations(n,m2),[np.nanstd(x) for x in corners],rtol=1e-10)
+
+def test_merge_statistics_ignores_empty_sets():
+    values = [np.array([1.,2.,4.]),np.array([]),np.array([1e8+1.,1e8-1.])]
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        n,mean,m2 = ff.merge_statistics([x.size for x in values],[np.mean(x) for x in values],\
+                                        [np.sum((x-np.mean(x))**2) for x in values])
+    assert n == 5
+    assert np.isclose(ff.std_from_deviations(n,m2),np.std(np.concatenate(values)),rtol=1e-12)
+    assert np.isnan(ff.std_from_deviations(0,0.))
+
+def test_remove_statistics_matches_merging_the_rest():
+    rng = np.random.default_rng(5)
+    values = [rng.normal(1e6,3.,size=(4,size)) for size in [30,0,25,40,12,33,0,28]]
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        mean = np.array([np.mean(x,axis=1) for x in values]).T
+        m2 = np.array([np.sum((x-np.mean(x,axis=1)[:,None])**2,axis=1) for x in values]).T
+    n = np.array([[x.shape[1]]*4 for x in values]).T
+    total = ff.merge_statistics(n,mean,m2)
+    first,last = 0,len(values)-1
+    # take sets from both ends as prep_cube does
+    for end in ['first','last','first','first','last','last']:
+        if end == 'first':
+            total = ff.remove_statistics(*total,n[:,first],mean[:,first],m2[:,first])
+            first += 1
+        else:
+            total = ff.remove_statistics(*total,n[:,last],mean[:,last],m2[:,last])
+            last -= 1
+        expected = ff.merge_statistics(n[:,first:last+1],mean[:,first:last+1],m2[:,first:last+1])
+        assert np.array_equal(total[0],expected[0])
+        assert np.allclose(total[1],expected[1],rtol=1e-14)
+        assert np.allclose(total[2],expected[2],rtol=1e-9)
+    # removing the last sets leaves nothing
+    for channel in range(first,last+1):
+        total = ff.remove_statistics(*total,n[:,channel],mean[:,channel],m2[:,channel])
+    assert np.all(total[0] == 0) and np.all(total[2] == 0.)
+    assert np.all(np.isnan(ff.std_from_deviations(total[0],total[2])))
+
+def test_read_cube_section(tmp_path):
+    data = synthetic_cube()
+    hdr = cube_header(data.shape)
+    filename = f"{tmp_path}/cube.fits"
+    fits.writeto(filename,data,hdr)
+    full,full_hdr = ff.read_cube_section(filename)
+    assert np.array_equal(full,data,equal_nan=True)
+    assert full_hdr['NAXIS3'] == data.shape[0]
+    for section in [(slice(2,7),slice(None),slice(None)),\
+                    (slice(None),slice(4,-3),slice(1,30,2)),\
+                    (slice(-5,None),slice(0,100),slice(10,11))]:
+        part,part_hdr = ff.read_cube_section(filename,section)
+        assert np.array_equal(part,data[section],equal_nan=True)
+        # the header describes the full file
+        assert part_hdr == full_hdr
+        part[:] = 0.
+    assert np.array_equal(fits.getdata(filename),data,equal_nan=True)
+
+@pytest.mark.parametrize('memmap',[True,False])
+def test_cube_nanmax_matches_nanmax(tmp_path,memmap):
+    data = synthetic_cube(dtype=np.float64)
+    data[17,12,16] = 42.
+    filename = f"{tmp_path}/cube.fits"
+    fits.writeto(filename,data,cube_header(data.shape))
+    Cube = ff.open_cube(filename, memmap = memmap)
+    # slabs of a few channels such that the maximum is taken over several slabs
+    slab_size = 3.5*data.shape[1]*data.shape[2]*8./1024.**2
+    assert ff.cube_nanmax(Cube, slab_size = slab_size) == np.nanmax(data) == 42.
+    assert ff.cube_nanmax(Cube) == np.nanmax(data)
+    Cube.close()
+
+def test_cube_nanmax_of_blank_cube(tmp_path):
+    data = np.full((5,4,4),np.nan,dtype=np.float32)
+    filename = f"{tmp_path}/cube.fits"
+    fits.writeto(filename,data,cube_header(data.shape))
+    Cube = ff.open_cube(filename)
+    assert np.isnan(ff.cube_nanmax(Cube, slab_size = 1e-4))
+    Cube.close()
+
+# The channel trimming of prep_cube as it was done on the full cube in memory, without the logging
+def baseline_prep_cube(hdr,data):
+    if hdr['CDELT3'] < -1:
+        hdr['CDELT3'] = abs(hdr['CDELT3'])
+        hdr['CRPIX3'] = hdr['NAXIS3']-hdr['CRPIX3']+1
+        data = data[::-1,:,:]
+    data[np.where(data == 0.)] = float('NaN')
+    cube_ok = False
+    prev_first_comparison = 0.
+    prev_last_comparison = 0.
+    times_cut_first_channel = 0
+    times_cut_last_channel = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        while not cube_ok:
+            while np.isnan(data[0,:,:]).all():
+                data=data[1:,:,:]
+                hdr['NAXIS3'] = hdr['NAXIS3']-1
+            while np.isnan(data[-1,:,:]).all():
+                data=data[:-1,:,:]
+                hdr['NAXIS3'] = hdr['NAXIS3']-1
+            noise_first_channel = np.nanstd(data[0,:,:])
+            noise_last_channel = np.nanstd(data[-1,:,:])
+            noise_bottom_right =  np.nanstd(data[:,:6,-6:])
+            noise_top_right =  np.nanstd(data[:,-6:,-6:])
+            noise_bottom_left =  np.nanstd(data[:,:6,:6])
+            noise_top_left =  np.nanstd(data[:,-6:,:6])
+            noise_corner = np.nanmean([noise_top_right,noise_bottom_right,noise_bottom_left,noise_top_left])
+            channel_noise = np.nanmean([noise_first_channel,noise_last_channel])
+            if ~np.isfinite(noise_corner):
+                noise_corner = copy.deepcopy(channel_noise)
+            difference = abs((noise_first_channel-noise_last_channel)/noise_first_channel)
+            if noise_corner/channel_noise >1.5 and difference < 0.2:
+                noise_corner = copy.deepcopy(channel_noise)
+            difference2 = abs(channel_noise-noise_corner)/channel_noise
+            if difference < 0.2 and np.isfinite(difference) and difference2 < 0.25:
+                cube_ok = True
+            else:
+                first_comparison = abs(noise_first_channel-noise_corner)/noise_corner
+                last_comparison = abs(noise_last_channel-noise_corner)/noise_corner
+                if prev_first_comparison == 0:
+                    prev_first_comparison = first_comparison
+                if prev_last_comparison == 0.:
+                    prev_last_comparison = last_comparison
+                if (first_comparison > last_comparison and \
+                   abs((first_comparison-prev_first_comparison)/first_comparison) >= abs((last_comparison-prev_last_comparison)/last_comparison) and \
+                   times_cut_first_channel < 0.1*hdr['NAXIS3']) or \
+                   ~np.isfinite(noise_first_channel):
+                    prev_first_comparison = first_comparison
+                    times_cut_first_channel += 1
+                    data=data[1:,:,:]
+                    hdr['CRPIX3'] = hdr['CRPIX3'] - 1
+                    hdr['NAXIS3'] = hdr['NAXIS3'] - 1
+                else:
+                    if times_cut_last_channel < 0.1*hdr['CRPIX3'] or \
+                        ~np.isfinite(noise_last_channel):
+                        prev_last_comparison = last_comparison
+                        times_cut_last_channel += 1
+                        data=data[:-1,:,:]
+                        hdr['NAXIS3'] = hdr['NAXIS3'] - 1
+                    else:
+                        cube_ok = True
+                if times_cut_first_channel >= 8 and times_cut_last_channel >= 8:
+                    cube_ok = True
+        hdr['FATNOISE'] = noise_corner
+        data[np.where(data < -10*noise_corner)] = float('NaN')
+    blanked_channels = []
+    for z in range(hdr['NAXIS3']):
+        if np.isnan(data[z,:,:]).all():
+            blanked_channels.append(str(z))
+    if len(blanked_channels) == 0.:
+        blanked_channels = ['-1']
+    hdr['BL_CHAN'] = ','.join(blanked_channels)
+    return data
+
+def untrimmed_cube():
+    data = synthetic_cube(shape = (30,24,32),dtype = np.float64)
+    data[10,:4,:5] = 0.
+    data[12,20,20] = -5.
+    return data
+
+def cube_with_bad_edges():
+    data = untrimmed_cube()
+    rng = np.random.default_rng(3)
+    data[:3] += rng.normal(0.,0.2,data[:3].shape)
+    data[-2:] *= 0.2
+    return data
+
+def cube_with_blank_channels():
+    data = untrimmed_cube()
+    data[-2:] = np.nan
+    data[14] = -1.
+    return data
+
+def cube_with_leading_blanks():
+    data = untrimmed_cube()
+    data[:2] = np.nan
+    return data
+
+@pytest.mark.parametrize('make_cube,cdelt3',[[untrimmed_cube,4000.],[cube_with_bad_edges,4000.],\
+                         [cube_with_bad_edges,-4000.],[cube_with_blank_channels,4000.],\
+                         [cube_with_leading_blanks,4000.]])
+def test_prep_cube_matches_full_cube(configuration,make_cube,cdelt3):
+    data = make_cube()
+    hdr = fits.PrimaryHDU(data=data).header
+    hdr.update(cube_header(data.shape))
+    hdr['CDELT3'] = cdelt3
+    hdr['CRPIX3'] = 3.
+    expected_hdr = copy.deepcopy(hdr)
+    expected = baseline_prep_cube(expected_hdr,np.array(data))
+    trimmed = ff.prep_cube(configuration,hdr,data)
+    # the data are not modified, the blanking is done when the cube is written
+    assert np.array_equal(data,make_cube(),equal_nan=True)
+    filename = f"{configuration['MAIN_DIRECTORY']}cube.fits"
+    ff.write_fat_cube(filename,hdr,trimmed)
+    assert np.array_equal(fits.getdata(filename),expected,equal_nan=True)
+    for key in ['NAXIS3','CDELT3','BL_CHAN']:
+        assert hdr[key] == expected_hdr[key]
+    # unlike the full cube version the reference pixel follows the cut blank leading channels
+    ordered = data if cdelt3 > 0 else data[::-1]
+    leading = np.argmax(~np.all(np.isnan(ordered),axis=(1,2)))
+    assert hdr['CRPIX3'] == expected_hdr['CRPIX3']-leading
+    assert np.isclose(hdr['FATNOISE'],expected_hdr['FATNOISE'],rtol=1e-10)
+
+def test_prep_cube_shifts_the_reference_for_leading_blanks(configuration):
+    data = cube_with_leading_blanks()
+    hdr = fits.PrimaryHDU(data=data).header
+    hdr.update(cube_header(data.shape))
+    hdr['CRPIX3'] = 3.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        velocities = WCS(hdr).spectral.pixel_to_world_values(np.arange(data.shape[0]))
+    trimmed = ff.prep_cube(configuration,hdr,data)
+    assert hdr['NAXIS3'] == trimmed.shape[0] == data.shape[0]-2
+    assert np.array_equal(trimmed,data[2:],equal_nan=True)
+    # every kept channel stays on its velocity
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        kept = WCS(hdr).spectral.pixel_to_world_values(np.arange(trimmed.shape[0]))
+    assert np.allclose(kept,velocities[2:])
+    with open(configuration['OUTPUTLOG']) as file:
+        assert 'The reference pixel of the velocity axis is shifted with it.' in file.read()
+
+@pytest.mark.parametrize('make_cube',[cube_with_bad_edges,cube_with_blank_channels,cube_with_leading_blanks])
+def test_prep_cube_merges_the_corners_once(configuration,monkeypatch,make_cube):
+    merges = []
+    merge_statistics = ff.merge_statistics
+    def count_merges(n,mean,m2,**kwargs):
+        merges.append(np.shape(n))
+        return merge_statistics(n,mean,m2,**kwargs)
+    monkeypatch.setattr(ff,'merge_statistics',count_merges)
+    data = make_cube()
+    hdr = fits.PrimaryHDU(data=data).header
+    hdr.update(cube_header(data.shape))
+    expected_hdr = copy.deepcopy(hdr)
+    baseline_prep_cube(expected_hdr,np.array(data))
+    trimmed = ff.prep_cube(configuration,hdr,data)
+    assert trimmed.shape[0] < data.shape[0]
+    # the corners of all channels are merged once, the cut channels are taken out one by one
+    assert merges == [(4,data.shape[0])]
+    assert np.isclose(hdr['FATNOISE'],expected_hdr['FATNOISE'],rtol=1e-10)
+
+def sofia_output(configuration,data,hdr):
+    os.makedirs(f"{configuration['FITTING_DIR']}Sofia_Output")
+    configuration['SOFIA_RAN'] = True
+    configuration['BASE_NAME'] = 'Galaxy'
+    # two sources in the mask, the second is the one we fit
+    mask = np.zeros(data.shape,dtype=np.int32)
+    mask[data > 0.15] = 2
+    mask[:,:4,:6] = 1
+    fits.writeto(f"{configuration['FITTING_DIR']}Sofia_Output/mask.fits",mask,hdr)
+    fits.writeto(f"{configuration['FITTING_DIR']}cube.fits",data,hdr)
+    return mask,{'MASK':'mask.fits','FITTING_CUBE':'cube.fits'}
+
+@pytest.mark.parametrize('precision',['float64','float32'])
+def test_check_mask_matches_full_cube(configuration,precision):
+    configuration['WORKING_PRECISION'] = precision
+    data = synthetic_cube()
+    hdr = cube_header(data.shape)
+    mask,Fits_Files = sofia_output(configuration,data,hdr)
+    ff.check_mask(configuration,'2',Fits_Files)
+    directory = f"{configuration['FITTING_DIR']}Sofia_Output/"
+    # as before the mask only contains the selected source
+    expected_mask = np.array(mask)
+    expected_mask[expected_mask != 2] = 0
+    clean_mask = fits.getdata(f"{directory}mask.fits")
+    assert np.array_equal(clean_mask,expected_mask)
+    assert not os.path.exists(f"{directory}mask.fits.clean")
+    chan_map = fits.getdata(f"{directory}Galaxy_chan.fits")
+    # as before writeto ignores the BITPIX of the header
+    assert chan_map.dtype.newbyteorder('=') == np.dtype(precision)
+    assert np.array_equal(chan_map,np.sum(expected_mask > 0.5,axis=0))
+    for i,reference in enumerate(full_cube_moments(data,expected_mask,hdr)):
+        moment = fits.getdata(f"{directory}Galaxy_mom{i}.fits")
+        assert np.array_equal(np.isnan(moment),np.isnan(reference))
+        assert np.allclose(moment,reference,rtol=1e-5,atol=1e-5,equal_nan=True)
+
+def test_check_mask_without_the_source(configuration):
+    data = synthetic_cube()
+    mask,Fits_Files = sofia_output(configuration,data,cube_header(data.shape))
+    with pytest.raises(ff.BadMaskError):
+        ff.check_mask(configuration,'3',Fits_Files)
+    directory = f"{configuration['FITTING_DIR']}Sofia_Output/"
+    assert np.array_equal(fits.getdata(f"{directory}mask.fits"),mask)
+    assert not os.path.exists(f"{directory}mask.fits.clean")
+
+def test_working_dtype(configuration):
+    for dtype in [np.float64,np.float32,np.int32]:
+        assert ff.working_dtype(configuration,dtype) == dtype
+        assert ff.working_dtype(configuration,dtype,limits=[0,2]) == dtype
+    configuration['WORKING_PRECISION'] = 'float32'
+    assert ff.working_dtype(configuration,np.float64) == np.float32
+    assert ff.working_dtype(configuration,np.dtype('>f8')) == np.float32
+    assert ff.working_dtype(configuration,np.float32) == np.float32
+    # integers are only compacted when their limits are known
+    assert ff.working_dtype(configuration,np.int64) == np.int64
+    assert ff.working_dtype(configuration,np.int64,limits=[0,200]) == np.uint8
+    assert ff.working_dtype(configuration,np.int64,limits=[-1,200]) == np.int16
+    assert ff.working_dtype(configuration,np.int64,limits=[0,70000]) == np.int32
+    assert ff.working_dtype(configuration,np.int64,limits=[0,2**40]) == np.int64
+
+def test_check_mask_writes_a_compact_mask(configuration):
+    configuration['WORKING_PRECISION'] = 'float32'
+    data = synthetic_cube()
+    mask,Fits_Files = sofia_output(configuration,data,cube_header(data.shape))
+    ff.check_mask(configuration,'2',Fits_Files)
+    clean_mask = fits.getdata(f"{configuration['FITTING_DIR']}Sofia_Output/mask.fits")
+    assert clean_mask.dtype == np.uint8
+    assert np.array_equal(clean_mask,np.where(mask == 2,2,0))
+
+# The PV diagram as it was interpolated from a copy of the full cube with a coordinate list
+def baseline_extract_pv(Configuration,cube_in,angle,center=[-1,-1,-1],finalsize=[-1,-1],convert=-1):
+    cube = copy.deepcopy(cube_in)
+    hdr = copy.deepcopy(cube[0].header)
+    TwoD_hdr= copy.deepcopy(cube[0].header)
+    data = copy.deepcopy(cube[0].data)
+    try:
+        if hdr['CUNIT3'].lower() == 'km/s':
+            hdr['CUNIT3'] = 'm/s'
+            hdr['CDELT3'] = hdr['CDELT3']*1000.
+            hdr['CRVAL3'] = hdr['CRVAL3']*1000.
+        elif hdr['CUNIT3'].lower() == 'm/s':
+            hdr['CUNIT3'] = 'm/s'
+    except KeyError:
+        hdr['CUNIT3'] = 'm/s'
+    if center[0] == -1:
+        center = [hdr['CRVAL1'],hdr['CRVAL2'],hdr['CRVAL3']]
+        xcenter,ycenter,zcenter = hdr['CRPIX1'],hdr['CRPIX2'],hdr['CRPIX3']
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            coordinate_frame = WCS(hdr)
+        xcenter,ycenter,zcenter = coordinate_frame.wcs_world2pix(center[0], center[1], center[2], 1.)
+    nz, ny, nx = data.shape
+    if finalsize[0] != -1:
+        if finalsize[1] >nz:
+            finalsize[1] = nz
+        if finalsize[0] > nx:
+            finalsize[0] = nx
+    x1,x2,y1,y2 = ff.obtain_border_pix(Configuration,angle,[xcenter,ycenter])
+    linex,liney,linez = np.linspace(x1,x2,nx), np.linspace(y1,y2,nx), np.linspace(0,nz-1,nz)
+    new_coordinates = np.array([(z,y,x)
+                        for z in linez
+                        for y,x in zip(liney,linex)
+                        ],dtype=float).transpose().reshape((-1,nz,nx))
+    PV = ndimage.map_coordinates(data, new_coordinates,order=1)
+    if hdr['CDELT1'] < 0:
+        PV = PV[:,::-1]
+    if finalsize[0] == -1:
+        TwoD_hdr['NAXIS2'] = nz
+        TwoD_hdr['NAXIS1'] = nx
+        TwoD_hdr['CRPIX2'] = hdr['CRPIX3']
+        if convert !=-1:
+            TwoD_hdr['CRVAL2'] = hdr['CRVAL3']/convert
+        else:
+            TwoD_hdr['CRVAL2'] = hdr['CRVAL3']
+        TwoD_hdr['CRPIX1'] = xcenter+1
+    else:
+        zstart = ff.set_limits(int(zcenter-finalsize[1]/2.),0,int(nz))
+        zend = ff.set_limits(int(zcenter+finalsize[1]/2.),0,int(nz))
+        xstart = ff.set_limits(int(xcenter-finalsize[0]/2.),0,int(nx))
+        xend = ff.set_limits(int(xcenter+finalsize[0]/2.),0,int(nx))
+        PV =  PV[zstart:zend, xstart:xend]
+        TwoD_hdr['NAXIS2'] = int(finalsize[1])
+        TwoD_hdr['NAXIS1'] = int(finalsize[0])
+        TwoD_hdr['CRPIX2'] = hdr['CRPIX3']-int(nz/2.-finalsize[1]/2.)
+        if convert !=-1:
+            TwoD_hdr['CRVAL2'] = hdr['CRVAL3']/convert
+        else:
+            TwoD_hdr['CRVAL2'] = hdr['CRVAL3']
+        TwoD_hdr['CRPIX1'] = int(finalsize[0]/2.)+1
+    if convert !=-1:
+        TwoD_hdr['CDELT2'] = hdr['CDELT3']/convert
+    else:
+        TwoD_hdr['CDELT2'] = hdr['CDELT3']
+    TwoD_hdr['CTYPE2'] = hdr['CTYPE3']
+    try:
+        if hdr['CUNIT3'].lower() == 'm/s' and convert == -1:
+            TwoD_hdr['CDELT2'] = hdr['CDELT3']/1000.
+            TwoD_hdr['CRVAL2'] = hdr['CRVAL3']/1000.
+            TwoD_hdr['CUNIT2'] = 'km/s'
+            del (TwoD_hdr['CUNIT3'])
+        elif  convert != -1:
+            del (TwoD_hdr['CUNIT3'])
+            del (TwoD_hdr['CUNIT2'])
+        else:
+            TwoD_hdr['CUNIT2'] = hdr['CUNIT3']
+            del (TwoD_hdr['CUNIT3'])
+    except:
+        pass
+    del (TwoD_hdr['CRPIX3'])
+    del (TwoD_hdr['CRVAL3'])
+    del (TwoD_hdr['CDELT3'])
+    del (TwoD_hdr['CTYPE3'])
+    del (TwoD_hdr['NAXIS3'])
+    TwoD_hdr['CRVAL1'] = 0.
+    TwoD_hdr['CDELT1'] = np.sqrt(((x2-x1)*abs(hdr['CDELT1'])/nx)**2+((y2-y1)*abs(hdr['CDELT2'])/nx)**2)*3600.
+    TwoD_hdr['CTYPE1'] = 'OFFSET'
+    TwoD_hdr['CUNIT1'] = 'ARCSEC'
+    TwoD_hdr['HISTORY'] = f'EXTRACT_PV: PV diagram extracted with angle {angle} and center {center}'
+    cube[0].header = TwoD_hdr
+    cube[0].data = PV
+    return cube
+
+@pytest.mark.parametrize('memmap,read_section',[[True,False],[True,True],[False,True]])
+@pytest.mark.parametrize('cdelt1',[-1./3600.,1./3600.])
+def test_extract_pv_matches_full_cube(configuration,tmp_path,memmap,read_section,cdelt1):
+    data = synthetic_cube(shape = (30,32,32))
+    hdr = fits.PrimaryHDU(data=data).header
+    hdr.update(cube_header(data.shape,cunit3 = 'km/s'))
+    hdr['CRVAL3'] = 1200.
+    hdr['CDELT3'] = 4.
+    hdr['CDELT1'] = cdelt1
+    filename = f"{tmp_path}/cube.fits"
+    fits.writeto(filename,data,hdr)
+    configuration['NAXES'] = [hdr['NAXIS1'],hdr['NAXIS2'],hdr['NAXIS3']]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        world = WCS(hdr).wcs_pix2world(14.3,17.8,12.,1)
+    for angle in [0.,35.,90.,137.,250.]:
+        for center in [[-1,-1,-1],[float(x) for x in world]]:
+            for finalsize in [[-1,-1],[20,16],[64,64],[9,40]]:
+                for convert in [-1,1000.]:
+                    Cube = ff.open_cube(filename,memmap = memmap)
+                    expected = baseline_extract_pv(configuration,Cube,angle,center = center,\
+                        finalsize = copy.deepcopy(finalsize),convert = convert)
+                    PV = ff.extract_pv(configuration,Cube,angle,center = center,\
+                        finalsize = copy.deepcopy(finalsize),convert = convert,read_section = read_section)
+                    assert PV[0].data.shape == expected[0].data.shape
+                    assert np.array_equal(PV[0].data,expected[0].data,equal_nan=True)
+                    assert PV[0].header == expected[0].header
+                    # the cube itself is not changed
+                    assert Cube[0].header['NAXIS'] == 3
+                    Cube.close()
+
+def test_extract_pv_uses_changes_in_memory(configuration,tmp_path):
+    data = synthetic_cube(shape = (20,24,24))
+    hdr = fits.PrimaryHDU(data=data).header
+    hdr.update(cube_header(data.shape))
+    filename = f"{tmp_path}/cube.fits"
+    fits.writeto(filename,data,hdr)
+    configuration['NAXES'] = [hdr['NAXIS1'],hdr['NAXIS2'],hdr['NAXIS3']]
+    Cube = ff.open_cube(filename,memmap = False)
+    Cube[0].data = Cube[0].data*2.
+    PV = ff.extract_pv(configuration,Cube,35.)
+    expected = baseline_extract_pv(configuration,Cube,35.)
+    assert np.array_equal(PV[0].data,expected[0].data,equal_nan=True)
+    # the file itself is read when asked
+    PV = ff.extract_pv(configuration,Cube,35.,read_section = True)
+    assert np.allclose(PV[0].data*2.,expected[0].data,equal_nan=True)
+    Cube.close()
+
+# The regridding as it was done by interpolating the full cube with map_coordinates
+def baseline_regridder(oldarray, newshape):
+    oldshape = np.array(oldarray.shape)
+    newshape = np.array(newshape, dtype=float)
+    ratios = oldshape/newshape
+    nslices = [ slice(0,j) for j in list(newshape) ]
+    new_coordinates = np.mgrid[nslices]
+    for i in range(len(ratios)):
+        new_coordinates[i] *= ratios[i]
+    return ndimage.map_coordinates(oldarray, new_coordinates,order=1)
+
+def baseline_regrid_cube(data,hdr,ratio):
+    regrid_hdr = copy.deepcopy(hdr)
+    shape = np.array(data.shape, dtype=float)
+    new_shape = [int(x/ratio) for x in shape]
+    real_ratio = shape/new_shape
+    new_shape[0] = shape[0]
+    regrid_data = baseline_regridder(data,new_shape)
+    regrid_hdr['CRPIX1'] =   (regrid_hdr['CRPIX1']-1)/real_ratio[2]+1
+    regrid_hdr['CRPIX2'] =   (regrid_hdr['CRPIX2']-1)/real_ratio[1]+1
+    regrid_hdr['CDELT1'] =   regrid_hdr['CDELT1']*real_ratio[2]
+    regrid_hdr['CDELT2'] =   regrid_hdr['CDELT2']*real_ratio[1]
+    regrid_hdr['NAXIS1'] =   new_shape[2]
+    regrid_hdr['NAXIS2'] =   new_shape[1]
+    return regrid_data,regrid_hdr
+
+@pytest.mark.parametrize('ratio',[1.37,2.6,3.5])
+def test_regrid_cube_matches_map_coordinates(ratio):
+    data = synthetic_cube(shape = (7,45,52),dtype = np.float64)
+    data[3,5:8,7:9] = 1.
+    hdr = cube_header(data.shape)
+    expected,expected_hdr = baseline_regrid_cube(data,hdr,ratio)
+    old,old_hdr = ff.regrid_cube(data,hdr,ratio,engine = 'map_coordinates')
+    assert np.array_equal(old,expected)
+    assert old_hdr == expected_hdr
+    # a slab size below a channel regrids a channel at a time
+    for slab_size in [1e-3,4.]:
+        new,new_hdr = ff.regrid_cube(data,hdr,ratio,slab_size = slab_size)
+        assert new.shape == expected.shape and new.dtype == expected.dtype
+        assert np.allclose(new,expected,rtol=1e-12,atol=1e-13)
+        assert new_hdr == expected_hdr
+    new,new_hdr = ff.regrid_cube(data.astype(np.float32),hdr,ratio,dtype = np.float32)
+    assert new.dtype == np.float32
+    assert np.allclose(new,expected,rtol=1e-5,atol=1e-6)
+
+# 81 pixels in 40 bins drops the last pixel, 2.98 gives exactly 12 and 15 bins of 3 pixels
+@pytest.mark.parametrize('shape,ratio,factor',[[(5,81,40),2.,2],[(5,36,45),2.98,3]])
+def test_regrid_cube_bins_integer_ratios(shape,ratio,factor):
+    data = synthetic_cube(shape = shape,dtype = np.float64)
+    hdr = cube_header(data.shape)
+    new,new_hdr = ff.regrid_cube(data,hdr,ratio)
+    ny,nx = data.shape[1]//factor,data.shape[2]//factor
+    assert new.shape == (data.shape[0],ny,nx)
+    blocks = data[:,:ny*factor,:nx*factor].reshape(data.shape[0],ny,factor,nx,factor)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = np.nanmean(blocks,axis=(2,4))
+    assert np.allclose(new,expected,rtol=1e-12,equal_nan=True)
+    # the blanks in channel 3 only count where a whole block is blank
+    assert np.array_equal(np.isnan(new),np.all(np.isnan(blocks),axis=(2,4)))
+    # the new pixels are at the centres of the blocks
+    offset = (factor-1)/2.
+    for axis in [1,2]:
+        assert np.isclose((new_hdr[f'CRPIX{axis}']-1)*factor+offset,hdr[f'CRPIX{axis}']-1,rtol=1e-12)
+        assert np.isclose(new_hdr[f'CDELT{axis}'],hdr[f'CDELT{axis}']*factor,rtol=1e-12)
+
+def test_regrid_axis():
+    data = np.random.default_rng(5).normal(size=(3,23))
+    # an interpolation at the positions of regridder
+    new,ratio,offset,count = ff.regrid_axis(data,1,10)
+    assert ratio == 2.3 and offset == 0. and count is None
+    expected = np.array([np.interp(np.arange(10)*2.3,np.arange(23),row) for row in data])
+    assert np.allclose(new,expected,rtol=1e-12,atol=1e-14)
+    # integer data are averaged in floats
+    new,ratio,offset,count = ff.regrid_axis(np.arange(12).reshape(2,6),1,3)
+    assert ratio == 2. and offset == 0.5 and count is None
+    assert np.array_equal(new,[[0.5,2.5,4.5],[6.5,8.5,10.5]])
+    # nothing to do for an unchanged or a single pixel axis
+    assert ff.regrid_axis(data,1,23)[0] is data
+    assert ff.regrid_axis(data[:,:1],1,1)[1:] == (1.,0.,None)
+
+def test_regrid_axis_weighs_partially_blank_blocks():
+    data = np.array([[1.,np.nan,5.,7.],[3.,np.nan,np.nan,np.nan]])
+    new,ratio,offset,count = ff.regrid_axis(data,0,1)
+    assert np.array_equal(new,[[2.,np.nan,5.,7.]],equal_nan=True)
+    assert np.array_equal(count,[[2,0,1,1]])
+    new,ratio,offset,count = ff.regrid_axis(new,1,2,count = count)
+    # the averages of the valid pixels in the 2x2 blocks
+    assert np.array_equal(new,[[2.,6.]])
+    assert np.array_equal(count,[[2,2]])
+
+def preprocessing_products(configuration,shape = (40,60,64)):
+    directory = configuration['FITTING_DIR']
+    os.makedirs(f"{directory}Sofia_Output",exist_ok=True)
+    data = synthetic_cube(shape = shape)
+    hdr = cube_header(data.shape)
+    products = {'cube.fits': data,'Sofia_Output/mask.fits': (data > 0.15).astype(np.int32)}
+    for i,name in enumerate(['mom0','mom1','mom2','chan']):
+        products[f'Sofia_Output/{name}.fits'] = np.nansum(data,axis=0)*(i+1)
+    for name in products:
+        product_hdr = copy.deepcopy(hdr)
+        if products[name].ndim == 2:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                product_hdr = WCS(hdr).celestial.to_header()
+        fits.writeto(f"{directory}{name}",products[name],product_hdr)
+    configuration.update({'NAXES': [shape[2],shape[1],shape[0]],'BEAM_IN_PIXELS': [2.,2.,4.5],\
+                          'OPT_PIXEL_BEAM': 4})
+    Fits_Files = {'FITTING_CUBE': 'cube.fits','MASK': 'mask.fits','MOMENT0': 'mom0.fits','MOMENT1': 'mom1.fits',\
+                  'MOMENT2': 'mom2.fits','CHANNEL_MAP': 'chan.fits','OPTIMIZED_CUBE': 'cube_opt.fits'}
+    return products,Fits_Files
+
+def test_cut_cubes_matches_the_files(configuration):
+    products,Fits_Files = preprocessing_products(configuration)
+    headers = {name: fits.getheader(f"{configuration['FITTING_DIR']}{name}") for name in products}
+    galaxy_box = [[10,30],[20,45],[15,50]]
+    new_cube,cut_products = ff.cut_cubes(configuration,Fits_Files,galaxy_box)
+    # six channels and five beams around the galaxy
+    assert np.array_equal(new_cube,[[4,36],[10,55],[5,60]])
+    assert configuration['NAXES'] == [55,45,32]
+    assert sorted(cut_products) == sorted(products)
+    for name in products:
+        section = (slice(4,36),slice(10,55),slice(5,60))[3-products[name].ndim:]
+        expected = products[name][section]
+        on_disk = fits.getdata(f"{configuration['FITTING_DIR']}{name}")
+        assert np.array_equal(on_disk,expected,equal_nan=True)
+        assert np.issubdtype(on_disk.dtype,np.integer) == np.issubdtype(products[name].dtype,np.integer)
+        assert np.array_equal(cut_products[name][0].data,on_disk,equal_nan=True)
+        hdr = fits.getheader(f"{configuration['FITTING_DIR']}{name}")
+        assert hdr['CRPIX1'] == headers[name]['CRPIX1']-5
+        assert hdr['CRPIX2'] == headers[name]['CRPIX2']-10
+        if products[name].ndim == 3:
+            assert hdr['CRPIX3'] == headers[name]['CRPIX3']-4
+
+def test_cut_cubes_leaves_a_snug_cube(configuration):
+    products,Fits_Files = preprocessing_products(configuration)
+    new_cube,cut_products = ff.cut_cubes(configuration,Fits_Files,[[3,37],[5,55],[8,56]])
+    assert np.array_equal(new_cube,[[0,40],[0,60],[0,64]])
+    assert cut_products == {}
+    for name in products:
+        assert np.array_equal(fits.getdata(f"{configuration['FITTING_DIR']}{name}"),products[name],equal_nan=True)
@@ -0,0 +1,113 @@
+# -*- coding: future_fstrings -*-
+# Tests of the batch drivers in main
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import pyFAT_astro.main as main
+import pyFAT_astro.Support.support_functions as sf
+
+
+# The main settings of a batch that the drivers use
+@pytest.fixture
+def batch_configuration(configuration):
+    configuration.update({'WORK_QUEUE': False,'PARALLEL_GALAXIES': 1,'PREFETCH_GALAXIES': 0,'NCPU': 1,\
+                          'QUEUE_HEARTBEAT': 0.1,'QUEUE_TIMEOUT': 0.5})
+    os.makedirs(f"{configuration['MAIN_DIRECTORY']}FAT_Queue")
+    return configuration
+
+def catalogue(number):
+    return {'NUMBER': [str(i) for i in range(number)],'DIRECTORYNAME': [f"Galaxy_{i}" for i in range(number)],\
+            'CUBENAME': ['Cube']*number,'DISTANCE': [-1.]*number}
+
+# Replace the preparation and the fitting by a record of the order in which the galaxies pass
+def record_galaxies(monkeypatch):
+    prepared = []
+    fitted = []
+    def prepare_galaxy(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+        prepared.append(current_galaxy_index)
+        return [Original_Configuration,{},current_galaxy_index]
+    def fit_galaxy(Configuration,Fits_Files,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+        fitted.append(current_galaxy_index)
+    monkeypatch.setattr(main,'prepare_galaxy',prepare_galaxy)
+    monkeypatch.setattr(main,'fit_galaxy',fit_galaxy)
+    return prepared,fitted
+
+# The preparation in the prefetching processes, galaxy 1 crashes and galaxy 2 is stopped by an error
+def prepare_mock_galaxy(Original_Configuration,Full_Catalogue,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+    with open(f"{Original_Configuration['MAIN_DIRECTORY']}prepared.txt",'a') as file:
+        file.write(f"{current_galaxy_index}\n")
+    if current_galaxy_index == 1:
+        sys.exit(1)
+    if current_galaxy_index == 2:
+        return None
+    return [Original_Configuration,{},current_galaxy_index]
+
+# The processes of the pool are spawned and import main again, the replacement has to be made there
+def prepare_in_child(input_parameters):
+    main.prepare_galaxy = prepare_mock_galaxy
+    return main.prepare_galaxy_parallel(input_parameters)
+
+def test_fit_catalogue_without_queue(batch_configuration,monkeypatch):
+    prepared,fitted = record_galaxies(monkeypatch)
+    main.fit_catalogue(batch_configuration,catalogue(3),[2,0,1],20,[])
+    assert fitted == [2,0,1]
+    assert os.listdir(f"{batch_configuration['MAIN_DIRECTORY']}FAT_Queue") == []
+
+def test_fit_catalogue_reclaims_galaxies_of_a_dead_worker(batch_configuration,monkeypatch):
+    batch_configuration['WORK_QUEUE'] = True
+    prepared,fitted = record_galaxies(monkeypatch)
+    Full_Catalogue = catalogue(3)
+    queue = f"{batch_configuration['MAIN_DIRECTORY']}FAT_Queue/"
+    # another worker is fitting galaxy 1 when we pass it and dies without renewing its claim
+    with open(f"{queue}{main.catalogue_queue_key(Full_Catalogue,1)}.claim",'w') as file:
+        file.write("othernode 2 0.\n")
+    start = time.time()
+    main.fit_catalogue(batch_configuration,Full_Catalogue,[0,1,2],20,[])
+    assert fitted == [0,2,1]
+    # the galaxy is only taken over after its claim went stale
+    assert time.time()-start > batch_configuration['QUEUE_TIMEOUT']
+    assert sorted(os.listdir(queue)) == sorted([f"{main.catalogue_queue_key(Full_Catalogue,i)}.done" for i in range(3)])
+
+def test_fit_catalogue_waits_for_a_living_worker(batch_configuration,monkeypatch):
+    batch_configuration['WORK_QUEUE'] = True
+    prepared,fitted = record_galaxies(monkeypatch)
+    Full_Catalogue = catalogue(2)
+    queue = f"{batch_configuration['MAIN_DIRECTORY']}FAT_Queue/"
+    # the other worker renews its claim and finishes galaxy 0 while we wait
+    other = sf.claim_galaxy(batch_configuration,main.catalogue_queue_key(Full_Catalogue,0))
+    sleep = time.sleep
+    rounds = []
+    def release_later(interval):
+        rounds.append(interval)
+        if len(rounds) == 3:
+            sf.release_galaxy(other)
+        sleep(interval)
+    monkeypatch.setattr(main.time,'sleep',release_later)
+    main.fit_catalogue(batch_configuration,Full_Catalogue,[0,1],20,[])
+    assert fitted == [1]
+    assert len(rounds) == 3
+
+def test_pipeline_galaxies(batch_configuration,monkeypatch):
+    batch_configuration.update({'WORK_QUEUE': True,'PREFETCH_GALAXIES': 2})
+    Full_Catalogue = catalogue(5)
+    queue = f"{batch_configuration['MAIN_DIRECTORY']}FAT_Queue/"
+    fitted = []
+    def fit_galaxy(Configuration,Fits_Files,current_galaxy_index,maximum_directory_length,stop_individual_errors):
+        # the galaxy stays claimed while it is fitted
+        assert os.path.exists(f"{queue}{main.catalogue_queue_key(Full_Catalogue,current_galaxy_index)}.claim")
+        fitted.append(current_galaxy_index)
+    monkeypatch.setattr(main,'prepare_galaxy_parallel',prepare_in_child)
+    monkeypatch.setattr(main,'fit_galaxy',fit_galaxy)
+    # a stalled pipeline should fail the test rather than hang it
+    pipeline = threading.Thread(target=main.pipeline_galaxies,args=(batch_configuration,Full_Catalogue,[0,1,2,3,4],20,[]),daemon=True)
+    pipeline.start()
+    pipeline.join(timeout=120.)
+    assert not pipeline.is_alive()
+    with open(f"{batch_configuration['MAIN_DIRECTORY']}prepared.txt") as file:
+        assert sorted([int(x) for x in file.readlines()]) == [0,1,2,3,4]
+    assert fitted == [0,3,4]
+    assert sorted(os.listdir(queue)) == sorted([f"{main.catalogue_queue_key(Full_Catalogue,i)}.done" for i in range(5)])
@@ -0,0 +1,102 @@
+# -*- coding: future_fstrings -*-
+# Tests of the mock TiRiFiC and SoFiA2 against the readers FAT uses for the real programs
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from test_fits_functions import cube_header,synthetic_cube
+import pyFAT_astro.Support.mock_functions as mock
+import pyFAT_astro.Support.read_functions as rf
+from pyFAT_astro.Support.support_functions import parse_tirific_progress
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_sofia_input(directory,cube):
+    parameter_file = f"{directory}sofia_input.txt"
+    with open(parameter_file,'w') as file:
+        file.write(f'''# the settings the mock reads
+input.data = {cube}
+output.directory = {directory}Sofia_Output
+output.filename = Galaxy
+scfind.threshold = 5.
+scfind.kernelsXY = 0, 3
+scfind.kernelsZ = 0, 3
+linker.minSizeXY = 3
+linker.minSizeZ = 3
+''')
+    return parameter_file
+
+def test_mock_sofia(configuration,monkeypatch):
+    monkeypatch.delenv('PYFAT_MOCK_DELAY',raising=False)
+    directory = configuration['FITTING_DIR']
+    os.makedirs(f"{directory}Sofia_Output")
+    data = synthetic_cube(shape = (40,32,32))
+    fits.writeto(f"{directory}cube.fits",data,cube_header(data.shape))
+    mock.mock_sofia([write_sofia_input(directory,f"{directory}cube.fits")])
+    mask = fits.getdata(f"{directory}Sofia_Output/Galaxy_mask.fits")
+    assert mask.shape == data.shape
+    assert np.max(mask) == 1
+    # the catalogue is read by FAT as a SoFiA2 catalogue
+    configuration.update({'BASE_NAME': 'Galaxy','CHANNEL_WIDTH': 4.,'BEAM_IN_PIXELS': [3.,3.,10.],'SOFIA_RAN': True})
+    catalogue = rf.sofia_catalogue(configuration,{'MASK': 'Galaxy_mask.fits','FITTING_CUBE': 'cube.fits'})
+    # the values of the selected source in the order id, x, x_min, x_max, y
+    assert catalogue[0] == '1'
+    assert abs(float(catalogue[1])-16.) < 1.
+    assert abs(float(catalogue[4])-16.) < 1.
+    assert float(catalogue[2]) <= float(catalogue[1]) <= float(catalogue[3])
+    # and the mask is accepted by check_mask
+    assert os.path.exists(f"{directory}Sofia_Output/Galaxy_mom0.fits")
+
+def test_mock_sofia_without_sources(configuration,monkeypatch):
+    monkeypatch.delenv('PYFAT_MOCK_DELAY',raising=False)
+    directory = configuration['FITTING_DIR']
+    data = np.random.default_rng(1).normal(0.,0.05,(20,16,16))
+    fits.writeto(f"{directory}cube.fits",data,cube_header(data.shape))
+    with pytest.raises(SystemExit) as exit:
+        mock.mock_sofia([write_sofia_input(directory,f"{directory}cube.fits")])
+    # SoFiA2 exits with 8 when there are no sources
+    assert exit.value.code == 8
+
+def tirific_input(directory):
+    data = synthetic_cube(shape = (20,24,24))
+    fits.writeto(f"{directory}cube.fits",data,cube_header(data.shape))
+    return {'INSET': f"{directory}cube.fits",'LOOPS': '3','NUR': '3','RADI': '0 10 20',
+            'VROT': '0 50 60','SBR': '1e-3 5e-4 1e-4','INCL': '50','PA': '30','VSYS': '1230',
+            'OUTSET': f"{directory}model.fits",'TIRDEF': f"{directory}model.def",'LOGNAME': ''}
+
+def test_run_mock_tirific(configuration,monkeypatch,capsys):
+    monkeypatch.delenv('PYFAT_MOCK_DELAY',raising=False)
+    directory = configuration['FITTING_DIR']
+    Template = tirific_input(directory)
+    mock.run_mock_tirific(Template)
+    # the progress is read as tirific progress
+    progress = [parse_tirific_progress(line) for line in capsys.readouterr().out.split('\n') if line]
+    assert all(progress)
+    assert [x['LOOP'] for x in progress] == [1]*5+[2]*5+[3]*5
+    assert all(x['MAX_LOOP'] == 3 for x in progress)
+    chi = [x['CHI_SQUARE'] for x in progress[::5]]
+    assert chi[0] > chi[1] > chi[2]
+    assert fits.getdata(f"{directory}model.fits").shape == (20,24,24)
+    written = rf.tirific_template(filename = f"{directory}model.def")
+    assert all(written[key] == Template[key] for key in Template if key != 'LOGNAME')
+
+def test_mock_tirific_executable(configuration):
+    directory = configuration['FITTING_DIR']
+    Template = tirific_input(directory)
+    with open(f"{directory}input.def",'w') as file:
+        for key in Template:
+            file.write(f"{key}= {Template[key]}\n")
+    environment = dict(os.environ, PYTHONPATH = REPOSITORY, PYFAT_MOCK_DELAY = '0')
+    result = subprocess.run([sys.executable,f"{REPOSITORY}/bin/pyFAT_mock_tirific",\
+        f"DEFFILE={directory}input.def",'LOOPS=2'],capture_output = True,text = True,\
+        env = environment,cwd = directory,timeout = 60)
+    assert result.returncode == 0
+    lines = result.stdout.strip().split('\n')
+    # without a restart file the mock finishes like a single tirific run
+    assert lines[-1] == 'Finished'
+    assert parse_tirific_progress(lines[-2])['LOOP'] == 2
+    assert rf.tirific_template(filename = f"{directory}model.def")['LOOPS'] == '2'
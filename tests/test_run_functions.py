@@ -0,0 +1,212 @@
+# -*- coding: future_fstrings -*-
+# Tests of the tirific runs on recorded TiRiFiC stdout and the mock tirific
+import concurrent.futures
+import os
+import signal
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from conftest import DATA_DIR
+from test_fits_functions import cube_header,synthetic_cube
+import pyFAT_astro.Support.read_functions as rf
+import pyFAT_astro.Support.run_functions as runf
+from pyFAT_astro.Support.support_functions import finish_current_run,parse_tirific_progress,start_watchdog
+
+
+# A stand in for tirific that writes the output of the fit and prints the stdout of a TiRiFiC run
+def write_tirific(directory,fit_type,stdout_file,output_last = False):
+    executable = f"{directory}fake_tirific"
+    output = f'''os.makedirs('{fit_type}',exist_ok=True)
+fits.writeto('{fit_type}/{fit_type}.fits',np.zeros((2,3,4),dtype=np.float32),overwrite=True)
+with open('{fit_type}/{fit_type}.def','w') as file:
+    file.write('LOOPS= 6\\n')
+'''
+    with open(executable,'w') as file:
+        file.write(f'''#!{sys.executable}
+import os
+import sys
+import time
+import numpy as np
+from astropy.io import fits
+{'' if output_last else output}
+with open('{stdout_file}') as file:
+    for line in file:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        {'time.sleep(0.1)' if output_last else ''}
+{output if output_last else ''}
+# tirific keeps running until it is killed
+time.sleep(60)
+''')
+    os.chmod(executable,0o755)
+    return executable
+
+def run(configuration,fit_type = 'Fit_Tirific_OSC',output_last = False):
+    configuration['TIRIFIC'] = write_tirific(configuration['FITTING_DIR'],fit_type,f"{DATA_DIR}tirific_stdout.txt",\
+                                             output_last = output_last)
+    with open(f"{configuration['FITTING_DIR']}{fit_type}_In.def",'w') as file:
+        file.write("RESTARTNAME= restart.txt\nLOOPS= 6\nINSET= cube.fits\n")
+    accepted,current_run = runf.run_tirific(configuration,None,stage = 'run_os',fit_type = fit_type)
+    finish_current_run(configuration,current_run)
+    return accepted,current_run
+
+def progress_rows(configuration):
+    with open(f"{configuration['LOG_DIRECTORY']}Tirific_Progress_Fit_Tirific_OSC.txt") as file:
+        return [line.split() for line in file if line[0] != '#']
+
+def test_parse_tirific_stdout():
+    with open(f"{DATA_DIR}tirific_stdout.txt") as file:
+        progress = [parse_tirific_progress(line) for line in file]
+    reported = [x for x in progress if x]
+    assert len(progress) - len(reported) == 4
+    assert [x['LOOP'] for x in reported[::3]] == [1,2,3,4,5,6]
+    assert all(x['MAX_LOOP'] == 6 for x in reported)
+    assert reported[0]['PARAMETER'] == 'VROT'
+    assert reported[-1]['CHI_SQUARE'] == 1.4898e5
+    assert reported[-1]['STEP'] == 1.562e-02
+
+def test_run_tirific_without_plateau(configuration):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    accepted,current_run = run(configuration)
+    # tirific ran all its loops so the fit is not accepted
+    assert accepted == 0
+    assert np.array_equal(configuration['NO_POINTSOURCES'],[1236.,1500.])
+    rows = progress_rows(configuration)
+    assert len(rows) == 18
+    assert [int(x[3]) for x in rows[::3]] == [1,2,3,4,5,6]
+    assert float(rows[-1][5]) == 1.4898e5
+
+def test_run_tirific_plateau(configuration):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    configuration['PLATEAU_LOOPS'] = 2
+    accepted,current_run = run(configuration)
+    # loops 4 and 5 improved the chi-square by less than 0.1 % so tirific is stopped when loop 6 starts
+    rows = progress_rows(configuration)
+    assert len(rows) == 16
+    assert int(rows[-1][3]) == 6
+    # tirific ended itself and the next run starts a new one
+    assert current_run.returncode == -signal.SIGTERM
+    assert not configuration['TIRIFIC_RUNNING']
+    # a run that ends before its last loop is accepted as before
+    assert accepted == 1
+    assert configuration['PLATEAU_LOOPS'] == 2
+    assert os.path.exists(f"{configuration['FITTING_DIR']}Fit_Tirific_OSC/Fit_Tirific_OSC.fits")
+    # the loops of the fit are left alone
+    with open(f"{configuration['FITTING_DIR']}Fit_Tirific_OSC_In.def") as file:
+        assert file.read() == "RESTARTNAME= restart.txt\nLOOPS= 6\nINSET= cube.fits\n"
+    with open(f"{configuration['LOG_DIRECTORY']}restart_Fit_Tirific_OSC.txt") as file:
+        assert file.read() == "Initialized a new run"
+
+def test_run_tirific_plateau_without_output(configuration):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    configuration['PLATEAU_LOOPS'] = 2
+    accepted,current_run = run(configuration,output_last = True)
+    # the stopped tirific wrote nothing so the fit ran again with all its loops
+    rows = progress_rows(configuration)
+    assert len(rows) == 16+18
+    assert configuration['PLATEAU_LOOPS'] == 0
+    assert accepted == 0
+    with open(configuration['OUTPUTLOG']) as file:
+        assert 'The stopped tirific did not write the output of Fit_Tirific_OSC' in file.read()
+    assert os.path.exists(f"{configuration['FITTING_DIR']}Fit_Tirific_OSC/Fit_Tirific_OSC.def")
+
+def test_run_tirific_stops_watchdog_on_error(configuration,monkeypatch):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    configuration['TIRIFIC_TIMEOUT'] = 300.
+    watchdogs = []
+    def record_watchdog(process,timeout):
+        watchdogs.append(start_watchdog(process,timeout))
+        return watchdogs[-1]
+    def broken_parser(line):
+        raise ValueError('Unreadable tirific output')
+    monkeypatch.setattr(runf,'start_watchdog',record_watchdog)
+    monkeypatch.setattr(runf,'parse_tirific_progress',broken_parser)
+    with pytest.raises(ValueError):
+        run(configuration)
+    # a cancelled timer is finished without having killed tirific
+    assert watchdogs[0][0].finished.is_set()
+    assert not watchdogs[0][1].is_set()
+    finish_current_run(configuration,None)
+
+def test_load_tirific_progress(configuration):
+    os.makedirs(configuration['FITTING_DIR'],exist_ok=True)
+    # without a file there is no progress
+    progress = rf.load_tirific_progress(configuration,'Fit_Tirific_OSC')
+    assert all(len(progress[x]) == 0 for x in progress)
+    run(configuration)
+    with open(f"{configuration['LOG_DIRECTORY']}Tirific_Progress_Fit_Tirific_OSC.txt",'a') as file:
+        file.write(f"{1e9:16.3f} {'run_ec':>16s} {3:9d} {1:5d} {3:8d} {2.5e5:14.7e} {-1.:12.5e} {'VROT':>10s}\n")
+        file.write("an incomplete line\n")
+    progress = rf.load_tirific_progress(configuration,'Fit_Tirific_OSC')
+    assert len(progress['TIME']) == 19
+    assert progress['LOOP'].dtype == int and progress['CHI_SQUARE'].dtype == float
+    progress = rf.load_tirific_progress(configuration,'Fit_Tirific_OSC',stage = 'run_os')
+    assert len(progress['TIME']) == 18
+    assert np.all(np.diff(progress['TIME']) >= 0.)
+    assert list(progress['LOOP'][::3]) == [1,2,3,4,5,6]
+    assert progress['CHI_SQUARE'][-1] == 1.4898e5
+    assert progress['PARAMETER'][0] == 'VROT'
+    progress = rf.load_tirific_progress(configuration,'Fit_Tirific_OSC',stage = 'run_ec')
+    assert list(progress['ITERATION']) == [3]
+
+# The mock tirific as the tirific executable
+def write_mock_tirific(directory):
+    executable = f"{directory}mock_tirific"
+    with open(executable,'w') as file:
+        file.write(f'''#!{sys.executable}
+import sys
+sys.path.insert(0,'{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}')
+import pyFAT_astro.Support.mock_functions as mock
+mock.mock_tirific(sys.argv[1:])
+''')
+    os.chmod(executable,0o755)
+    return executable
+
+def inclination_candidates(configuration,inclinations):
+    directory = configuration['FITTING_DIR']
+    os.makedirs(f"{directory}Sofia_Output",exist_ok=True)
+    data = synthetic_cube(shape = (20,24,24))
+    hdr = cube_header(data.shape)
+    fits.writeto(f"{directory}cube.fits",data,hdr)
+    fits.writeto(f"{directory}Sofia_Output/mask.fits",np.ones(data.shape,dtype=np.int32),hdr)
+    candidates = []
+    for i,inclination in enumerate(inclinations):
+        candidate = f"tmp_incl_check/Incl_{i}"
+        os.makedirs(f"{directory}{candidate}")
+        with open(f"{directory}{candidate}_In.def",'w') as file:
+            file.write(f'''INSET= cube.fits
+LOOPS= 0
+NUR= 3
+RADI= 0 10 20
+VROT= 0 50 60
+SBR= 1e-3 5e-4 1e-4
+INCL= {inclination}
+PA= 30
+VSYS= 1230
+OUTSET= {candidate}/Incl_{i}.fits
+TIRDEF= {candidate}/Incl_{i}.def
+RESTARTNAME= {configuration['LOG_DIRECTORY']}restart_tmp_incl_check_{i}.txt
+''')
+        with open(f"{configuration['LOG_DIRECTORY']}restart_tmp_incl_check_{i}.txt",'w') as file:
+            file.write("Initialized a new run")
+        candidates.append(candidate)
+    return candidates
+
+def test_run_inclination_candidates_in_parallel(configuration,monkeypatch):
+    monkeypatch.delenv('PYFAT_MOCK_DELAY',raising=False)
+    configuration['TIRIFIC'] = write_mock_tirific(configuration['FITTING_DIR'])
+    candidates = inclination_candidates(configuration,[20.,70.])
+    Fits_Files = {'MASK': 'mask.fits'}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        maps = list(executor.map(lambda candidate: runf.run_inclination_candidate(configuration,\
+                                 Fits_Files,candidate),candidates))
+    # the maps are returned in the order of the candidates
+    assert maps == [f"{configuration['FITTING_DIR']}{candidate}/Incl_{i}_mom0.fits" for i,candidate in enumerate(candidates)]
+    parallel = [fits.getdata(x) for x in maps]
+    # the models differ for every inclination
+    assert not np.array_equal(parallel[0],parallel[1])
+    # and a run on its own gives the same map
+    assert np.array_equal(parallel[1],fits.getdata(runf.run_inclination_candidate(configuration,Fits_Files,candidates[1])))
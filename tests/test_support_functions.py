@@ -0,0 +1,585 @@
+# -*- coding: future_fstrings -*-
+# Tests of the batch bookkeeping in support_functions
+import copy
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import pyFAT_astro.Support.read_functions as rf
+import pyFAT_astro.Support.support_functions as sf
+import pyFAT_astro.Support.write_functions as wf
+
+
+# Append many long lines to a file from a separate process
+def append_lines(filename,worker,lines = 200):
+    for i in range(lines):
+        sf.locked_append(filename,f"{worker:02d} {i:04d} {'x'*2000}\n")
+
+
+def test_config_hash_covers_new_settings(configuration):
+    reference = sf.get_config_hash(configuration)
+    assert reference == sf.get_config_hash(copy.deepcopy(configuration))
+    for key,value in [['WORKING_PRECISION','float32'],['INHOMOGENEITY_ENGINE','polar'],\
+                      ['PLATEAU_LOOPS',3],['AN_OPTION_ADDED_LATER',True]]:
+        changed = copy.deepcopy(configuration)
+        changed[key] = value
+        assert sf.get_config_hash(changed) != reference, key
+
+def test_config_hash_ignores_batch_control(configuration):
+    reference = sf.get_config_hash(configuration)
+    for key,value in [['NCPU',12],['TIRIFIC_TIMEOUT',3600.],['QUEUE_TIMEOUT',10.],\
+                      ['PREFETCH_GALAXIES',2],['MAIN_DIRECTORY','/elsewhere/'],['LOG_DIRECTORY','Logs/01-01-2030'],\
+                      ['JOURNAL','/elsewhere/FAT_Journal.txt'],['FITS_CACHE_SIZE',0.]]:
+        changed = copy.deepcopy(configuration)
+        changed[key] = value
+        assert sf.get_config_hash(changed) == reference, key
+
+def test_locked_append_from_parallel_processes(tmp_path):
+    filename = f"{tmp_path}/FAT_results.txt"
+    workers = [multiprocessing.get_context('fork').Process(target=append_lines,args=(filename,i)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    with open(filename) as file:
+        lines = file.readlines()
+    assert len(lines) == 800
+    # every line is written in one piece
+    assert all(len(line) == 2009 and line[8:-1] == 'x'*2000 for line in lines)
+    for i in range(4):
+        assert [int(line.split()[1]) for line in lines if int(line.split()[0]) == i] == list(range(200))
+
+def test_journal_resume(configuration):
+    configuration['JOURNAL'] = f"{configuration['MAIN_DIRECTORY']}FAT_Journal.txt"
+    configuration['CONFIG_HASH'] = sf.get_config_hash(configuration)
+    configuration['ID_NR'] = '3'
+    configuration['SUB_DIR'] = 'Galaxy'
+    # nothing is journaled yet
+    assert rf.load_journal(configuration) == []
+    wf.journal_entry(configuration,'create_fat_cube')
+    wf.journal_entry(configuration,'run_sofia')
+    other_galaxy = copy.deepcopy(configuration)
+    other_galaxy['ID_NR'] = '4'
+    other_galaxy['SUB_DIR'] = 'Other'
+    wf.journal_entry(other_galaxy,'finished',status='fitted')
+    other_settings = copy.deepcopy(configuration)
+    other_settings['WORKING_PRECISION'] = 'float32'
+    other_settings['CONFIG_HASH'] = sf.get_config_hash(other_settings)
+    wf.journal_entry(other_settings,'finished',status='fitted')
+    assert rf.load_journal(configuration) == [['create_fat_cube','completed'],['run_sofia','completed']]
+    assert rf.load_journal(other_galaxy) == [['finished','fitted']]
+    assert rf.load_journal(other_settings) == [['finished','fitted']]
+    # a journal without a file name switches the journaling off
+    configuration['JOURNAL'] = None
+    wf.journal_entry(configuration,'finished')
+    assert rf.load_journal(configuration) == []
+
+def test_claim_galaxy(configuration):
+    os.makedirs(f"{configuration['MAIN_DIRECTORY']}FAT_Queue")
+    queue_file = f"{configuration['MAIN_DIRECTORY']}FAT_Queue/Galaxy"
+    claim = sf.claim_galaxy(configuration,'Galaxy')
+    assert claim[0] == queue_file
+    assert os.path.exists(f"{queue_file}.claim")
+    # a claim that is renewed in time belongs to a living worker
+    assert sf.claim_galaxy(configuration,'Galaxy') is None
+    sf.release_galaxy(claim)
+    assert not os.path.exists(f"{queue_file}.claim")
+    assert os.path.exists(f"{queue_file}.done")
+    assert not claim[2].is_alive()
+    # a finished galaxy is never claimed again
+    assert sf.claim_galaxy(configuration,'Galaxy') is None
+
+def stale_claim(configuration):
+    os.makedirs(f"{configuration['MAIN_DIRECTORY']}FAT_Queue")
+    queue_file = f"{configuration['MAIN_DIRECTORY']}FAT_Queue/Galaxy"
+    with open(f"{queue_file}.claim",'w') as file:
+        file.write("deadnode 1 0.\n")
+    last_heartbeat = time.time()-configuration['QUEUE_TIMEOUT']-10.
+    os.utime(f"{queue_file}.claim",(last_heartbeat,last_heartbeat))
+    return queue_file
+
+def test_claim_galaxy_reclaims_dead_worker(configuration):
+    queue_file = stale_claim(configuration)
+    claim = sf.claim_galaxy(configuration,'Galaxy')
+    assert claim is not None
+    with open(f"{queue_file}.claim") as file:
+        assert file.read().split()[:2] == [socket.gethostname(),str(os.getpid())]
+    assert os.listdir(f"{configuration['MAIN_DIRECTORY']}FAT_Queue") == ['Galaxy.claim']
+    sf.release_galaxy(claim)
+
+def test_claim_galaxy_does_not_take_a_reclaimed_claim(configuration,monkeypatch):
+    queue_file = stale_claim(configuration)
+    seen = sf.read_claim(f"{queue_file}.claim")
+    # A reclaims the galaxy
+    claim = sf.claim_galaxy(configuration,'Galaxy')
+    live_claim = sf.read_claim(f"{queue_file}.claim")
+    # B looked at the claim before A replaced it
+    read_claim = sf.read_claim
+    reads = []
+    def read_before_takeover(claim_file):
+        reads.append(claim_file)
+        return seen if len(reads) == 1 else read_claim(claim_file)
+    monkeypatch.setattr(sf,'read_claim',read_before_takeover)
+    assert sf.claim_galaxy(configuration,'Galaxy') is None
+    assert len(reads) == 2
+    # A keeps its claim and no token is left behind
+    assert sf.read_claim(f"{queue_file}.claim") == live_claim
+    assert sorted(os.listdir(f"{configuration['MAIN_DIRECTORY']}FAT_Queue")) == ['Galaxy.claim']
+    sf.release_galaxy(claim)
+
+def test_claim_galaxy_waits_for_the_takeover_token(configuration):
+    queue_file = stale_claim(configuration)
+    # another process is taking over the stale claim
+    with open(f"{queue_file}.takeover",'w') as file:
+        file.write("othernode 2 0.\n")
+    assert sf.claim_galaxy(configuration,'Galaxy') is None
+    with open(f"{queue_file}.claim") as file:
+        assert file.read() == "deadnode 1 0.\n"
+    # a token left behind by a dead process is removed but not taken
+    os.utime(f"{queue_file}.takeover",(0.,0.))
+    assert sf.claim_galaxy(configuration,'Galaxy') is None
+    assert not os.path.exists(f"{queue_file}.takeover")
+    claim = sf.claim_galaxy(configuration,'Galaxy')
+    assert claim is not None
+    sf.release_galaxy(claim)
+
+def test_queue_heartbeat_renews_claim(configuration):
+    os.makedirs(f"{configuration['MAIN_DIRECTORY']}FAT_Queue")
+    configuration['QUEUE_HEARTBEAT'] = 0.05
+    claim = sf.claim_galaxy(configuration,'Galaxy')
+    os.utime(f"{claim[0]}.claim",(0.,0.))
+    time.sleep(0.3)
+    assert time.time()-os.path.getmtime(f"{claim[0]}.claim") < 1.
+    sf.release_galaxy(claim)
+
+# A catalogue of galaxies with empty cubes on disk
+def write_catalogue(directory,shapes):
+    catalogue = {'NUMBER': [],'DIRECTORYNAME': [],'CUBENAME': []}
+    for i,shape in enumerate(shapes):
+        os.makedirs(f"{directory}Galaxy_{i}")
+        hdr = fits.Header()
+        hdr['SIMPLE'] = True
+        hdr['BITPIX'] = -32
+        hdr['NAXIS'] = 3
+        for axis,size in enumerate(shape):
+            hdr[f'NAXIS{axis+1}'] = size
+        hdr['CDELT1'] = -1./3600.
+        hdr['BMAJ'] = 4./3600.
+        hdr.tofile(f"{directory}Galaxy_{i}/Cube.fits")
+        # a sparse data part keeps the file complete without writing it
+        with open(f"{directory}Galaxy_{i}/Cube.fits",'r+b') as file:
+            file.truncate(sf.fits_file_size(f"{directory}Galaxy_{i}/Cube.fits"))
+        catalogue['NUMBER'].append(str(i))
+        catalogue['DIRECTORYNAME'].append(f"Galaxy_{i}")
+        catalogue['CUBENAME'].append('Cube')
+    return catalogue
+
+def test_schedule_galaxies_largest_first(configuration):
+    configuration['FITTING_STAGES'] = ['create_fat_cube','run_sofia','fit_tirific_osc']
+    configuration['MAX_SIZE_IN_BEAMS'] = 30
+    shapes = [[20,20,30],[200,200,100],[50,50,60],[120,120,80]]
+    catalogue = write_catalogue(configuration['MAIN_DIRECTORY'],shapes)
+    catalogue['NUMBER'].append('4')
+    catalogue['DIRECTORYNAME'].append('Missing')
+    catalogue['CUBENAME'].append('Cube')
+    assert sf.schedule_galaxies(configuration,catalogue,[0,1,2,3,4]) == [1,3,2,0,4]
+
+def test_schedule_galaxies_calibrated_on_wall_times(configuration):
+    configuration['FITTING_STAGES'] = ['create_fat_cube','run_sofia','fit_tirific_osc']
+    configuration['MAX_SIZE_IN_BEAMS'] = 30
+    shapes = [[20,20,30],[200,200,100],[50,50,60],[120,120,80],[60,60,60]]
+    catalogue = write_catalogue(configuration['MAIN_DIRECTORY'],shapes)
+    # the measured times disagree with the size for the first two galaxies
+    with open(f"{configuration['MAIN_DIRECTORY']}FAT_Wall_Times.txt",'w') as file:
+        for i,wall_time in enumerate([5000.,300.,900.,2000.]):
+            file.write(f"{i}|Galaxy_{i}|{wall_time:.1f}\n")
+        # another catalogue entry fitted in the directory of the unmeasured galaxy
+        file.write("9|Galaxy_4|1.0\n")
+    order = sf.schedule_galaxies(configuration,catalogue,[0,1,2,3,4])
+    # the measured galaxies follow their wall times, the unmeasured one gets the fitted cost
+    assert [x for x in order if x != 4] == [0,3,2,1]
+    assert order.index(4) > order.index(0)
+
+def test_fits_file_size(tmp_path):
+    for shape,dtype in [[(3,17,19),np.float32],[(5,5),np.int16],[(40,40,40),np.float64]]:
+        filename = f"{tmp_path}/cube.fits"
+        hdr = fits.Header()
+        for i in range(60):
+            hdr[f'COMM{i}'] = 'A card to make the header longer than a block'
+        fits.writeto(filename,np.zeros(shape,dtype=dtype),hdr,overwrite=True)
+        assert sf.fits_file_size(filename) == os.path.getsize(filename)
+    # a header that is not completely written has no size yet
+    with open(filename,'r+b') as file:
+        file.truncate(2880)
+    assert sf.fits_file_size(filename) == np.inf
+
+def test_wait_for_output(configuration):
+    filename = f"{configuration['MAIN_DIRECTORY']}model.fits"
+    def_file = f"{configuration['MAIN_DIRECTORY']}model.def"
+    fits.writeto(filename,np.zeros((10,30,30),dtype=np.float32))
+    size = os.path.getsize(filename)
+    with open(def_file,'w') as file:
+        file.write('LOOPS= 10\n')
+    assert sf.wait_for_output(configuration,[filename,def_file],timeout = 5.)
+    # a fits file that is shorter than its header says is still being written
+    with open(filename,'r+b') as file:
+        file.truncate(size-2880)
+    start = time.time()
+    assert not sf.wait_for_output(configuration,[filename],timeout = 0.3)
+    assert time.time()-start < 2.
+    # as is a missing file
+    assert not sf.wait_for_output(configuration,[f"{configuration['MAIN_DIRECTORY']}missing.fits"],timeout = 0.3)
+
+def test_wait_for_output_ignores_previous_output(configuration):
+    filename = f"{configuration['MAIN_DIRECTORY']}model.fits"
+    def_file = f"{configuration['MAIN_DIRECTORY']}model.def"
+    fits.writeto(filename,np.zeros((10,30,30),dtype=np.float32))
+    with open(def_file,'w') as file:
+        file.write('LOOPS= 10\n')
+    # files from before the start of the run do not count
+    run_start = time.time()+100.
+    for name in [filename,def_file]:
+        assert not sf.wait_for_output(configuration,[name],timeout = 0.3,newer_than = run_start)
+        os.utime(name,(run_start,run_start))
+        assert sf.wait_for_output(configuration,[name],timeout = 5.,newer_than = run_start)
+
+def test_wait_for_output_waits_for_a_stable_file(configuration):
+    def_file = f"{configuration['MAIN_DIRECTORY']}model.def"
+    with open(def_file,'w') as file:
+        file.write('LOOPS= 10\n')
+    def keep_writing():
+        for i in range(8):
+            time.sleep(0.1)
+            with open(def_file,'a') as file:
+                file.write(f'VROT_{i}= 10\n')
+    writer = threading.Thread(target=keep_writing)
+    writer.start()
+    start = time.time()
+    assert sf.wait_for_output(configuration,[def_file],timeout = 5.,stable_time = 0.3)
+    # the file is only complete after the last line plus the stable time
+    assert time.time()-start > 1.
+    writer.join()
+    with open(def_file) as file:
+        assert len(file.readlines()) == 9
+
+def test_wait_for_output_waits_for_the_writer(configuration):
+    filename = f"{configuration['MAIN_DIRECTORY']}model.fits"
+    data = np.zeros((10,30,30),dtype=np.float32)
+    fits.writeto(filename,data)
+    content = open(filename,'rb').read()
+    with open(filename,'wb') as file:
+        file.write(content[:2880])
+    def finish_writing():
+        time.sleep(0.3)
+        with open(filename,'ab') as file:
+            file.write(content[2880:])
+    writer = threading.Thread(target=finish_writing)
+    writer.start()
+    assert sf.wait_for_output(configuration,[filename],timeout = 5.)
+    writer.join()
+    assert np.array_equal(fits.getdata(filename),data)
+
+def busy_child(*args,**kwargs):
+    return subprocess.Popen([sys.executable,'-c','while True: pass'],*args,**kwargs)
+
+def test_get_process_tree():
+    child = busy_child()
+    script = "import subprocess,sys,time; subprocess.Popen([sys.executable,'-c','import time; time.sleep(60)']); time.sleep(60)"
+    parent = subprocess.Popen([sys.executable,'-c',script],start_new_session=True)
+    try:
+        time.sleep(1.)
+        tree = sf.get_process_tree(os.getpid())
+        assert tree[0] == os.getpid()
+        assert child.pid in tree and parent.pid in tree
+        # the grandchild is found through its parent
+        assert len(sf.get_process_tree(parent.pid)) == 2
+        assert sf.get_process_tree(parent.pid)[1] in tree
+    finally:
+        child.kill()
+        child.wait()
+        sf.kill_process_group(parent.pid)
+        parent.wait()
+
+def test_get_usage_statistics(configuration):
+    child = busy_child()
+    try:
+        # the first sample is the average since the start of the process
+        CPU,mem = sf.get_usage_statistics(configuration,child.pid)
+        assert mem > 0.
+        time.sleep(0.5)
+        CPU,mem = sf.get_usage_statistics(configuration,child.pid)
+        assert 50. < CPU < 150.
+        assert mem > 0.
+        # the statistics of a parent include its busy child
+        CPU,mem = sf.get_usage_statistics(configuration,os.getpid())
+        time.sleep(0.5)
+        CPU,mem = sf.get_usage_statistics(configuration,os.getpid())
+        assert CPU > 50.
+    finally:
+        child.kill()
+        child.wait()
+        sf.usage_previous_sample.clear()
+
+def test_usage_sampler(configuration):
+    child = busy_child()
+    sf.start_usage_sampler(configuration,child.pid)
+    time.sleep(0.5)
+    sf.stop_usage_sampler(child.pid)
+    child.kill()
+    child.wait()
+    assert child.pid not in sf.usage_samplers
+    assert child.pid not in sf.usage_previous_sample
+    with open(f"{configuration['LOG_DIRECTORY']}Usage_Statistics.txt") as file:
+        lines = file.readlines()
+    assert len(lines) >= 3
+    for line in lines:
+        # the fields read by plot_usage_stats
+        tmp = line.strip().split(' ')
+        assert tmp[2] == 'CPU' and tmp[6] == 'Mem' and tmp[9] == 'Mb'
+        float(tmp[4])
+        float(tmp[8])
+
+def test_usage_sampler_stops_with_its_process(configuration):
+    child = busy_child()
+    sf.start_usage_sampler(configuration,child.pid)
+    sampler = sf.usage_samplers[child.pid][1]
+    child.kill()
+    child.wait()
+    sampler.join(timeout = 2.)
+    assert not sampler.is_alive()
+    sf.stop_usage_sampler(child.pid)
+
+def test_chi_square_plateau():
+    chi = [1000.,500.,499.9,499.85,499.84]
+    # disabled or too few loops
+    assert not sf.chi_square_plateau(chi,0,0.001)
+    assert not sf.chi_square_plateau(chi[:3],3,0.001)
+    # the last three loops improved by less than 0.1 %
+    assert sf.chi_square_plateau(chi,3,0.001)
+    # but the fourth one did not
+    assert not sf.chi_square_plateau(chi,4,0.001)
+    # a rising chi-square has not improved either
+    assert sf.chi_square_plateau([500.,510.,520.],2,0.001)
+    # an improvement exactly at the tolerance is not flat
+    assert not sf.chi_square_plateau([1000.,999.],1,0.001)
+    assert sf.chi_square_plateau([1000.,999.5],1,0.001)
+
+def test_remaining_time(configuration):
+    assert sf.remaining_time(configuration,-1.) == -1.
+    assert sf.remaining_time(configuration,30.) == 30.
+    configuration['GALAXY_DEADLINE'] = time.time()+10.
+    assert 9. < sf.remaining_time(configuration,-1.) <= 10.
+    assert sf.remaining_time(configuration,5.) == 5.
+    assert 9. < sf.remaining_time(configuration,30.) <= 10.
+    # a passed deadline leaves no time rather than a negative time
+    configuration['GALAXY_DEADLINE'] = time.time()-10.
+    assert sf.remaining_time(configuration,30.) == 0.
+
+def process_state(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            stat = file.read()
+    except OSError:
+        return 'gone'
+    return stat[stat.rfind(')')+2]
+
+def test_watchdog_kills_a_hung_program():
+    script = "import subprocess,sys,time; subprocess.Popen([sys.executable,'-c','import time; time.sleep(60)']); time.sleep(60)"
+    process = subprocess.Popen([sys.executable,'-c',script],start_new_session=True)
+    time.sleep(0.5)
+    group = sf.get_process_tree(process.pid)
+    start = time.time()
+    watchdog = sf.start_watchdog(process,0.5)
+    process.wait(timeout = 10.)
+    assert time.time()-start < 5.
+    assert sf.stop_watchdog(watchdog)
+    # the whole process group is gone, orphans may stay behind as zombies until init reaps them
+    time.sleep(0.5)
+    assert all([process_state(pid) in ['Z','gone'] for pid in group])
+
+def test_watchdog_leaves_a_finished_program():
+    assert sf.start_watchdog(None,-1.) is None
+    assert not sf.stop_watchdog(None)
+    process = subprocess.Popen([sys.executable,'-c','pass'],start_new_session=True)
+    watchdog = sf.start_watchdog(process,10.)
+    process.wait()
+    assert not sf.stop_watchdog(watchdog)
+    assert watchdog[0].finished.is_set()
+
+# The ratios as they were determined with a profile extraction per angle
+def baseline_obtain_ratios(Configuration, map, center, angles, noise = 0.):
+    ratios = []
+    max_extent = 0.
+    for angle in angles:
+        maj_profile,maj_axis,maj_resolution = sf.get_profile(Configuration,map,angle,center=center)
+        tmp = np.where(maj_profile > noise)[0]
+        if tmp.shape[0] == 0.:
+             width_maj = 0.
+        else:
+            width_maj = (tmp[-1]-tmp[0])*maj_resolution
+            if width_maj**2 > Configuration['BEAM_IN_PIXELS'][0]**2:
+                width_maj = np.sqrt(width_maj**2 - Configuration['BEAM_IN_PIXELS'][0]**2)
+            else:
+                if width_maj < Configuration['BEAM_IN_PIXELS'][0]:
+                    width_maj = Configuration['BEAM_IN_PIXELS'][0]
+        if width_maj > max_extent:
+            max_extent = width_maj
+        if angle < 90:
+            min_profile,min_axis,min_resolution = sf.get_profile(Configuration,map,angle+90,center=center)
+        else:
+            min_profile,min_axis,min_resolution = sf.get_profile(Configuration,map,angle-90,center=center)
+        tmp = np.where(min_profile > noise)[0]
+        if tmp.shape[0] == 0.:
+             width_min = 0.
+        else:
+            width_min = (tmp[-1]-tmp[0])*min_resolution
+            if width_min**2 > Configuration['BEAM_IN_PIXELS'][0]**2:
+                width_min = np.sqrt(width_min**2 - Configuration['BEAM_IN_PIXELS'][0]**2)
+            else:
+                if width_min < Configuration['BEAM_IN_PIXELS'][1]:
+                    width_min = Configuration['BEAM_IN_PIXELS'][1]
+            if width_min > max_extent:
+                max_extent = width_min
+        if width_min != 0. and width_maj != 0.:
+            ratios.append(width_maj/width_min)
+        else:
+            ratios.append(float('NaN'))
+    max_extent = max_extent/2.
+    return np.array(ratios,dtype=float), max_extent*Configuration['PIXEL_SIZE']
+
+# An inclined exponential disk on top of noise
+def synthetic_map(shape = (70,80),center = (41.3,33.7),pa = 35.,inclination = 60.,seed = 2):
+    rng = np.random.default_rng(seed)
+    y,x = np.indices(shape,dtype=float)
+    dx,dy = x-center[0],y-center[1]
+    major = dx*np.cos(np.radians(pa))+dy*np.sin(np.radians(pa))
+    minor = (-dx*np.sin(np.radians(pa))+dy*np.cos(np.radians(pa)))/np.cos(np.radians(inclination))
+    return np.exp(-np.sqrt(major**2+minor**2)/8.)+rng.normal(0.,0.01,shape)
+
+def map_configuration(configuration,map):
+    configuration['NAXES'] = [map.shape[1],map.shape[0]]
+    configuration['BEAM_IN_PIXELS'] = [4.,3.5,0.]
+    configuration['PIXEL_SIZE'] = 1./3600.
+    return configuration
+
+def test_obtain_ratios_matches_profile_per_angle(configuration):
+    map = synthetic_map()
+    map_configuration(configuration,map)
+    angles = np.linspace(0, 360, 180)
+    centers = [[41.3,33.7],[40.,35.],[12.5,60.2],[0.,0.]]
+    for noise in [0.05,0.5,2.]:
+        all_ratios,all_extents = sf.obtain_ratios(configuration,map,centers,angles,noise = noise)
+        assert all_ratios.shape == (len(centers),angles.size)
+        for i,center in enumerate(centers):
+            expected,expected_extent = baseline_obtain_ratios(configuration,map,center,angles,noise = noise)
+            ratios,extent = sf.obtain_ratios(configuration,map,center,angles,noise = noise)
+            assert np.allclose(ratios,expected,rtol=1e-13,atol=0.,equal_nan=True)
+            assert np.isclose(extent,expected_extent,rtol=1e-13,atol=0.)
+            assert np.array_equal(all_ratios[i],ratios,equal_nan=True)
+            assert all_extents[i] == extent
+    # nothing above the noise gives no ratios at all
+    assert np.all(np.isnan(sf.obtain_ratios(configuration,map,centers[0],angles,noise = 2.)[0]))
+
+def test_get_inclination_pa_with_precomputed_ratios(configuration,monkeypatch):
+    map = synthetic_map()
+    map_configuration(configuration,map)
+    image = fits.HDUList([fits.PrimaryHDU(data=map)])
+    center = [41.3,33.7]
+    # record the ratios that are fitted and stop after the first fit
+    fitted = []
+    def record_fit(Configuration,x,y,debug = False):
+        fitted.append(np.array(y,dtype=float))
+        return y,[float('NaN')]
+    monkeypatch.setattr(sf,'fit_sine',record_fit)
+    ratios = sf.obtain_ratios(configuration,map,center,np.linspace(0, 360, 180),noise = 0.05)
+    sf.get_inclination_pa(configuration,image,center,cutoff = 0.05,ratios = ratios)
+    sf.get_inclination_pa(configuration,image,center,cutoff = 0.05)
+    assert len(fitted) == 2
+    assert np.array_equal(fitted[0],fitted[1])
+    assert np.array_equal(fitted[0],ratios[0])
+
+def disk_with_knot(shape = (60,64),center = (30.5,28.2)):
+    y,x = np.indices(shape,dtype=float)
+    radius = np.sqrt((x-center[0])**2+(y-center[1])**2)
+    disk = np.exp(-radius**2/200.)
+    knot = 0.5*np.exp(-((x-center[0]-12.)**2+(y-center[1]-5.)**2)/4.)
+    return disk,disk+knot,radius
+
+def test_azimuthal_minimum_removes_a_knot(configuration):
+    center = [30.5,28.2]
+    disk,map,radius = disk_with_knot(center = center)
+    minimum_map = sf.azimuthal_minimum(configuration,map,center)
+    # no pixel is ever raised
+    assert np.all(minimum_map <= map)
+    # the knot is gone while the smooth disk is kept up to the interpolation between the samples
+    inside = radius < 25.
+    assert np.max(np.abs(minimum_map-disk)[inside]) < 0.01*np.max(disk)
+    # outside the circles that stay inside the map the minimum is the padding of 0.
+    assert minimum_map[0,0] == 0.
+
+@pytest.mark.parametrize('inclination,pa',[[0.,90.],[50.,120.]])
+def test_remove_inhomogeneities_polar_against_rotation(configuration,inclination,pa):
+    center = [30.5,28.2]
+    disk,map,radius = disk_with_knot(center = center)
+    fits_map = fits.HDUList([fits.PrimaryHDU(data=map)])
+    maps = {}
+    for engine in ['polar','rotation']:
+        maps[engine] = sf.remove_inhomogeneities(configuration,fits_map,inclination = inclination, pa = pa,\
+            center = center, WCS_center = False, engine = engine)[0].data
+    # the input map is not changed
+    assert np.array_equal(fits_map[0].data,map)
+    inside = radius < 20.
+    # the repeated interpolation of the rotations smooths the map somewhat
+    assert np.median(np.abs(maps['polar']-maps['rotation'])[inside]) < 0.05*np.max(disk)
+    # both engines remove the knot
+    knot = np.abs(map-disk) > 0.1
+    for engine in maps:
+        assert np.all(maps[engine][knot] < map[knot]-0.05)
+    if inclination == 0.:
+        # the face-on disk is azimuthally symmetric, the polar sampling stays closer to it
+        errors = {engine: np.mean(np.abs(maps[engine]-disk)[inside]) for engine in maps}
+        assert errors['polar'] <= errors['rotation']
+        assert np.max(np.abs(maps['polar']-disk)[inside]) < 0.01*np.max(disk)
+    with pytest.raises(sf.InputError):
+        sf.remove_inhomogeneities(configuration,fits_map,center = center, WCS_center = False, engine = 'median')
+
+# The deprojection as it was done with an interpolation per column
+def baseline_deproject(map,angle, center = 0., invert = False):
+    axis = np.array(range(len(map[:,0])),dtype=float)-center
+    if invert:
+        newaxis = axis/np.cos(np.radians(angle))
+    else:
+        newaxis = axis*np.cos(np.radians(angle))
+    for x in range(len(map[0,:])):
+        profile = copy.deepcopy(map[:,x])
+        new_profile = np.interp(np.array(newaxis,dtype=float),np.array(axis,dtype=float),np.array(profile,dtype=float))
+        map[:,x] = new_profile
+    return map
+
+@pytest.mark.parametrize('dtype',[np.float64,np.float32])
+@pytest.mark.parametrize('invert',[False,True])
+def test_deproject_matches_interpolation_per_column(configuration,dtype,invert):
+    map = np.random.default_rng(4).normal(size=(41,37)).astype(dtype)
+    map[7,3] = np.nan
+    for angle in [0.,30.,60.,85.]:
+        for center in [0.,20.,17.3,40.]:
+            expected = baseline_deproject(np.array(map),angle,center = center,invert = invert)
+            new_map = sf.deproject(configuration,map,angle,center = center,invert = invert,in_place = False)
+            assert new_map.dtype == dtype
+            assert np.allclose(new_map,expected,rtol=1e-13,atol=1e-14,equal_nan=True)
+            # in place the map itself is changed as before
+            in_place = np.array(map)
+            assert sf.deproject(configuration,in_place,angle,center = center,invert = invert) is in_place
+            assert np.array_equal(in_place,new_map,equal_nan=True)
+    # a single row cannot be interpolated
+    row = np.ones((1,5),dtype=dtype)
+    assert np.array_equal(sf.deproject(configuration,row,60.,in_place = False),row)